@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+Benchmark of update_stack.main() against a local fake buildhost and a fake
+dpkg, sweeping the size of the manifest and the ratio of packages to update.
+
+    $ python benchmarks/bench_update_stack.py --sizes 10,100,1000 \
+            --ratios 0.1,1 --latency 0.005 --bandwidth 10000000
+
+Each scenario reports the wall time of main(), and the number of requests
+and bytes served by the buildhost.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from mise_a_feu.scripts import update_stack
+
+
+FAKE_DPKG = """#!%(python)s
+# fake dpkg keeping the installed packages in a dpkg status file
+import os
+import sys
+
+status_file = %(status_file)r
+
+
+def read():
+    packages = {}
+    if os.path.exists(status_file):
+        for stanza in open(status_file).read().split("\\n\\n"):
+            fields = dict(line.split(": ", 1) for line in stanza.splitlines())
+            if fields:
+                packages[fields["Package"]] = fields["Version"]
+    return packages
+
+
+def write(packages):
+    with open(status_file, "w") as output:
+        output.write("\\n\\n".join(
+            "Package: %%s\\nStatus: install ok installed\\nVersion: %%s" %% (
+                package, version)
+            for package, version in sorted(packages.items())))
+
+
+arguments = [argument for argument in sys.argv[1:]
+             if not argument.startswith("--force")]
+packages = read()
+if arguments[0] == "-r":
+    for package in arguments[1:]:
+        packages.pop(package, None)
+elif arguments[0] == "-i":
+    for deb in arguments[1:]:
+        package, version = os.path.basename(deb)[:-len("-amd64.deb")] \\
+                                                            .rsplit("-", 1)
+        packages[package] = version
+elif arguments[0] == "-s":
+    if arguments[1] not in packages:
+        sys.exit(1)
+    print "Package: %%s\\nVersion: %%s" %% (arguments[1], packages[arguments[1]])
+    sys.exit(0)
+write(packages)
+"""
+
+
+class FakeBuildhostHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer the requests of update_stack as a buildhost whose stack has the
+    version `server.version` of every package.
+    """
+    protocol_version = "HTTP/1.1"
+    # headers are written line by line, do not let them wait for an ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._dispatch(None)
+
+    def do_HEAD(self):
+        self._dispatch(None)
+
+    def do_POST(self):
+        length = int(self.headers.getheader("Content-Length", 0))
+        self._dispatch(self.rfile.read(length))
+
+    def _dispatch(self, body):
+        server = self.server
+        time.sleep(server.latency)
+        parts = self.path.strip("/").split("/")
+        version = server.version
+        if self.path.startswith("/debs/") and self.path.endswith(".sha256"):
+            self._reply(200, server.deb_sha256)
+        elif self.path.startswith("/debs/"):
+            self._reply(200, server.deb)
+        elif parts[0] == "packages" and parts[-1] == "file":
+            self._reply(200, "%s-%s-amd64.deb" % (parts[1], parts[3]))
+        elif parts[0] == "domains" and parts[-1] == "version":
+            self._reply(200, version)
+        elif parts[0] == "domains" and body is not None:
+            self._reply(200, json.dumps(dict(
+                (package, {"version": version,
+                           "file": "%s-%s-amd64.deb" % (package, version),
+                           "sha256": server.deb_sha256})
+                for package in json.loads(body)["packages"])))
+        else:
+            self._reply(404, "not found")
+
+    def _reply(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "HEAD":
+            body = ""
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes += len(body)
+        chunk_size = 64 * 1024
+        for offset in range(0, len(body), chunk_size):
+            chunk = body[offset:offset + chunk_size]
+            if self.server.bandwidth:
+                time.sleep(float(len(chunk)) / self.server.bandwidth)
+            self.wfile.write(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeBuildhost(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local buildhost answering after `latency` seconds, sending packages of
+    deb_size bytes at `bandwidth` bytes per second (unlimited with 0).
+    """
+    daemon_threads = True
+
+    def __init__(self, version, latency=0, bandwidth=0, deb_size=1024):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           FakeBuildhostHandler)
+        self.version = version
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.deb = os.urandom(deb_size)
+        self.deb_sha256 = hashlib.sha256(self.deb).hexdigest()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def address(self):
+        return "%s:%s" % self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeHost(object):
+    """
+    Temporary folder holding a fake dpkg, its status file and the manifest
+    of `size` packages, the first `changed` of which are outdated.
+    """
+    def __init__(self, size, changed, version):
+        self.folder = tempfile.mkdtemp(prefix="mise-a-feu-bench-")
+        self.status_file = os.path.join(self.folder, "status")
+        self.manifest = os.path.join(self.folder, "manifest")
+        packages = ["package%05d" % index for index in range(size)]
+        with open(self.manifest, "w") as manifest:
+            manifest.write("\n".join(packages))
+        with open(self.status_file, "w") as status:
+            status.write("\n\n".join(
+                "Package: %s\nStatus: install ok installed\nVersion: %s" % (
+                    package, "0.0.1" if index < changed else version)
+                for index, package in enumerate(packages)))
+
+        bin_folder = os.path.join(self.folder, "bin")
+        os.mkdir(bin_folder)
+        dpkg = os.path.join(bin_folder, "dpkg")
+        with open(dpkg, "w") as script:
+            script.write(FAKE_DPKG % {"python": sys.executable,
+                                      "status_file": self.status_file})
+        os.chmod(dpkg, 0755)
+        self.path = bin_folder + os.pathsep + os.environ.get("PATH", "")
+
+    def remove(self):
+        shutil.rmtree(self.folder)
+
+
+def run_scenario(size, ratio, latency=0, bandwidth=0, deb_size=1024,
+                 **options):
+    """
+    Run update_stack.main() on a fake host of `size` packages, `ratio` of
+    which are outdated, and return the wall time, number of requests and
+    bytes served by the buildhost, the number of packages updated and of
+    packages still outdated according to the fake dpkg.
+    The options are passed to main().
+    """
+    buildhost = FakeBuildhost("1.0.0", latency=latency, bandwidth=bandwidth,
+                              deb_size=deb_size)
+    host = FakeHost(size, int(round(size * ratio)), "1.0.0")
+    path = os.environ.get("PATH")
+    base_folder = update_stack.base_folder
+    dpkg_status_file = update_stack.dpkg_status_file
+    os.environ["PATH"] = host.path
+    update_stack.base_folder = host.folder
+    update_stack.dpkg_status_file = host.status_file
+    try:
+        started = time.time()
+        packages = update_stack.main(host.manifest, buildhost.address,
+                                     "default", **options)
+        elapsed = time.time() - started
+        outdated = [package for package, version
+                    in update_stack.get_local_versions().items()
+                    if version != buildhost.version]
+    finally:
+        os.environ["PATH"] = path
+        update_stack.base_folder = base_folder
+        update_stack.dpkg_status_file = dpkg_status_file
+        update_stack.http_pool.close()
+        buildhost.stop()
+        host.remove()
+    return {"size": size,
+            "ratio": ratio,
+            "updated": len(packages),
+            "outdated": len(outdated),
+            "seconds": elapsed,
+            "requests": buildhost.requests,
+            "bytes": buildhost.bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark update_stack "
+                                     "against a fake buildhost and dpkg.")
+    parser.add_argument('--sizes', default="10,100,1000,5000",
+                        help="comma separated numbers of packages in the "
+                             "manifest (10,100,1000,5000 by default)")
+    parser.add_argument('--ratios', default="0,0.1,0.5,1",
+                        help="comma separated ratios of packages to update "
+                             "(0,0.1,0.5,1 by default)")
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help="seconds before each answer of the buildhost")
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help="bytes per second sent by the buildhost "
+                             "(unlimited by default)")
+    parser.add_argument('--deb-size', type=int, default=1024,
+                        help="size of each package in bytes")
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--download-jobs', type=int, default=2)
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--strategy', default="remove-install",
+                        choices=['remove-install', 'upgrade'])
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as json lines")
+    args = parser.parse_args()
+
+    if not args.json:
+        print "%6s %6s %8s %10s %9s %12s" % ("size", "ratio", "updated",
+                                              "seconds", "requests", "bytes")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        for ratio in [float(ratio) for ratio in args.ratios.split(",")]:
+            result = run_scenario(size, ratio,
+                                  latency=args.latency,
+                                  bandwidth=args.bandwidth,
+                                  deb_size=args.deb_size,
+                                  jobs=args.jobs,
+                                  download_jobs=args.download_jobs,
+                                  batch=args.batch,
+                                  strategy=args.strategy)
+            if args.json:
+                print json.dumps(result)
+            else:
+                print "%(size)6d %(ratio)6.2f %(updated)8d %(seconds)9.2fs " \
+                      "%(requests)9d %(bytes)12d" % result
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
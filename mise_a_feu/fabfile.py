@@ -2,11 +2,21 @@
 #code: utf-8
 
 import os
-from fabric.api import put, task, run, sudo, settings, abort, local, env, runs_once, execute, parallel
+import time
+from StringIO import StringIO
+from fabric.api import put, task, run, sudo, settings, abort, local, env, runs_once, execute, parallel, hide
 import fabric.main
 
 from lib.stack_updater import StackUpdater
-from lib.utils import str2bool, get_config, run_notifications, log_deployment
+from lib.rollout import WaveScheduler, has_failed
+from lib.post_deploy import schedule_post_deployment, stage_hosts, stage_pool_size
+from lib.delivery import Notifier
+from lib.deploy_state import DeployState, converge
+from lib.progress import FleetProgress
+from lib.timings import summarize_timings, format_timings
+from lib.utils import str2bool, get_config, run_notifications, log_deployment, record_deployment, parse_time
+from lib.history import DeploymentHistory
+from scripts import update_stack
 from scripts.update_stack import get_version
 
 
@@ -32,29 +42,61 @@ def show_config():
 
 
 @task
-def update_updater(updater_path=None):
+@parallel
+def upload_updater(updater_path=None):
     '''
-    Upload a new update_stack python script to the REMOTE side (e.g. hosts)
+    Upload the update_stack python script to the REMOTE side (e.g. hosts)
+    if it differs from the REMOTE one, and return whether it was uploaded.
     '''
-    updater_path = updater_path or '/root/tools/update_stack.py'
     origin = os.path.join(os.path.dirname(__file__),
                         "scripts",
                         "update_stack.py")
+    updater = StackUpdater(None, None, None,
+                           updater_path=updater_path or env.get("updater_path"))
+    return updater.upload(origin)
 
-    put(origin, updater_path, mirror_local_mode=False, use_sudo=True)
-    sudo("chown root:root %s" % updater_path)
-    sudo("chmod 770 %s" % updater_path)
+
+@task
+@runs_once
+def update_updater(updater_path=None):
+    '''
+    Upload a new update_stack python script to the REMOTE side (e.g. hosts)
+    '''
+    results = execute(upload_updater, updater_path=updater_path)
+    updated = len([host for host, uploaded in results.items() if uploaded])
+    print "update_stack.py updated on %s hosts, skipped on %s" % (
+                                            updated, len(results) - updated)
+    return results
 
 
 @task
 def run_updater(domain, stack, buildhost,
                 manifest=None, updater_path=None, webcallback=None,
-                verbose=True, force=False):
+                verbose=True, force=False, jobs=None, batch=False,
+                download_jobs=None, cache_dir=None, phase=None, strategy=None,
+                detach=False, peers=None, plan=None, timings=None,
+                lookup_cache=None):
     '''
-    Run the REMOTE update_stack python script using a REMOTE manifest
+    Run the REMOTE update_stack python script using a REMOTE manifest.
+    phase "prefetch" only stages the packages, "install" installs them.
+    With detach, the script runs in the background and its job id is returned.
+    Without lookup_cache, the versions are always asked to the buildhost.
     '''
     verbose = str2bool(verbose)
     force = str2bool(force)
+    manifest = manifest or env.get("manifest")
+    updater_path = updater_path or env.get("updater_path")
+    jobs = jobs or env.get("jobs")
+    batch = str2bool(batch) or env.get("batch", False)
+    download_jobs = download_jobs or env.get("download_jobs")
+    cache_dir = cache_dir or env.get("cache_dir")
+    strategy = strategy or env.get("strategy")
+    timings = timings or env.get("timings_file")
+    lookup_cache = str2bool(lookup_cache) if lookup_cache is not None \
+                                          else env.get("lookup_cache", True)
+    detach = str2bool(detach)
+    if isinstance(peers, basestring):
+        peers = peers.split(",")
 
     updater = StackUpdater(domain,
                            stack,
@@ -63,53 +105,556 @@ def run_updater(domain, stack, buildhost,
                            updater_path=updater_path,
                            webcallback=webcallback,
                            force_update=force,
-                           verbose=verbose)
-    return updater.run()
+                           verbose=verbose,
+                           jobs=jobs,
+                           batch=batch,
+                           download_jobs=download_jobs,
+                           cache_dir=cache_dir,
+                           cache_max_bytes=env.get("cache_max_bytes"),
+                           cache_max_entries=env.get("cache_max_entries"),
+                           strategy=strategy,
+                           peers=peers,
+                           timings=timings,
+                           lookup_cache=lookup_cache,
+                           lookup_ttl=env.get("lookup_ttl"),
+                           retain_dir=env.get("retain_dir"),
+                           deltas=env.get("deltas", False),
+                           connect_timeout=env.get("connect_timeout"),
+                           read_timeout=env.get("read_timeout"),
+                           agent=env.get("agent_port"),
+                           agent_token=env.get("agent_token"))
+    if plan and phase != "install":
+        updater.push_plan(plan)
+    if phase == "prefetch":
+        return updater.prefetch()
+    elif phase == "install":
+        return updater.install_staged()
+    elif phase:
+        abort("Unknown phase: %s" % phase)
+    elif detach:
+        return updater.start()
+    fleet = env.get("fleet_progress")
+    return updater.run(progress=fleet.callback_for(env.host_string)
+                                if fleet is not None else None)
 
 
 @task
 @parallel
-def deploy_host(domain, stack_version):
+def deploy_host(domain, stack_version, phase=None, detach=False, peers=None,
+                plan=None):
     """
     Do only deployment according to config file & stack version
     """
-    run_updater(domain, stack_version, env["buildhost"])
+    try:
+        return run_updater(domain, stack_version, env["buildhost"],
+                           phase=phase, detach=detach, peers=peers, plan=plan)
+    except SystemExit, e:
+        # a parallel task aborting has no result, raise an error instead
+        raise Exception(getattr(e, "message", None) or "aborted")
+
+
+@task
+@parallel
+def read_manifest(manifest=None):
+    """
+    Return the packages of the REMOTE manifest of the host.
+    """
+    manifest = manifest or StackUpdater(None, None, None,
+                                        manifest=env.get("manifest")).manifest
+    with hide('running', 'stdout'):
+        return sudo("cat %s" % manifest).splitlines()
+
+
+@task
+@runs_once
+def resolve_plan(domain, stack_version, plan_file=None):
+    """
+    Resolve the stack once for the manifests of all the hosts into a plan.
+    """
+    plan_file = plan_file or "plan-%s-%s.json" % (domain, stack_version)
+    packages = set()
+    for manifest in execute(read_manifest).values():
+        packages.update(package.strip() for package in manifest
+                        if package.strip())
+    update_stack.write_plan(plan_file,
+                            env["buildhost"],
+                            sorted(packages),
+                            domain,
+                            stack=stack_version,
+                            jobs=int(env.get("jobs", 4)),
+                            batch=env.get("batch", False))
+    print "plan of %s packages written into %s" % (len(packages), plan_file)
+    return plan_file
+
+
+@task
+@parallel
+def collect_timings(timings_file):
+    """
+    Return the timing events of the updates run on the host, and remove them.
+    """
+    updater = StackUpdater(None, None, None,
+                           updater_path=env.get("updater_path"))
+    return updater.collect_timings(timings_file)
+
+
+@task
+@parallel
+def plan_host(domain, stack_version):
+    """
+    Return the changes a deployment would make on the host, without
+    applying them.
+    """
+    updater = StackUpdater(domain, stack_version, env["buildhost"],
+                           manifest=env.get("manifest"),
+                           updater_path=env.get("updater_path"),
+                           jobs=env.get("jobs"),
+                           batch=env.get("batch", False),
+                           cache_dir=env.get("cache_dir"),
+                           agent=env.get("agent_port"),
+                           agent_token=env.get("agent_token"))
+    return updater.dry_run()
 
 
 @task
+@runs_once
+def plan_fleet(domain, stack_version):
+    """
+    Print the changes a deployment would make on all the hosts, with the
+    volume to download and the distinct packages it needs.
+    """
+    plans = execute(plan_host, domain, stack_version)
+    debs = {}
+    total = 0
+    for host in sorted(plans):
+        changes = plans[host]["changes"]
+        print "%s: %s changes, %s bytes to download" % (
+            host, len(changes), plans[host]["download_bytes"])
+        for change in changes:
+            print "  %(action)s %(package)s %(installed)s -> %(version)s" % \
+                                                                    change
+            if change["file"]:
+                debs[change["file"]] = max(change["size"],
+                                           debs.get(change["file"], 0))
+        total += plans[host]["download_bytes"]
+    print "%s hosts, %s bytes to download, %s distinct packages of %s bytes" \
+        % (len(plans), total, len(debs), sum(debs.values()))
+    return plans
+
+
+@task
+@parallel
+def rollback_host(domain, stack_version):
+    """
+    Reinstall the packages replaced by the last deployment on the host, and
+    return how long it took.
+    """
+    updater = StackUpdater(domain, stack_version, env["buildhost"],
+                           manifest=env.get("manifest"),
+                           updater_path=env.get("updater_path"),
+                           verbose=True,
+                           retain_dir=env.get("retain_dir"),
+                           agent=env.get("agent_port"),
+                           agent_token=env.get("agent_token"))
+    started = time.time()
+    updater.rollback()
+    return time.time() - started
+
+
+@task
+@runs_once
+def rollback(domain, stack_version):
+    """
+    Roll all the hosts back to the packages they had before the last
+    deployment, from the ones they retained, without the buildhost.
+    """
+    started = time.time()
+    durations = execute(rollback_host, domain, stack_version)
+    for host in sorted(durations):
+        print "%s: rolled back in %.2fs" % (host, durations[host])
+    print "%s hosts rolled back in %.2fs" % (len(durations),
+                                             time.time() - started)
+    return durations
+
+
+@task
+@parallel
+def start_agent(port=None, token_file="/root/tools/agent.token"):
+    """
+    Start the agent of the host, which then runs the updates requested by
+    the next deployments. The agent listens on agent_bind (all the
+    addresses by default) and requires the agent_token of the config file.
+    """
+    port = port or env["agent_port"]
+    if not env.get("agent_token"):
+        abort("agent_token is required to start the agents")
+    updater = StackUpdater(None, None, None,
+                           updater_path=env.get("updater_path"),
+                           cache_dir=env.get("cache_dir"),
+                           lookup_cache=env.get("lookup_cache", True),
+                           retain_dir=env.get("retain_dir"))
+    put(StringIO(env["agent_token"]), token_file, use_sudo=True, mode=0600)
+    sudo("chown root:root %s" % token_file)
+    return updater.start_agent(port, token_file, bind=env.get("agent_bind"))
+
+
+@task
+@parallel
+def stop_agent():
+    """
+    Stop the agent started by start_agent.
+    """
+    updater = StackUpdater(None, None, None,
+                           updater_path=env.get("updater_path"))
+    return updater.stop_agent()
+
+
+@task
+@parallel
+def start_relay(port, duration=None, bind=None):
+    """
+    Serve the packages downloaded on the host to the other hosts.
+    """
+    updater = StackUpdater(None, None, None,
+                           updater_path=env.get("updater_path"),
+                           cache_dir=env.get("cache_dir"))
+    return updater.serve(port, duration=duration, bind=bind)
+
+
+@task
+@parallel
+def stop_relay(jobs):
+    """
+    Stop serving the packages started by start_relay.
+    """
+    updater = StackUpdater(None, None, None,
+                           updater_path=env.get("updater_path"))
+    return updater.stop(jobs[env.host_string])
+
+
+@task
+@parallel
+def poll_host(jobs, updater_path=None):
+    """
+    Return the status of the detached update job of the host.
+    """
+    updater = StackUpdater(None, None, None,
+                           updater_path=updater_path or env.get("updater_path"))
+    return updater.poll(jobs[env.host_string])
+
+
+def deploy_hosts(domain, stack_version, phase=None, plan=None, hosts=None,
+                 detach=False):
+    """
+    Run deploy_host on the hosts, all of them by default, wave by wave if
+    the config file has a rollout section. With a distribution section as
+    well, the hosts of each wave then serve the packages to the hosts of the
+    next waves, unless they only install staged packages. With detach, the
+    updates run in the background on the hosts, which are polled until they
+    are over, for at most host_timeout seconds.
+    """
+    hosts = hosts or env.hosts
+
+    def _deploy(hosts, peers=None):
+        if not detach:
+            return execute(deploy_host, domain, stack_version, phase=phase,
+                           peers=peers, plan=plan, hosts=hosts)
+        jobs = execute(deploy_host, domain, stack_version, phase=phase,
+                       detach=True, peers=peers, plan=plan, hosts=hosts)
+        results = dict((host, job) for host, job in jobs.items()
+                       if has_failed(job))
+        results.update(wait_for_jobs(dict((host, job)
+                                          for host, job in jobs.items()
+                                          if host not in results),
+                                     env.get("poll_interval", 5),
+                                     timeout=env.get("host_timeout")))
+        return results
+
+    if "rollout" not in env:
+        return _deploy(hosts)
+
+    def _gate():
+        with settings(warn_only=True):
+            return local(env.rollout["gate"]).succeeded
+
+    relays = {}
+    distribution = env.get("distribution") if phase != "install" else None
+
+    def _deploy_wave(hosts):
+        peers = ["%s:%s" % (host.split("@")[-1].split(":")[0],
+                            distribution["relay_port"])
+                 for host in sorted(relays)] if distribution else None
+        results = _deploy(hosts, peers=peers)
+        succeeded = [host for host in hosts if not has_failed(results[host])]
+        if distribution and succeeded:
+            relays.update(execute(start_relay,
+                                  distribution["relay_port"],
+                                  distribution.get("serve_for", 3600),
+                                  distribution.get("relay_bind"),
+                                  hosts=succeeded))
+        return results
+
+    scheduler = WaveScheduler.from_config(hosts, env.rollout,
+                                gate=_gate if "gate" in env.rollout else None)
+    try:
+        return scheduler.run(_deploy_wave)
+    finally:
+        if relays:
+            with settings(warn_only=True):
+                execute(stop_relay, relays, hosts=sorted(relays))
+
+
+def wait_for_jobs(jobs, interval=5, timeout=None):
+    """
+    Poll the detached update jobs, {host: job_id}, until they are all over,
+    or for at most timeout seconds, and return their last status by host.
+    """
+    statuses = {}
+    pending = dict(jobs)
+    started = time.time()
+    while pending:
+        if timeout is not None and time.time() - started >= timeout:
+            statuses.update((host, {"job": job_id, "status": "running"})
+                            for host, job_id in pending.items())
+            break
+        time.sleep(interval)
+        for host, status in execute(poll_host, pending,
+                                    hosts=sorted(pending)).items():
+            if status["status"] != "running":
+                statuses[host] = status
+                del pending[host]
+    return statuses
+
+
+@task
+@runs_once
+def prefetch(domain, stack_version):
+    """
+    Stage the packages of the stack on all the hosts, without installing.
+    """
+    deploy_hosts(domain, stack_version, phase="prefetch")
+
+
+@task
+@parallel
+def run_post_deploy_command(command):
+    """
+    Run one post deployment command of the config file on the host.
+    """
+    with settings(warn_only=command["warn_only"] if "warn_only" in command else env.warn_only):
+        return run(command["command"])
+
+
+@task
+@parallel
+def run_post_deploy_stage(stage):
+    """
+    Run the commands of a post deployment stage meant for the host, one
+    after the other.
+    """
+    return [run_post_deploy_command(command) for command, hosts in stage
+            if env.host_string in hosts]
+
+
+@task
+@runs_once
 def post_deploy():
     """
-    Run post deployment tasks
+    Run post deployment tasks, each on its hosts in parallel, after the
+    commands listed in its "after". The commands which do not depend on each
+    other form a stage, ran by one parallel execution on all their hosts, at
+    most the lowest "concurrency" of them at once.
+    The hosts are the ones of the deployment, from the hosts and the roles.
     """
-    for command in env["post_deployment"]:
-        if ("run_once_on" in command and
-                env.host_string != command["run_once_on"]):
-            continue
-        else:
-            with settings(warn_only=command["warn_only"] if "warn_only" in command else env.warn_only):
-                run(command["command"])
+    for stage in schedule_post_deployment(env["post_deployment"],
+                                          env.all_hosts or env.hosts):
+        task = parallel(pool_size=stage_pool_size(stage))(
+                                            run_post_deploy_stage.wrapped)
+        execute(task, stage, hosts=stage_hosts(stage))
 
 
 @task
 @runs_once
-def deploy(domain, stack_version):
+def deploy(domain, stack_version, prefetch=False, detach=False, plan=False,
+           progress=False, resume=False):
     """
     Deploy to all the hosts and run the post deployment tasks.
+    The hosts whose update fails, or lasts more than the host_timeout of
+    the config file, are retried as set by its retry section. The outcome
+    of each host is kept in a state file until they all succeeded: with
+    resume, only the hosts which did not are deployed again.
+    With prefetch, the packages are staged on all the hosts before any
+    of them starts installing. With detach, the updates run in the
+    background on the hosts, which are polled until they are over.
+    With plan, the stack is resolved once here instead of on each host.
+    With progress, the progress of the updates of all the hosts is printed
+    while they run, along with the hosts not progressing anymore.
+    The durations of the update phases on all the hosts are printed at the
+    end, and recorded with the outcome of each host into the history
+    database, even when the deployment fails. The notifications are sent
+    in the background, and waited for at most "wait" seconds of the
+    delivery section of the config file.
     """
+    prefetch = str2bool(prefetch) or env.get("prefetch", False)
+    detach = str2bool(detach) or env.get("detach", False)
+    plan = str2bool(plan) or env.get("plan", False)
+    progress = str2bool(progress) or "progress" in env
+    resume = str2bool(resume)
+    state_file = env.get("state_file", "~/.mise-a-feu/state-%s-%s.json" % (
+                                                        domain, stack_version))
+    if resume:
+        state = DeployState.load(state_file)
+        if (state is None or state.domain != domain or
+                state.stack != stack_version):
+            abort("No deployment of %s to %s to resume: %s" % (
+                                        stack_version, domain, state_file))
+    else:
+        state = DeployState(state_file, domain, stack_version, env.hosts)
     # LOCK the deploymend with pidfile here, req for paralel execution!
     if os.path.exists(os.path.expanduser(env["pidfile"])):
         abort("Deployment in progress: %s" % env["pidfile"])
+    # before the lock, which a failure would leave behind otherwise
+    plan_file = resolve_plan(domain, stack_version) if plan else None
     with open(os.path.expanduser(env["pidfile"]), "w") as pidfile:
         pidfile.write(str(os.getpid()))
 
-    run_notifications(env.notifications["start"], stack_version)
-    # TODO? with settings(warn_only=True):
-    execute(deploy_host, domain, stack_version)
-    execute(post_deploy)
-    log_deployment(stack_version)
-    # unlock here
-    os.remove(os.path.expanduser(env["pidfile"]))
-    run_notifications(env.notifications["end"], stack_version)
+    delivery = env.get("delivery", {})
+    notifier = Notifier(timeout=delivery.get("timeout", 30),
+                        retries=delivery.get("retries", 2),
+                        backoff=delivery.get("backoff", 1))
+    run_notifications(env.notifications["start"], stack_version, notifier)
+
+    def _close_notifier():
+        stats = notifier.close(delivery.get("wait", 60))
+        print "notifications: %(sent)s sent, %(failed)s failed, " \
+              "%(retried)s retried, %(coalesced)s coalesced" % stats
+
+    # every update of this deployment appends its timing events there
+    timings_file = "/tmp/mise-a-feu-timings-%s-%s.jsonl" % (
+                                            stack_version, int(time.time()))
+    if progress:
+        env.fleet_progress = FleetProgress(hosts=env.hosts,
+                                           **env.get("progress", {}))
+        env.fleet_progress.start()
+    host_timeout = env.get("host_timeout")
+
+    def _deploy(hosts):
+        if prefetch:
+            begin = time.time()
+            try:
+                prefetched = deploy_hosts(domain, stack_version,
+                                          phase="prefetch", plan=plan_file,
+                                          hosts=hosts)
+            except SystemExit, e:
+                # staging the packages is not updating the host
+                e.results = dict((host, result) for host, result in
+                                 getattr(e, "results", {}).items()
+                                 if has_failed(result))
+                raise
+            installing = time.time()
+            results = dict((host, result) for host, result in
+                           prefetched.items() if has_failed(result))
+            try:
+                results.update(deploy_hosts(domain, stack_version,
+                                            phase="install",
+                                            hosts=[host for host in hosts
+                                                   if host not in results]))
+            except SystemExit, e:
+                e.results = dict(results.items() +
+                                 getattr(e, "results", {}).items())
+                raise
+            print "prefetch: %.1fs, install: %.1fs" % (installing - begin,
+                                                       time.time() - installing)
+            return results
+        return deploy_hosts(domain, stack_version, plan=plan_file,
+                            hosts=hosts, detach=detach)
+
+    started = time.time()
+    outcome = "failed"
+    retry = env.get("retry", {})
+    state.save()
+    try:
+        with settings(warn_only=True, command_timeout=host_timeout,
+                      timings_file=timings_file):
+            converge(_deploy, state,
+                     retries=retry.get("retries", 0),
+                     backoff=retry.get("backoff", 30))
+        print state.summary()
+        failed = state.pending_hosts()
+        if failed:
+            abort("Update failed on: %s, resume with %s" % (
+                    ", ".join(failed),
+                    "deploy:%s,%s,resume=True" % (domain, stack_version)))
+        outcome = "succeeded"
+        state.remove()
+    finally:
+        if progress:
+            env.fleet_progress.stop()
+            print "progress: %s" % env.fleet_progress.summary()
+        with settings(warn_only=True, skip_bad_hosts=True):
+            timings = execute(collect_timings,
+                              StackUpdater.agent_timings
+                              if env.get("agent_port") else timings_file)
+        events = sum(timings.values(), [])
+        if events:
+            print format_timings(summarize_timings(events))
+        record_deployment(stack_version, started, outcome, state.results(),
+                          timings)
+        if outcome != "succeeded":
+            # unlock, for the deployment to be resumed
+            os.remove(os.path.expanduser(env["pidfile"]))
+            _close_notifier()
+    try:
+        execute(post_deploy)
+        log_deployment(stack_version)
+        # unlock here
+        os.remove(os.path.expanduser(env["pidfile"]))
+        run_notifications(env.notifications["end"], stack_version, notifier)
+    finally:
+        _close_notifier()
+
+
+@task
+@runs_once
+def deployed_at(when=None, environment=None):
+    """
+    Print the last deployment before a time, "YYYY-MM-DD[ HH:MM:SS]" or now,
+    with the package versions of each host at that time.
+    """
+    environment = environment or env.rcfile.split("/")[-1]
+    timestamp = parse_time(when) if when else time.time()
+    history = DeploymentHistory(env.get("history_db",
+                                        "~/.mise-a-feu/history.db"))
+    deployment = history.deployed_at(environment, timestamp)
+    if deployment is None:
+        print "nothing deployed on %s before %s" % (environment, when or "now")
+        return
+    print "%s: stack %s deployed at %s" % (
+        environment, deployment["stack"],
+        time.strftime("%Y-%m-%d %H:%M:%S",
+                      time.localtime(deployment["started"])))
+    for host, versions in sorted(history.versions_at(environment,
+                                                     timestamp).items()):
+        print "%s:" % host
+        for package, version in sorted(versions.items()):
+            print "  %s %s" % (package, version or "(removed)")
+    history.close()
+
+
+@task
+@runs_once
+def slowest_hosts(last=10, limit=10, environment=None):
+    """
+    Print the hosts with the longest updates over the last deployments.
+    """
+    environment = environment or env.rcfile.split("/")[-1]
+    history = DeploymentHistory(env.get("history_db",
+                                        "~/.mise-a-feu/history.db"))
+    print "%-40s %9s %9s %6s" % ("host", "average", "max", "count")
+    for host, average, maximum, count in history.slowest_hosts(
+                                    environment, int(last), int(limit)):
+        print "%-40s %8.1fs %8.1fs %6d" % (host, average, maximum, count)
+    history.close()
 
 
 def main():
@@ -0,0 +1,105 @@
+import os
+import time
+import signal
+import threading
+import subprocess
+import Queue
+
+
+class Notifier(object):
+    """
+    Run the notification commands in background threads, so that a slow
+    mail or chat command does not hold up the deployment.
+
+    Basic usage:
+
+        notifier = Notifier(timeout=30, retries=2)
+        notifier.notify('echo "%(message)s" | mail -s "deploy" ops@foo.com',
+                        "Deploying 1.2.3")
+        ...
+        print notifier.close()
+
+    A command failing or running for more than timeout seconds is retried
+    after backoff seconds, then twice as long each time. The messages sent
+    to a command whose previous message is still waiting for a worker are
+    coalesced into one.
+    """
+    separator = " | "
+
+    def __init__(self, timeout=30, retries=2, backoff=1, workers=2):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {"sent": 0, "failed": 0, "retried": 0, "coalesced": 0}
+        self._pending = {}
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        for _ in range(max(workers, 1)):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def notify(self, command, message):
+        """
+        Queue the command, a format string with a %(message)s placeholder.
+        """
+        with self._lock:
+            if command in self._pending:
+                self._pending[command].append(message)
+                self.stats["coalesced"] += 1
+                return
+            self._pending[command] = [message]
+        self._queue.put(command)
+
+    def close(self, timeout=None):
+        """
+        Wait at most timeout seconds for the queued notifications to be
+        delivered, and return the delivery stats.
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        deadline = time.time() + timeout if timeout is not None else None
+        for worker in self._workers:
+            worker.join(None if deadline is None
+                        else max(deadline - time.time(), 0))
+        return dict(self.stats)
+
+    def _work(self):
+        while True:
+            command = self._queue.get()
+            if command is None:
+                return
+            with self._lock:
+                messages = self._pending.pop(command)
+            delivered = self._deliver(command % {
+                                    "message": self.separator.join(messages)})
+            with self._lock:
+                self.stats["sent" if delivered else "failed"] += 1
+
+    def _deliver(self, command):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self._lock:
+                    self.stats["retried"] += 1
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            if run_with_timeout(command, self.timeout) == 0:
+                return True
+        return False
+
+
+def run_with_timeout(command, timeout=None):
+    """
+    Run the shell command and return its exit code, or None if it was
+    killed after timeout seconds.
+    """
+    process = subprocess.Popen(command, shell=True, preexec_fn=os.setsid)
+    deadline = time.time() + timeout if timeout is not None else None
+    while process.poll() is None:
+        if deadline is not None and time.time() >= deadline:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            return None
+        time.sleep(0.05)
+    return process.returncode
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+
+from utils import host_outcome
+
+
+class DeployState(object):
+    """
+    Outcome of the update of each host of a deployment, kept in a json file
+    so that the deployment can be resumed on the hosts which did not
+    converge yet.
+
+    Basic usage:
+
+        state = DeployState("~/.mise-a-feu/state.json", "main", "1.2.3",
+                            env.hosts)
+        converge(lambda hosts: execute(deploy_host, "main", "1.2.3",
+                                       hosts=hosts),
+                 state, retries=2, backoff=30)
+        print state.pending_hosts()
+    """
+    def __init__(self, path, domain, stack, hosts=(), started=None):
+        self.path = os.path.expanduser(path)
+        self.domain = domain
+        self.stack = stack
+        self.started = started or time.time()
+        self.hosts = dict((host, {"outcome": "pending",
+                                  "reason": None,
+                                  "attempts": 0})
+                          for host in hosts)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the state saved in path, or None if there is none.
+        """
+        try:
+            with open(os.path.expanduser(path)) as state_file:
+                data = json.load(state_file)
+        except (IOError, ValueError):
+            return None
+        state = cls(path, data["domain"], data["stack"],
+                    started=data["started"])
+        state.hosts = data["hosts"]
+        return state
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(self.path + ".tmp", "w") as state_file:
+            json.dump({"domain": self.domain,
+                       "stack": self.stack,
+                       "started": self.started,
+                       "hosts": self.hosts}, state_file, indent=2,
+                      sort_keys=True)
+        os.rename(self.path + ".tmp", self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def record(self, host, outcome, reason=None):
+        entry = self.hosts.setdefault(host, {"attempts": 0})
+        entry.update(outcome=outcome, reason=reason, ended=time.time())
+        entry["attempts"] += 1
+
+    def results(self):
+        """
+        Outcome of each host so far, in the form of the status of a detached
+        job, for `record_deployment`.
+        """
+        return dict((host, {"status": entry["outcome"],
+                            "error": entry["reason"]})
+                    for host, entry in self.hosts.items())
+
+    def pending_hosts(self):
+        """
+        Hosts whose update did not succeed yet.
+        """
+        return sorted(host for host, entry in self.hosts.items()
+                      if entry["outcome"] != "succeeded")
+
+    def summary(self):
+        """
+        One line by host with its outcome, the reason of its failure and
+        the number of attempts.
+        """
+        lines = []
+        for host in sorted(self.hosts):
+            entry = self.hosts[host]
+            line = "%s: %s after %s attempts" % (host, entry["outcome"],
+                                                 entry["attempts"])
+            if entry["reason"]:
+                line += " (%s)" % entry["reason"]
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def converge(deploy, state, retries=0, backoff=1):
+    """
+    Call deploy with the hosts of the state which did not converge yet, then
+    again with the ones which failed or timed out, after backoff seconds and
+    twice as long each time, at most retries times. deploy returns the
+    result by host, like `execute`, and a host without result failed.
+    The state is saved after each attempt. Return the result by host of its
+    last attempt.
+    When deploy aborts, like a `WaveScheduler` stopping the rollout, the
+    "results" of its error are recorded and saved before stopping, without
+    retrying.
+    """
+    results = {}
+    hosts = state.pending_hosts()
+    for attempt in range(retries + 1):
+        if not hosts:
+            break
+        if attempt:
+            delay = backoff * 2 ** (attempt - 1)
+            print "retrying %s hosts in %ss: %s" % (len(hosts), delay,
+                                                   ", ".join(hosts))
+            time.sleep(delay)
+        try:
+            attempt_results = deploy(hosts)
+        except SystemExit, e:
+            for host, result in getattr(e, "results", {}).items():
+                state.record(host, *host_outcome(result))
+            state.save()
+            raise
+        for host in hosts:
+            if host in attempt_results:
+                state.record(host, *host_outcome(attempt_results[host]))
+                results[host] = attempt_results[host]
+            else:
+                state.record(host, "failed", "not deployed")
+        state.save()
+        hosts = state.pending_hosts()
+    return results
@@ -0,0 +1,184 @@
+import os
+import time
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deployments (
+    id INTEGER PRIMARY KEY,
+    environment TEXT NOT NULL,
+    stack TEXT NOT NULL,
+    started REAL NOT NULL,
+    ended REAL,
+    outcome TEXT
+);
+CREATE INDEX IF NOT EXISTS deployments_by_environment
+    ON deployments (environment, started);
+CREATE INDEX IF NOT EXISTS deployments_by_stack
+    ON deployments (stack, started);
+CREATE TABLE IF NOT EXISTS hosts (
+    deployment_id INTEGER NOT NULL REFERENCES deployments (id),
+    host TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    duration REAL,
+    error TEXT,
+    PRIMARY KEY (deployment_id, host)
+);
+CREATE INDEX IF NOT EXISTS hosts_by_host ON hosts (host, deployment_id);
+CREATE TABLE IF NOT EXISTS packages (
+    deployment_id INTEGER NOT NULL REFERENCES deployments (id),
+    host TEXT NOT NULL,
+    package TEXT NOT NULL,
+    installed TEXT,
+    version TEXT
+);
+CREATE INDEX IF NOT EXISTS packages_by_host
+    ON packages (host, package, deployment_id);
+CREATE INDEX IF NOT EXISTS packages_by_deployment
+    ON packages (deployment_id);
+CREATE TABLE IF NOT EXISTS phases (
+    deployment_id INTEGER NOT NULL REFERENCES deployments (id),
+    host TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_by_deployment
+    ON phases (deployment_id, host);
+"""
+
+
+def host_records(results, events):
+    """
+    Build the records of `DeploymentHistory.record` from the result of the
+    update of each host, {host: (outcome, error)}, and the timing events
+    collected from each host, {host: [event]}.
+    """
+    records = {}
+    for host in set(results) | set(events):
+        outcome, error = results.get(host, ("unknown", None))
+        host_events = events.get(host, [])
+        phases = {}
+        packages = {}
+        for event in host_events:
+            if event["phase"] == "resolved":
+                packages[event["package"]] = (event.get("installed"),
+                                              event.get("version"))
+            elif "duration" in event:
+                phases[event["phase"]] = (phases.get(event["phase"], 0) +
+                                          event["duration"])
+        timed_events = [event for event in host_events if "start" in event]
+        duration = None
+        if timed_events:
+            duration = (max(event["end"] for event in timed_events) -
+                        min(event["start"] for event in timed_events))
+        records[host] = {"outcome": outcome,
+                         "error": error,
+                         "duration": duration,
+                         "phases": phases,
+                         "packages": packages}
+    return records
+
+
+class DeploymentHistory(object):
+    """
+    History of the deployments in a sqlite database, with the outcome and
+    duration of each host, the packages it updated and the duration of
+    each phase of its update.
+
+    Basic usage:
+
+        history = DeploymentHistory("~/.mise-a-feu/history.db")
+        history.record("production", "1.2.3", started, time.time(),
+                       "succeeded", {"host1": {"outcome": "succeeded",
+                                               "duration": 12.5}})
+        print history.deployed_at("production", time.time() - 86400)
+    """
+    def __init__(self, path):
+        path = os.path.expanduser(path)
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, environment, stack, started, ended, outcome, hosts=None):
+        """
+        Record a deployment, with hosts as {host: {"outcome", "error",
+        "duration", "phases": {phase: duration},
+        "packages": {package: (installed, version)}}}, and return its id.
+        """
+        with self.connection:
+            deployment_id = self.connection.execute(
+                "INSERT INTO deployments (environment, stack, started, ended,"
+                " outcome) VALUES (?, ?, ?, ?, ?)",
+                (environment, stack, started, ended, outcome)).lastrowid
+            for host, record in (hosts or {}).items():
+                self.connection.execute(
+                    "INSERT INTO hosts (deployment_id, host, outcome, duration,"
+                    " error) VALUES (?, ?, ?, ?, ?)",
+                    (deployment_id, host, record["outcome"],
+                     record.get("duration"), record.get("error")))
+                self.connection.executemany(
+                    "INSERT INTO packages (deployment_id, host, package,"
+                    " installed, version) VALUES (?, ?, ?, ?, ?)",
+                    [(deployment_id, host, package, installed, version)
+                     for package, (installed, version)
+                     in record.get("packages", {}).items()])
+                self.connection.executemany(
+                    "INSERT INTO phases (deployment_id, host, phase, duration)"
+                    " VALUES (?, ?, ?, ?)",
+                    [(deployment_id, host, phase, duration)
+                     for phase, duration in record.get("phases", {}).items()])
+        return deployment_id
+
+    def deployed_at(self, environment, timestamp=None):
+        """
+        Return the last deployment of the environment started before
+        timestamp, now by default, which did not fail, or None.
+        """
+        return self.connection.execute(
+            "SELECT * FROM deployments WHERE environment = ? AND started <= ?"
+            " AND outcome = 'succeeded' ORDER BY started DESC LIMIT 1",
+            (environment, timestamp or time.time())).fetchone()
+
+    def versions_at(self, environment, timestamp=None, host=None):
+        """
+        Return the version of the packages updated by the deployments of
+        the environment started before timestamp, by host and package, as
+        of the last of these deployments updating each of them.
+        """
+        query = ("SELECT packages.host, packages.package, packages.version,"
+                 " MAX(deployments.started) AS started"
+                 " FROM packages JOIN deployments"
+                 " ON deployments.id = packages.deployment_id"
+                 " JOIN hosts ON hosts.deployment_id = packages.deployment_id"
+                 " AND hosts.host = packages.host"
+                 " WHERE deployments.environment = ?"
+                 " AND deployments.started <= ? AND hosts.outcome = 'succeeded'")
+        parameters = [environment, timestamp or time.time()]
+        if host:
+            query += " AND packages.host = ?"
+            parameters.append(host)
+        query += " GROUP BY packages.host, packages.package"
+        versions = {}
+        for row in self.connection.execute(query, parameters):
+            versions.setdefault(row["host"], {})[row["package"]] = \
+                                                                row["version"]
+        return versions
+
+    def slowest_hosts(self, environment, last=10, limit=10):
+        """
+        Return the hosts with the longest average update over the last
+        deployments of the environment, as (host, average, maximum, count).
+        """
+        return [tuple(row) for row in self.connection.execute(
+            "SELECT host, AVG(duration) AS average, MAX(duration) AS maximum,"
+            " COUNT(*) AS count FROM hosts WHERE deployment_id IN"
+            " (SELECT id FROM deployments WHERE environment = ?"
+            "  ORDER BY started DESC LIMIT ?)"
+            " AND duration IS NOT NULL"
+            " GROUP BY host ORDER BY average DESC LIMIT ?",
+            (environment, last, limit))]
@@ -0,0 +1,83 @@
+from fabric.api import abort
+
+
+def command_name(command):
+    """
+    Name of a post deployment command, to refer to it in "after".
+    """
+    return command.get("name", command["command"])
+
+
+def command_dependencies(commands):
+    """
+    Return the names of the commands each command must wait for, by index.
+    A command waits for the commands listed in its "after", a name or a
+    list of names, and by default for the previous command of the list.
+    """
+    names = [command_name(command) for command in commands]
+    dependencies = []
+    for index, command in enumerate(commands):
+        if "after" not in command:
+            after = names[index - 1:index]
+        elif isinstance(command["after"], basestring):
+            after = [command["after"]]
+        else:
+            after = list(command["after"] or [])
+        for name in after:
+            if name not in names:
+                abort("Unknown post deployment command in after: %s" % name)
+        dependencies.append(set(after))
+    return dependencies
+
+
+def schedule_post_deployment(commands, hosts):
+    """
+    Order the post deployment commands of the config file into stages: the
+    commands of a stage only depend on the commands of the previous stages.
+    Each stage is a list of (command, hosts to run it on), where a command
+    with "run_once_on" only runs on this host.
+    """
+    dependencies = command_dependencies(commands)
+    done = set()
+    pending = range(len(commands))
+    stages = []
+    while pending:
+        ready = [index for index in pending if dependencies[index] <= done]
+        if not ready:
+            abort("Circular dependencies between the post deployment "
+                  "commands: %s" % ", ".join(command_name(commands[index])
+                                             for index in pending))
+        stage = []
+        for index in ready:
+            command = commands[index]
+            if "run_once_on" in command:
+                targets = [host for host in hosts
+                           if host == command["run_once_on"]]
+            else:
+                targets = list(hosts)
+            if targets:
+                stage.append((command, targets))
+        stages.append(stage)
+        done.update(command_name(commands[index]) for index in ready)
+        pending = [index for index in pending if index not in ready]
+    return stages
+
+
+def stage_hosts(stage):
+    """
+    Hosts running at least one command of a stage, in their order.
+    """
+    hosts = []
+    for _, targets in stage:
+        hosts.extend(host for host in targets if host not in hosts)
+    return hosts
+
+
+def stage_pool_size(stage):
+    """
+    How many hosts run a stage at once: the lowest "concurrency" of its
+    commands, None for all of them.
+    """
+    sizes = [command["concurrency"] for command, _ in stage
+             if command.get("concurrency")]
+    return min(sizes) if sizes else None
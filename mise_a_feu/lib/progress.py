@@ -0,0 +1,146 @@
+import sys
+import json
+import time
+import threading
+import multiprocessing
+import Queue
+
+# prefix of the lines of progress events written by update_stack --progress
+PROGRESS_MARKER = "MISE-A-FEU-PROGRESS "
+
+# state of a host after an event of these phases
+STATES = {"resolved": "resolving",
+          "lookup": "resolving",
+          "batch_lookup": "resolving",
+          "download": "downloading",
+          "remove": "installing",
+          "install": "installing",
+          "downtime": "installing",
+          "done": "done"}
+
+
+class ProgressStream(object):
+    """
+    File-like object to give as stdout to fabric's run or sudo, which calls
+    callback with the list of events of each progress line, and passes
+    the other lines through to output.
+    """
+    def __init__(self, callback, output=None):
+        self.callback = callback
+        self.output = output or sys.stdout
+        self._line = ""
+
+    def write(self, data):
+        self._line += data
+        while "\n" in self._line:
+            line, self._line = self._line.split("\n", 1)
+            self._write_line(line + "\n")
+
+    def flush(self):
+        self.output.flush()
+
+    def _write_line(self, line):
+        index = line.find(PROGRESS_MARKER)
+        if index == -1:
+            self.output.write(line)
+            return
+        try:
+            events = json.loads(line[index + len(PROGRESS_MARKER):])
+        except ValueError:
+            self.output.write(line)
+            return
+        self.callback(events)
+
+
+class FleetProgress(object):
+    """
+    Follow the progress events of the updates of all the hosts, including
+    from the processes of parallel fabric tasks, and print a summary line
+    every interval seconds. Hosts without event for stuck_after seconds
+    are reported as stuck.
+
+    Basic usage:
+
+        fleet = FleetProgress(hosts=env.hosts)
+        fleet.start()
+        execute(task_calling, fleet.callback_for(env.host_string))
+        fleet.stop()
+    """
+    def __init__(self, hosts=(), interval=5, stuck_after=300, output=None):
+        self.interval = interval
+        self.stuck_after = stuck_after
+        self.output = output or sys.stdout
+        self.hosts = {}
+        for host in hosts:
+            self.update(host, [])
+        self._queue = multiprocessing.Queue()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def callback_for(self, host):
+        """
+        Return the function to call with the events received from host.
+        """
+        def _callback(events):
+            self._queue.put((host, events))
+        return _callback
+
+    def update(self, host, events, now=None):
+        progress = self.hosts.setdefault(host, {"state": "starting",
+                                                "events": 0,
+                                                "bytes": 0})
+        for event in events:
+            progress["events"] += 1
+            progress["state"] = STATES.get(event["phase"], progress["state"])
+            if event["phase"] == "download" and event.get("state") == "end":
+                progress["bytes"] += event.get("bytes") or 0
+        progress["updated"] = now or time.time()
+
+    def stuck_hosts(self, now=None):
+        now = now or time.time()
+        return sorted(host for host, progress in self.hosts.items()
+                      if progress["state"] != "done" and
+                         now - progress["updated"] >= self.stuck_after)
+
+    def summary(self, now=None):
+        """
+        One line summary of the states of the hosts.
+        """
+        states = {}
+        for progress in self.hosts.values():
+            states[progress["state"]] = states.get(progress["state"], 0) + 1
+        line = "%s hosts: %s, %s bytes downloaded" % (
+            len(self.hosts),
+            ", ".join("%s %s" % (count, state)
+                      for state, count in sorted(states.items())),
+            sum(progress["bytes"] for progress in self.hosts.values()))
+        stuck = self.stuck_hosts(now)
+        if stuck:
+            line += "; stuck: %s" % ", ".join(stuck)
+        return line
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._drain()
+
+    def _drain(self):
+        while True:
+            try:
+                host, events = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.update(host, events)
+
+    def _work(self):
+        while not self._stopped.wait(self.interval):
+            self._drain()
+            if self.hosts:
+                self.output.write("progress: %s\n" % self.summary())
+                self.output.flush()
@@ -0,0 +1,105 @@
+import math
+import time
+
+from fabric.api import abort, settings
+
+from utils import host_outcome
+
+
+def split_waves(hosts, wave_size=None):
+    """
+    Split the hosts in waves of wave_size hosts, either a number or a
+    percentage of the hosts like "25%". One single wave by default.
+    """
+    hosts = list(hosts)
+    if not hosts:
+        return []
+    if not wave_size:
+        size = len(hosts)
+    elif isinstance(wave_size, basestring) and wave_size.endswith("%"):
+        size = int(math.ceil(len(hosts) * float(wave_size[:-1]) / 100))
+    else:
+        size = int(wave_size)
+    size = max(size, 1)
+    return [hosts[index:index + size] for index in range(0, len(hosts), size)]
+
+
+def has_failed(result):
+    """
+    Tell if the result of a task on a host is not a success, as told by
+    `host_outcome`: the error raised by the task, a failed command ran with
+    warn_only, or a job or an agent update which did not succeed.
+    """
+    return host_outcome(result)[0] != "succeeded"
+
+
+class WaveScheduler(object):
+    """
+    Deploy hosts wave by wave, stopping as soon as the failure ratio of a
+    wave is above max_failure_ratio.
+
+    Basic usage:
+
+        scheduler = WaveScheduler(env.hosts, wave_size="25%",
+                                  max_concurrency=10, pause=30)
+        scheduler.run(lambda hosts: execute(deploy_host, "default", "1.2.3",
+                                            hosts=hosts))
+
+    `gate` is an optional function called between waves, which stops the
+    deployment when it returns False.
+    """
+    def __init__(self, hosts, wave_size=None, max_concurrency=None,
+                 pause=0, gate=None, max_failure_ratio=0):
+        self.waves = split_waves(hosts, wave_size)
+        self.max_concurrency = max_concurrency
+        self.pause = pause
+        self.gate = gate
+        self.max_failure_ratio = max_failure_ratio
+
+    @classmethod
+    def from_config(cls, hosts, config, gate=None):
+        """
+        Build a scheduler from the "rollout" section of the config file.
+        """
+        return cls(hosts,
+                   wave_size=config.get("wave_size"),
+                   max_concurrency=config.get("max_concurrency"),
+                   pause=config.get("pause", 0),
+                   gate=gate,
+                   max_failure_ratio=config.get("max_failure_ratio", 0))
+
+    def run(self, deploy_wave):
+        """
+        Call deploy_wave with the hosts of each wave, at most max_concurrency
+        of them in parallel, and return the results of all the hosts.
+        deploy_wave must return the result by host, like `execute`.
+        When the deployment stops early, the results of the hosts deployed
+        so far are the "results" of the error raised by abort.
+        """
+        results = {}
+        try:
+            for number, hosts in enumerate(self.waves, 1):
+                if number > 1:
+                    if self.pause:
+                        time.sleep(self.pause)
+                    if self.gate is not None and not self.gate():
+                        abort("Gate closed before wave %s/%s" % (
+                                                    number, len(self.waves)))
+
+                started = time.time()
+                with settings(warn_only=True, pool_size=self.max_concurrency):
+                    wave_results = deploy_wave(hosts)
+                results.update(wave_results)
+
+                failed = sorted(host for host, result in wave_results.items()
+                                if has_failed(result))
+                print "wave %s/%s: %s hosts, %s failed in %.1fs" % (
+                    number, len(self.waves), len(hosts), len(failed),
+                    time.time() - started)
+                if float(len(failed)) / len(hosts) > self.max_failure_ratio:
+                    abort("Too many failures in wave %s/%s: %s" % (
+                                number, len(self.waves), ", ".join(failed)))
+        except SystemExit, e:
+            e.results = results
+            raise
+        return results
@@ -1,4 +1,12 @@
-from fabric.api import settings, sudo
+import os
+import json
+import time
+import hashlib
+import urllib2
+
+from fabric.api import settings, sudo, hide, put, env, abort
+
+from progress import ProgressStream
 
 
 def target_host(host):
@@ -26,10 +34,38 @@ class StackUpdater(object):
         for host in hosts_list:
             with settings(host_string=host):
                 updater.run()
+
+    Or without holding the session during the update:
+
+        jobs = {}
+        for host in hosts_list:
+            with settings(host_string=host):
+                jobs[host] = updater.start()
+        for host in hosts_list:
+            with settings(host_string=host):
+                print updater.wait(jobs[host])["status"]
+
+    With agent, the port of the agent of the hosts (see update_stack
+    --agent) or its host:port, and agent_token, the updates are requested
+    to the agent instead of running the script through sudo. The agent
+    uses the timings file, the package cache and the retained packages of
+    the updater which started it, whatever this updater is given.
     """
+    # the options naming files the agent writes, which it does not accept
+    agent_fixed_options = ('--timings', '--lookup-cache', '--cache-dir',
+                           '--retain-dir')
+    # where the agents write the timing events of all their updates
+    agent_timings = "/var/cache/mise-a-feu/agent-timings.jsonl"
+
     def __init__(self, domain, stack, buildhost,
                  manifest=None, updater_path=None, webcallback=None,
-                 force_update=False, verbose=False):
+                 force_update=False, verbose=False, jobs=None,
+                 batch=False, download_jobs=None, cache_dir=None,
+                 cache_max_bytes=None, cache_max_entries=None,
+                 strategy=None, peers=None,
+                 plan=None, timings=None, lookup_cache=True, lookup_ttl=None,
+                 retain_dir=None, deltas=False, connect_timeout=None,
+                 read_timeout=None, agent=None, agent_token=None):
         self.domain = domain
         self.stack = stack
         self.buildhost = buildhost
@@ -38,15 +74,317 @@ class StackUpdater(object):
         self.webcallback = webcallback
         self.force_update = force_update
         self.verbose = verbose
+        self.jobs = jobs
+        self.batch = batch
+        self.download_jobs = download_jobs
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_max_entries = cache_max_entries
+        self.strategy = strategy
+        self.peers = peers
+        self.plan = plan
+        self.timings = timings
+        self.lookup_cache = lookup_cache
+        self.lookup_ttl = lookup_ttl
+        self.retain_dir = retain_dir
+        self.deltas = deltas
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.agent = agent
+        self.agent_token = agent_token
+        self.job_id = None
+
+    def command(self, *extra_options):
+        """
+        Build the command line of the update script.
+        """
+        options = list(extra_options)
+        if self.verbose:
+            options.append('--verbose')
+        if self.force_update:
+            options.append('--force')
+        if self.webcallback:
+            options.append('--web-callback %s' % self.webcallback)
+        if self.batch:
+            options.append('--batch')
+        if self.jobs:
+            options.append('--jobs %s' % self.jobs)
+        if self.download_jobs:
+            options.append('--download-jobs %s' % self.download_jobs)
+        if self.strategy:
+            options.append('--strategy %s' % self.strategy)
+        if self.peers:
+            options.append('--peers %s' % ','.join(self.peers))
+        if self.plan:
+            options.append('--plan %s' % self.plan)
+        if self.timings:
+            options.append('--timings %s' % self.timings)
+        if not self.lookup_cache:
+            options.append('--no-lookup-cache')
+        if self.lookup_ttl:
+            options.append('--lookup-ttl %s' % self.lookup_ttl)
+        if self.retain_dir:
+            options.append('--retain-dir %s' % self.retain_dir)
+        if self.deltas:
+            options.append('--deltas')
+        if self.connect_timeout:
+            options.append('--connect-timeout %s' % self.connect_timeout)
+        if self.read_timeout:
+            options.append('--read-timeout %s' % self.read_timeout)
+        if self.cache_dir:
+            options.append('--cache-dir %s' % self.cache_dir)
+        if self.cache_max_bytes:
+            options.append('--cache-max-bytes %s' % self.cache_max_bytes)
+        if self.cache_max_entries:
+            options.append('--cache-max-entries %s' % self.cache_max_entries)
+        return ' '.join(map(str, [self.updater_path] + options +
+                                 [self.manifest, self.buildhost,
+                                  self.domain, self.stack]))
+
+    def run(self, progress=None):
+        """
+        Run the update on the host. progress is called with each batch of
+        progress events, as a list, while the update goes on.
+        """
+        if self.agent:
+            return self.request_agent()
+        if progress is None:
+            return sudo(self.command())
+        return sudo(self.command('--progress'),
+                    stdout=ProgressStream(progress))
+
+    def prefetch(self):
+        """
+        Only download and stage the packages to install on the host.
+        """
+        if self.agent:
+            return self.request_agent('--prefetch')
+        return sudo(self.command('--prefetch'))
+
+    def install_staged(self):
+        """
+        Install the packages staged by `prefetch`, without network access.
+        """
+        if self.agent:
+            return self.request_agent('--staged')
+        return sudo(self.command('--staged'))
+
+    def rollback(self):
+        """
+        Reinstall the packages replaced by the last update on the host,
+        from the ones it retained, without network access.
+        """
+        if self.agent:
+            return self.request_agent('--rollback')
+        return sudo(self.command('--rollback'))
+
+    def dry_run(self):
+        """
+        Return the changes the update would make on the host, as reported
+        by update_stack --plan-only, without applying them.
+        """
+        if self.agent:
+            answer = self.request_agent('--plan-only')
+            if answer["status"] != "succeeded":
+                abort("planning the update of %s failed: %s" % (
+                                        env.host_string, answer["error"]))
+            return answer["output"]
+        with hide('running', 'stdout'):
+            output = sudo(self.command('--plan-only'))
+        return json.loads(output.strip().splitlines()[-1])
+
+    def request_agent(self, *extra_options):
+        """
+        Run the update script through the agent of the host and return its
+        answer, with the "status", "output" and "duration" of the update,
+        or the "status" and "error" of its failure. The request gives up
+        after the command_timeout of fabric.
+        """
+        arguments = self._agent_arguments(*extra_options)
+        request = urllib2.Request(self.agent_url("/update"),
+                                  json.dumps({"arguments": arguments}),
+                                  self._agent_headers())
+        try:
+            response = urllib2.urlopen(request, timeout=env.command_timeout)
+            return json.loads(response.read())
+        except urllib2.HTTPError, e:
+            body = e.read()
+            try:
+                answer = json.loads(body)
+            except ValueError:
+                answer = {"error": body}
+            answer.setdefault("status", "failed")
+            answer["error"] = "agent answered %s: %s" % (e.code,
+                                                         answer.get("error"))
+            return answer
+        except urllib2.URLError, e:
+            abort("agent of %s unreachable: %s" % (env.host_string, e))
+
+    def agent_status(self):
+        """
+        Return the status of the agent of the host.
+        """
+        request = urllib2.Request(self.agent_url("/status"),
+                                  headers=self._agent_headers())
+        return json.loads(urllib2.urlopen(request).read())
+
+    def agent_url(self, path):
+        agent = str(self.agent)
+        if ":" not in agent:
+            agent = "%s:%s" % (env.host_string.split("@")[-1].split(":")[0],
+                               agent)
+        return "http://%s%s" % (agent, path)
+
+    def _agent_arguments(self, *extra_options):
+        # the agent keeps its own files, see update_stack AGENT_FIXED_OPTIONS
+        arguments = []
+        words = self.command(*extra_options).split()[1:]
+        while words:
+            word = words.pop(0)
+            if word in self.agent_fixed_options:
+                words.pop(0)
+            else:
+                arguments.append(word)
+        return arguments
+
+    def _agent_headers(self):
+        if not self.agent_token:
+            abort("agent_token is required to reach the agent of %s" %
+                                                            env.host_string)
+        return {"Content-Type": "application/json",
+                "Authorization": "Bearer %s" % self.agent_token}
+
+    def start_agent(self, port, token_file, bind=None,
+                    job_file="/root/tools/agent.job"):
+        """
+        Start the agent of the host in the background, and return the id of
+        its job, which is also kept in job_file for `stop_agent`. The agent
+        writes its timing events into agent_timings, and uses the package
+        cache, the lookup cache and the retained packages of this updater.
+        """
+        options = ['--detach', '--agent %s' % port,
+                   '--agent-token-file %s' % token_file,
+                   '--timings %s' % self.agent_timings]
+        if bind:
+            options.append('--agent-bind %s' % bind)
+        if self.verbose:
+            options.append('--verbose')
+        if not self.lookup_cache:
+            options.append('--no-lookup-cache')
+        if self.cache_dir:
+            options.append('--cache-dir %s' % self.cache_dir)
+        if self.retain_dir:
+            options.append('--retain-dir %s' % self.retain_dir)
+        output = sudo('%s %s' % (self.updater_path, ' '.join(options)))
+        job_id = output.strip().splitlines()[-1]
+        sudo('echo %s > %s' % (job_id, job_file))
+        return job_id
+
+    def stop_agent(self, job_file="/root/tools/agent.job"):
+        """
+        Terminate the agent started by `start_agent`, and return the last
+        status of its job, "unknown" if none was started.
+        """
+        with settings(hide('running', 'stdout'), warn_only=True):
+            output = sudo('cat %s' % job_file)
+        if output.failed or not output.strip():
+            return {"status": "unknown"}
+        status = self.stop(output.strip())
+        sudo('rm -f %s' % job_file)
+        return status
+
+    def collect_timings(self, timings=None):
+        """
+        Return the timing events written by the update script on the host,
+        and remove them.
+        """
+        timings = timings or self.timings
+        with settings(hide('running', 'stdout'), warn_only=True):
+            output = sudo('cat %s && rm -f %s' % (timings, timings))
+        if output.failed:
+            return []
+        return [json.loads(line) for line in output.splitlines()
+                if line.strip()]
+
+    def upload(self, script):
+        """
+        Upload the update script to the host, unless the remote one is
+        already identical, and return whether it was uploaded.
+        """
+        with open(script) as local_script:
+            checksum = hashlib.sha256(local_script.read()).hexdigest()
+        with settings(hide('running', 'stdout'), warn_only=True):
+            output = sudo('sha256sum %s' % self.updater_path)
+        if not output.failed and output.split()[:1] == [checksum]:
+            return False
+        put(script, self.updater_path, mirror_local_mode=False, use_sudo=True)
+        sudo('chown root:root %s && chmod 770 %s' % (self.updater_path,
+                                                     self.updater_path))
+        return True
+
+    def push_plan(self, plan_file, remote_folder="/tmp"):
+        """
+        Upload a plan written by update_stack --write-plan to the host, so
+        the next runs install its versions without resolving the stack.
+        """
+        self.plan = os.path.join(remote_folder, os.path.basename(plan_file))
+        put(plan_file, self.plan, use_sudo=True)
+        return self.plan
+
+    def start(self):
+        """
+        Start the update script in the background on the host and return
+        the id of the job, to follow with `poll` or `wait`.
+        """
+        output = sudo(self.command('--detach'))
+        self.job_id = output.strip().splitlines()[-1]
+        return self.job_id
+
+    def poll(self, job_id=None):
+        """
+        Return the status of the job on the host, as a dict whose "status"
+        is either "running", "succeeded", "failed" or "unknown".
+        """
+        with hide('running', 'stdout'):
+            output = sudo('%s --status %s' % (self.updater_path,
+                                              job_id or self.job_id))
+        return json.loads(output.strip().splitlines()[-1])
+
+    def wait(self, job_id=None, interval=5, timeout=None):
+        """
+        Poll the job until it is over and return its last status, still
+        "running" if the timeout expired first.
+        """
+        started = time.time()
+        while True:
+            status = self.poll(job_id)
+            if status["status"] != "running":
+                return status
+            if timeout is not None and time.time() - started >= timeout:
+                return status
+            time.sleep(interval)
+
+    def serve(self, port, duration=None, bind=None):
+        """
+        Start serving the packages downloaded on the host to its peers, in
+        the background, and return the id of the job to `stop`. The packages
+        are served on all the addresses of the host unless bind is given.
+        """
+        options = ['--detach', '--serve %s' % port]
+        if duration:
+            options.append('--serve-for %s' % duration)
+        if bind:
+            options.append('--serve-bind %s' % bind)
+        if self.cache_dir:
+            options.append('--cache-dir %s' % self.cache_dir)
+        output = sudo('%s %s' % (self.updater_path, ' '.join(options)))
+        return output.strip().splitlines()[-1]
 
-    def run(self):
-        command = '%s %s%s%s%s %s %s %s' % (self.updater_path,
-            '' if not self.verbose else '--verbose ',
-            '' if not self.force_update else '--force ',
-            '' if not self.webcallback \
-                                else '--web-callback %s ' % self.webcallback,
-            self.manifest,
-            self.buildhost,
-            self.domain,
-            self.stack)
-        return sudo(command)
+    def stop(self, job_id=None):
+        """
+        Terminate a detached job on the host.
+        """
+        with hide('running', 'stdout'):
+            output = sudo('%s --stop %s' % (self.updater_path,
+                                            job_id or self.job_id))
+        return json.loads(output.strip().splitlines()[-1])
@@ -0,0 +1,51 @@
+import math
+
+
+def percentile(values, ratio):
+    """
+    Nearest-rank percentile of the values, ratio being between 0 and 1.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(ratio * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def summarize_timings(events):
+    """
+    Aggregate the timing events written by update_stack --timings, from any
+    number of hosts, into {phase: {"count", "p50", "p95", "max", "bytes"}}.
+    The events without duration are ignored.
+    """
+    durations = {}
+    transferred = {}
+    for event in events:
+        if "duration" not in event:
+            continue
+        durations.setdefault(event["phase"], []).append(event["duration"])
+        transferred[event["phase"]] = (transferred.get(event["phase"], 0) +
+                                       (event.get("bytes") or 0))
+    return dict((phase, {"count": len(values),
+                         "p50": percentile(values, 0.5),
+                         "p95": percentile(values, 0.95),
+                         "max": max(values),
+                         "bytes": transferred[phase]})
+                for phase, values in durations.items())
+
+
+def format_timings(summary):
+    """
+    Render the summary of `summarize_timings` as a table, one phase by line.
+    """
+    lines = ["%-16s %6s %9s %9s %9s %12s" % ("phase", "count", "p50", "p95",
+                                              "max", "bytes")]
+    for phase in sorted(summary):
+        lines.append("%-16s %6d %8.2fs %8.2fs %8.2fs %12d" % (
+            phase,
+            summary[phase]["count"],
+            summary[phase]["p50"],
+            summary[phase]["p95"],
+            summary[phase]["max"],
+            summary[phase]["bytes"]))
+    return "\n".join(lines)
@@ -1,8 +1,14 @@
 import datetime
 import os
+import time
+import socket
+import sqlite3
 import yaml
 
-from fabric.api import abort, local, env
+from fabric.api import abort, local, env, warn
+from fabric.exceptions import CommandTimeout
+
+from history import DeploymentHistory, host_records
 
 
 def str2bool(answer):
@@ -26,11 +32,17 @@ def get_config(config_file):
     except IOError:
         abort("Please specify a config file ie. 'fab -c examples/foo.yml'")
 
-def run_notifications(notifications, stack):
+def run_notifications(notifications, stack, notifier=None):
+    """
+    Send the notifications, in the background if a notifier is given.
+    """
     for noti in notifications:
         message = noti["message"] % {"stack": stack}
-        command = noti["command"] % {"message": message}
-        local(command)
+        if notifier is not None:
+            notifier.notify(noti["command"], message)
+        else:
+            command = noti["command"] % {"message": message}
+            local(command)
 
 def log_deployment(stack, use_utc=False):
     strf_format = "%Y-%m-%d %H:%M:%S" if "strf_format" not in env else env.strf_format
@@ -39,3 +51,60 @@ def log_deployment(stack, use_utc=False):
     line = "%s %s %s\n" % (timestamp.strftime(strf_format), deployment_env, stack)
     with open(os.path.expanduser(env.deployment_history), "a") as history_log:
         history_log.write(line)
+
+def parse_time(value):
+    """
+    Convert a "YYYY-MM-DD[ HH:MM:SS]" local time into a timestamp.
+    """
+    for strf_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, strf_format))
+        except ValueError:
+            pass
+    abort("Invalid time, expected YYYY-MM-DD[ HH:MM:SS]: %s" % value)
+
+def host_outcome(result):
+    """
+    Outcome and error of the update of a host from its result: the status
+    of a detached job, the error raised or the output of the command.
+    A job still running or a command timing out is a "timeout", and a
+    task without result, like a parallel one which aborted, failed.
+    """
+    if result is None:
+        return "failed", "no result"
+    if isinstance(result, dict):
+        if result["status"] == "running":
+            return "timeout", "job %s still running" % result.get("job")
+        return result["status"], result.get("error")
+    if isinstance(result, (CommandTimeout, socket.timeout)):
+        return "timeout", str(result) or "timed out"
+    if isinstance(result, BaseException):
+        return "failed", str(result) or result.__class__.__name__
+    if getattr(result, "failed", False):
+        return "failed", "exit code %s" % getattr(result, "return_code", None)
+    return "succeeded", None
+
+def record_deployment(stack, started, outcome, results, timings):
+    """
+    Record the deployment into the history database, with the result of
+    each host and its timing events. A database error is only warned
+    about, since the deployment may be failing for another reason.
+    """
+    deployment_env = env.rcfile.split("/")[-1]
+    try:
+        history = DeploymentHistory(env.get("history_db",
+                                            "~/.mise-a-feu/history.db"))
+    except (sqlite3.Error, OSError), e:
+        warn("Could not record the deployment: %s" % e)
+        return None
+    try:
+        return history.record(deployment_env, stack, started, time.time(),
+                              outcome,
+                              host_records(dict((host, host_outcome(result))
+                                                for host, result
+                                                in results.items()),
+                                           timings))
+    except sqlite3.Error, e:
+        warn("Could not record the deployment: %s" % e)
+    finally:
+        history.close()
@@ -1,15 +1,50 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import errno
+import fcntl
+import base64
+import signal
+import shutil
+import hashlib
+import hmac
+import itertools
+import struct
 import argparse
+import contextlib
 import subprocess
-import urllib2
+import threading
+import time
+import socket
+import httplib
+import urlparse
 import urllib
+import urllib2
 import json
+import random
+import Queue
+import BaseHTTPServer
+import SocketServer
 
 
 base_folder = "/tmp"
+dpkg_status_file = "/var/lib/dpkg/status"
+local_versions_cache = {}
 is_verbose = False
+package_cache = None
+lookup_cache = None
+package_peers = []
+delta_base_folder = None
+timing_file = None
+timing_lock = threading.Lock()
+progress_reporter = None
+
+# size of the blocks read from the network and from the files
+BUFFER_SIZE = 64 * 1024
+
+# prefix of the lines of progress events on the standard output
+PROGRESS_MARKER = "MISE-A-FEU-PROGRESS "
 
 __version__ = "0.0.1"
 
@@ -22,39 +57,688 @@ def get_version():
 
 
 def main(manifest_file, buildhost, domain=None,
-         verbose=False, force_install=False, stack=None, webcallback=None):
+         verbose=False, force_install=False, stack=None, webcallback=None,
+         jobs=4, batch=False, download_jobs=2, cache_dir=None,
+         cache_max_bytes=2 * 1024 ** 3, cache_max_entries=500,
+         prefetch=False, staged=False, strategy="remove-install", peers=None,
+         plan_file=None, plan_only=False, timings=None, lookup_cache_file=None,
+         lookup_ttl=60, progress=False, progress_url=None, retain_dir=None,
+         rollback=False, deltas=False, connect_timeout=None,
+         read_timeout=None):
     """
     Main logic to update only packages that are installed.
+    With prefetch, the packages are only downloaded and staged for a later
+    run with staged, which installs them without any network access.
+    The "remove-install" strategy removes all the packages to update before
+    installing them, "upgrade" installs them over the old ones and removes
+    the packages the stack lists without a version. Only a rollback removes
+    packages with both strategies, the ones installed by the last update.
+    The packages are downloaded from the peers, "host:port" serving them,
+    before falling back on the build server. With a plan file, written by
+    `write_plan`, the versions are not requested to the build server.
+    With plan_only, nothing is changed and the report of `plan_changes` is
+    returned instead.
+    The duration of each phase, and the versions of the packages to update,
+    are written as json lines into the timings file, or on the standard
+    output with "-".
+    The answers of the build server are kept in the lookup cache file, see
+    `LookupCache`.
+    With progress, the start and end of each phase are streamed in batches
+    on the standard output, or posted to progress_url, see
+    `ProgressReporter`.
+    The installed package files are kept in retain_dir, along with the
+    versions they replaced, which rollback reinstalls without any network
+    access. An update whose dpkg -i fails raises without retaining them. With deltas, the retained package of the installed version is
+    the base of a delta download, see `download_delta`.
+    The requests to the build server and to the peers give up after
+    connect_timeout seconds to connect, and read_timeout seconds without
+    data.
     """
-    global is_verbose
+    global is_verbose, package_cache, package_peers, timing_file, \
+           lookup_cache, progress_reporter, delta_base_folder
     is_verbose = verbose
+    delta_base_folder = retain_dir if deltas else None
+    http_pool.timeout = connect_timeout
+    http_pool.read_timeout = read_timeout
+    progress_reporter = ProgressReporter(url=progress_url) \
+                                    if progress or progress_url else None
+    timing_file = timings
+    package_peers = list(peers or [])
+    # the caches of a previous run of the same process, like the agent, are
+    # kept warm
+    if not cache_dir:
+        package_cache = None
+    elif package_cache is None or package_cache.folder != cache_dir:
+        package_cache = PackageCache(cache_dir)
+    if package_cache is not None:
+        package_cache.max_bytes = cache_max_bytes
+        package_cache.max_entries = cache_max_entries
+    if not lookup_cache_file:
+        lookup_cache = None
+    elif lookup_cache is None or lookup_cache.file_name != lookup_cache_file:
+        lookup_cache = LookupCache(lookup_cache_file)
+    if lookup_cache is not None:
+        lookup_cache.ttl = lookup_ttl
+
+    plan = read_plan(plan_file, domain, stack) if plan_file else None
+    if plan_only:
+        return plan_changes(manifest_file, buildhost, domain,
+                            force_install=force_install, stack=stack,
+                            jobs=jobs, batch=batch, plan=plan)
+
+    # a deployment retrying the host must not run along an update which
+    # outlived its timeout
+    with update_lock():
+        started = time.time()
+        if rollback:
+            if not retain_dir:
+                raise Exception("no retained packages to roll back to")
+            packages = get_rollback_packages(retain_dir)
+        elif staged:
+            packages = get_staged_packages(domain, stack,
+                                           force_install=force_install)
+        else:
+            with timed("fetch"):
+                packages = fetch_packages(manifest_file, buildhost, domain,
+                                          force_install=force_install,
+                                          stack=stack, jobs=jobs, batch=batch,
+                                          download_jobs=download_jobs,
+                                          plan=plan)
+
+        packages_to_install = dict((package, remote_package["file"])
+                                   for package, remote_package
+                                   in packages.items()
+                                   if remote_package.get("file"))
+        packages_to_remove = [package for package, remote_package
+                              in packages.items()
+                              if not remote_package.get("file")]
+
+        if prefetch:
+            stage_packages(domain, stack, packages)
+            report_progress("done", packages=len(packages))
+            return packages_to_install
+
+        if strategy != "upgrade" and not rollback:
+            # the packages no longer in the stack stay installed
+            packages = dict((package, remote_package)
+                            for package, remote_package in packages.items()
+                            if remote_package.get("file"))
+            packages_to_remove = []
+
+        if len(packages) > 0:
+            if retain_dir:
+                previous_packages = retain_previous_packages(retain_dir,
+                                                             packages)
+            exit_code = 0
+            with timed("downtime", strategy=strategy,
+                       packages=len(packages)) as event:
+                if strategy == "upgrade":
+                    if packages_to_remove:
+                        remove_packages(packages_to_remove)
+                else:
+                    remove_packages(list(packages_to_install) +
+                                    packages_to_remove)
+                if packages_to_install:
+                    exit_code = install_packages(packages_to_install)
+            log("downtime window with the %s strategy: %.2fs" % (
+                                                strategy, event["duration"]))
+            if exit_code:
+                raise Exception("installing the packages failed with exit "
+                                "code %s, they are not retained" % exit_code)
+            elif retain_dir:
+                retain_packages(retain_dir, packages, previous_packages)
+        if rollback:
+            log("rolled back %d packages in %.2fs" % (len(packages),
+                                                      time.time() - started))
+
+        report_progress("done", packages=len(packages))
+        # a rollback is not a deployment of the stack
+        if webcallback and not rollback:
+            send_web_callback(webcallback, packages_to_install.keys())
+
+        return packages_to_install
+
+
+@contextlib.contextmanager
+def update_lock():
+    """
+    Hold the lock of the updates of the host, raising if another update
+    already holds it.
+    """
+    with open(os.path.join(base_folder, "mise-a-feu-update.lock"),
+              "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise Exception("another update is running on this host")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def fetch_packages(manifest_file, buildhost, domain, force_install=False,
+                   stack=None, jobs=4, batch=False, download_jobs=2, plan=None,
+                   download=True):
+    """
+    Resolve the packages of the manifest whose version differs from the
+    stack and download them, as {package: {"version": ..., "file": ...}}.
+    The packages of a plan are not resolved again, the ones missing from
+    it are.
+    """
+    installed_packages = get_installed_packages(manifest_file)
+    with timed("local_versions"):
+        local_versions = get_local_versions()
+    remote_packages = {}
+    if plan is not None:
+        remote_packages = dict((package, plan["packages"][package])
+                               for package in installed_packages
+                               if package in plan["packages"])
+        for package in installed_packages:
+            if package not in remote_packages:
+                log("%s is missing from the plan, resolving it" % package,
+                    log_level="WARNING")
+    elif batch:
+        with timed("batch_lookup", packages=len(installed_packages)):
+            remote_packages = get_remote_packages_for(buildhost,
+                                                      installed_packages,
+                                                      domain,
+                                                      stack=stack) or {}
+
+    downloader = Downloader(buildhost, jobs=download_jobs)
+    delta_bases = get_delta_bases(local_versions) if download else {}
+
+    def _resolve(package):
+        if local_versions is not None:
+            installed_version = local_versions.get(package, "")
+        else:
+            installed_version = get_local_version_for(package)
+        if package not in remote_packages:
+            with timed("lookup", package=package):
+                remote_package = resolve_package(buildhost, package,
+                                                 installed_version, domain,
+                                                 stack=stack,
+                                                 force_install=force_install)
+        elif (force_install or
+                installed_version != remote_packages[package]["version"]):
+            remote_package = remote_packages[package]
+        else:
+            remote_package = None
+        if remote_package:
+            report_progress("resolved", package=package,
+                            installed=installed_version,
+                            version=remote_package["version"])
+            write_timing_event({"phase": "resolved",
+                                "package": package,
+                                "installed": installed_version,
+                                "version": remote_package["version"],
+                                "time": time.time()})
+        if download and remote_package and remote_package.get("file"):
+            # start the transfer while the other packages are resolved
+            downloader.add(remote_package["file"],
+                           sha256=remote_package.get("sha256"),
+                           base=delta_bases.get(package))
+        return remote_package
 
-    packages_to_install = {}
+    try:
+        resolved = _map_in_threads(_resolve, installed_packages, jobs)
+    except Exception:
+        downloader.join(cancel=True)
+        raise
+    finally:
+        if lookup_cache is not None:
+            lookup_cache.save()
+    downloader.join()
+
+    return dict((package, remote_package)
+                for package, remote_package in zip(installed_packages, resolved)
+                if remote_package)
+
+
+def plan_changes(manifest_file, buildhost, domain, force_install=False,
+                 stack=None, jobs=4, batch=False, plan=None):
+    """
+    Report the changes an update would make, without downloading nor
+    installing anything. The download size of each package comes from an
+    HTTP HEAD request, and is 0 if the package is in the cache.
+    """
+    packages = fetch_packages(manifest_file, buildhost, domain,
+                              force_install=force_install, stack=stack,
+                              jobs=jobs, batch=batch, plan=plan,
+                              download=False)
+    local_versions = get_local_versions() or {}
+
+    def _change(package):
+        remote_package = packages[package]
+        change = {"package": package,
+                  "installed": local_versions.get(package, ""),
+                  "version": remote_package["version"],
+                  "file": remote_package.get("file"),
+                  "size": 0,
+                  "cached": False}
+        if not change["file"]:
+            change["action"] = "remove"
+            return change
+        change["action"] = "install"
+        if package_cache is not None and \
+                                    change["file"] in package_cache.entries:
+            change["cached"] = True
+        else:
+            change["size"] = get_package_size(buildhost, change["file"])
+        return change
+
+    changes = _map_in_threads(_change, sorted(packages), jobs)
+    return {"host": socket.getfqdn(),
+            "domain": domain,
+            "stack": stack if stack else "latest",
+            "changes": changes,
+            "download_bytes": sum(change["size"] for change in changes)}
+
+
+def resolve_stack(buildhost, packages, domain, stack=None, jobs=4,
+                  batch=False):
+    """
+    Resolve version and file name of all the packages in the stack, as
+    {package: {"version": ..., "file": ...}}, whatever their local version.
+    The packages no longer in the stack have neither version nor file.
+    """
+    remote_packages = {}
+    if batch:
+        remote_packages = get_remote_packages_for(buildhost,
+                                                  packages,
+                                                  domain,
+                                                  stack=stack) or {}
+    missing = [package for package in packages
+               if package not in remote_packages]
+    resolved = _map_in_threads(lambda package: resolve_package(buildhost,
+                                                               package,
+                                                               None,
+                                                               domain,
+                                                               stack=stack),
+                               missing, jobs)
+    for package, remote_package in zip(missing, resolved):
+        remote_packages[package] = remote_package or {"version": "",
+                                                      "file": None}
+    return remote_packages
+
+
+def write_plan(plan_file, buildhost, packages, domain, stack=None, jobs=4,
+               batch=False):
+    """
+    Resolve the stack for the packages and save it as a plan for the hosts.
+    """
+    plan = {"domain": domain,
+            "stack": stack if stack else "latest",
+            "packages": resolve_stack(buildhost, packages, domain,
+                                      stack=stack, jobs=jobs, batch=batch)}
+    log("writing plan of %d packages into %s" % (len(packages), plan_file))
+    with open(plan_file + ".tmp", "w") as output:
+        json.dump(plan, output, indent=2, sort_keys=True)
+    os.rename(plan_file + ".tmp", plan_file)
+    return plan
+
+
+def read_plan(plan_file, domain, stack=None):
+    """
+    Read a plan written by `write_plan`, which must be the one of the domain
+    and stack to install.
+    """
+    log("reading plan from: %s" % plan_file)
+    with open(plan_file) as plan_input:
+        plan = json.load(plan_input)
+    stack = stack if stack else "latest"
+    if (plan.get("domain"), plan.get("stack")) != (domain, stack):
+        raise Exception("plan %s is for stack %s of domain %s, not %s of %s" %
+                        (plan_file, plan.get("stack"), plan.get("domain"),
+                         stack, domain))
+    return plan
 
-    installed_packages = get_installed_packages(manifest_file)
 
-    for package in installed_packages:
-        installed_version = get_local_version_for(package)
-        future_version = get_remote_version_for(buildhost,
-                                                package,
-                                                domain,
-                                                stack=stack)
+def stage_packages(domain, stack, packages):
+    """
+    Record the downloaded packages for the install phase.
+    """
+    staged_file_name = _staged_file_name(domain, stack)
+    log("staging %d packages into %s" % (len(packages), staged_file_name))
+    with open(staged_file_name + ".tmp", "w") as staged_file:
+        json.dump(packages, staged_file)
+    os.rename(staged_file_name + ".tmp", staged_file_name)
+
+
+def get_staged_packages(domain, stack, force_install=False):
+    """
+    Retrieve the packages staged by the prefetch phase whose version is
+    still not the installed one. Nothing is requested to the build server.
+    """
+    staged_file_name = _staged_file_name(domain, stack)
+    log("reading staged packages from: %s" % staged_file_name)
+    try:
+        with open(staged_file_name) as staged_file:
+            staged = json.load(staged_file)
+    except IOError:
+        raise Exception("no package staged for stack %s, run the prefetch "
+                        "phase first" % stack)
+
+    local_versions = get_local_versions()
+    packages = {}
+    for package, remote_package in staged.items():
+        if local_versions is not None:
+            installed_version = local_versions.get(package, "")
+        else:
+            installed_version = get_local_version_for(package)
+        if not force_install and installed_version == remote_package["version"]:
+            continue
+        staged_package = os.path.join(base_folder, remote_package["file"]) \
+                                            if remote_package["file"] else None
+        if staged_package and not os.path.exists(staged_package):
+            raise Exception("staged package %s is missing, run the prefetch "
+                            "phase again" % remote_package["file"])
+        packages[package] = remote_package
+    return packages
+
+
+def retain_previous_packages(retain_dir, packages):
+    """
+    Record the versions installed before updating the packages, with their
+    package file if it was retained when they were installed, for a later
+    rollback. A package not installed before has no version.
+    """
+    if not os.path.isdir(retain_dir):
+        os.makedirs(retain_dir)
+    retained = _read_json(os.path.join(retain_dir, "index.json"), {})
+    local_versions = get_local_versions()
+    previous_packages = {}
+    for package in packages:
+        if local_versions is not None:
+            installed_version = local_versions.get(package, "")
+        else:
+            installed_version = get_local_version_for(package)
+        entry = retained.get(package)
+        previous_packages[package] = {
+            "version": installed_version,
+            "file": entry["file"] if entry and
+                                     entry["version"] == installed_version
+                                  else None}
+    log("recording the %d previous packages into %s" % (
+                                        len(previous_packages), retain_dir))
+    _write_json(os.path.join(retain_dir, "rollback.json"),
+                {"created": time.time(), "packages": previous_packages})
+    return previous_packages
+
+
+def retain_packages(retain_dir, packages, previous_packages):
+    """
+    Keep the files of the packages just installed for a later rollback, and
+    drop the retained files needed neither by the installed packages nor by
+    the rollback.
+    """
+    index_file_name = os.path.join(retain_dir, "index.json")
+    retained = _read_json(index_file_name, {})
+    for package, remote_package in packages.items():
+        if remote_package.get("file"):
+            _link_or_copy(os.path.join(base_folder, remote_package["file"]),
+                          os.path.join(retain_dir, remote_package["file"]))
+            retained[package] = {"version": remote_package["version"],
+                                 "file": remote_package["file"]}
+        else:
+            retained.pop(package, None)
+    _write_json(index_file_name, retained)
+
+    needed = set(entry["file"] for entry in retained.values())
+    needed.update(previous["file"] for previous in previous_packages.values()
+                  if previous["file"])
+    for file_name in os.listdir(retain_dir):
+        if file_name.endswith(".deb") and file_name not in needed:
+            log("dropping retained %s" % file_name, log_level="DEBUG")
+            os.unlink(os.path.join(retain_dir, file_name))
+
+
+def get_rollback_packages(retain_dir):
+    """
+    Retrieve the packages recorded before the last update, and put their
+    retained files back in place. Nothing is requested to the build server.
+    """
+    rollback_file_name = os.path.join(retain_dir, "rollback.json")
+    log("reading previous packages from: %s" % rollback_file_name)
+    record = _read_json(rollback_file_name, None)
+    if record is None:
+        raise Exception("no previous packages recorded in %s" % retain_dir)
+
+    packages = record["packages"]
+    for package, previous in sorted(packages.items()):
+        if previous["version"] and not previous["file"]:
+            raise Exception("%s %s was not retained, it cannot be rolled "
+                            "back offline" % (package, previous["version"]))
+        if previous["file"] and not os.path.exists(
+                            os.path.join(retain_dir, previous["file"])):
+            raise Exception("retained package %s is missing" %
+                                                            previous["file"])
+    for previous in packages.values():
+        if previous["file"]:
+            _link_or_copy(os.path.join(retain_dir, previous["file"]),
+                          os.path.join(base_folder, previous["file"]))
+    return packages
+
+
+def start_job(arguments):
+    """
+    Run the script with the given arguments in a background process
+    detached from the session, and return the id of the job.
+    """
+    job_id = "%s-%s" % (int(time.time()), os.getpid())
+    command = [sys.executable, os.path.abspath(__file__)] + list(arguments) \
+                                                        + ["--job-id", job_id]
+    write_job_status(job_id, status="running", started=time.time())
+    with open(os.devnull) as devnull:
+        with open(_job_file_name(job_id, "log"), "w") as output:
+            process = subprocess.Popen(command,
+                                       stdin=devnull,
+                                       stdout=output,
+                                       stderr=subprocess.STDOUT,
+                                       close_fds=True,
+                                       preexec_fn=os.setsid)
+    # the job records its own pid, this one covers a job dying before that
+    with open(_job_file_name(job_id, "pid"), "w") as pid_file:
+        pid_file.write(str(process.pid))
+    return job_id
+
+
+def run_job(job_id, **kwargs):
+    """
+    Run main for a detached job, recording its outcome in the status file.
+    """
+    started = time.time()
+    write_job_status(job_id, status="running", started=started,
+                     pid=os.getpid())
+    try:
+        packages = main(**kwargs)
+    except Exception, e:
+        write_job_status(job_id, status="failed", started=started,
+                         ended=time.time(), error=str(e))
+        raise
+    write_job_status(job_id, status="succeeded", started=started,
+                     ended=time.time(), packages=sorted(packages))
+    return packages
+
+
+def write_job_status(job, **status):
+    status["job"] = job
+    status_file_name = _job_file_name(job, "json")
+    with open(status_file_name + ".tmp", "w") as status_file:
+        json.dump(status, status_file)
+    os.rename(status_file_name + ".tmp", status_file_name)
+
+
+def get_job_status(job_id):
+    """
+    Retrieve the status of a detached job: "running", "succeeded", "failed"
+    or "unknown". A running job whose process is gone has failed.
+    """
+    try:
+        with open(_job_file_name(job_id, "json")) as status_file:
+            status = json.load(status_file)
+    except IOError:
+        return {"job": job_id, "status": "unknown"}
+    pid = _job_pid(job_id, status)
+    if status["status"] != "running" or pid is None:
+        return status
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            status.update(status="failed", error="process %s died" % pid)
+    return status
+
+
+def stop_job(job_id):
+    """
+    Terminate a detached job, like a package server started with --serve.
+    """
+    status = get_job_status(job_id)
+    pid = _job_pid(job_id, status)
+    if status["status"] != "running" or pid is None:
+        return status
+    log("stopping job %s (process %s)" % (job_id, pid))
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+    status.update(status="stopped", ended=time.time())
+    write_job_status(**status)
+    return status
+
+
+def send_web_callback(web_callback_url, packages, timeout=10, retries=3,
+                      backoff=1):
+    """
+    Deliver the web callback from a new process detached from the update,
+    so that neither the exit of the script nor the session running it wait
+    for its retries. Its outcome only goes into the timings file. The
+    process is a new interpreter, since a fork of this one could inherit
+    the locks held by its other threads.
+    """
+    log("sending web callback to %s in the background" % web_callback_url)
+    callback = json.dumps({"url": web_callback_url,
+                           "packages": list(packages),
+                           "timeout": timeout,
+                           "retries": retries,
+                           "backoff": backoff,
+                           "timings": timing_file})
+    with open(os.devnull, "r+") as devnull:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                          "--send-web-callback", callback],
+                         stdin=devnull,
+                         stdout=devnull,
+                         stderr=devnull,
+                         close_fds=True)
+
+
+def emit_timing(phase, started, ended=None, **fields):
+    """
+    Write the timing event of a phase as a json line into the timings file,
+    if any.
+    """
+    ended = ended or time.time()
+    write_timing_event(dict(fields, phase=phase, start=started, end=ended,
+                            duration=ended - started))
+
 
-        if force_install or (installed_version != future_version):
-            file_name = get_updated_package_name(buildhost,
-                                                 package,
-                                                 future_version)
-            download_package(buildhost, file_name)
-            packages_to_install[package] = file_name
+def write_timing_event(event):
+    """
+    Write an event as a json line into the timings file, if any.
+    """
+    if timing_file is None:
+        return
+    with timing_lock:
+        if timing_file == "-":
+            sys.stdout.write(json.dumps(event) + "\n")
+            sys.stdout.flush()
+        else:
+            with open(timing_file, "a") as output:
+                output.write(json.dumps(event) + "\n")
+
+
+@contextlib.contextmanager
+def timed(phase, **fields):
+    """
+    Time the block as a phase, whose event gets the fields of the yielded
+    dict, the error raised by the block and its "duration" once over.
+    """
+    started = time.time()
+    report_progress(phase, state="start", **fields)
+    try:
+        yield fields
+    except Exception, e:
+        fields["error"] = str(e)
+        raise
+    finally:
+        fields["duration"] = time.time() - started
+        emit_timing(phase, started, **fields)
+        report_progress(phase, state="end", **fields)
 
-    if len(packages_to_install) > 0:
-        remove_packages(packages_to_install)
-        install_packages(packages_to_install)
 
-    if webcallback:
-        _do_web_callback(webcallback, packages_to_install.keys())
+def report_progress(phase, **fields):
+    """
+    Send a progress event of the phase to the progress reporter, if any.
+    """
+    if progress_reporter is not None:
+        progress_reporter.report(dict(fields, phase=phase, time=time.time()))
 
-    return packages_to_install
+
+class ProgressReporter(object):
+    """
+    Stream the progress events in batches, at most one every interval
+    seconds: a json list written after PROGRESS_MARKER on a line of the
+    standard output, or posted as {"events": [...]} to url.
+    """
+    def __init__(self, url=None, interval=1, output=None):
+        self.url = url
+        self.interval = interval
+        self.output = output or sys.stdout
+        self._events = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def report(self, event):
+        with self._lock:
+            self._events.append(event)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return
+        if self.url:
+            try:
+                _post_to_url(self.url, {"events": events})
+            except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+                log("failed to post progress to %s : %s" % (self.url, e),
+                    log_level="WARNING")
+        else:
+            with timing_lock:
+                self.output.write(PROGRESS_MARKER + json.dumps(events) + "\n")
+                self.output.flush()
+
+    def close(self):
+        """
+        Stop the periodic flushes and send the last events.
+        """
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _work(self):
+        while not self._closed.wait(self.interval):
+            self.flush()
 
 
 def log(message, log_level="INFO"):
@@ -87,110 +771,1500 @@ def get_local_version_for(package):
     return version
 
 
+def get_local_versions(status_file=None):
+    """
+    Retrieve local versions of all the installed packages in one pass, from
+    the dpkg status database. Returns None if the database can not be read,
+    so the caller can fall back on `get_local_version_for`.
+    The database is only parsed again once dpkg replaced it.
+    """
+    status_file = status_file or dpkg_status_file
+    log("reading local versions from: %s" % status_file)
+    try:
+        with open(status_file, 'r') as status:
+            stat = os.fstat(status.fileno())
+            key = (stat.st_ino, stat.st_mtime, stat.st_size)
+            cached = local_versions_cache.get(status_file)
+            if cached is not None and cached[0] == key:
+                versions = cached[1]
+            else:
+                versions = _parse_dpkg_status(status)
+                local_versions_cache[status_file] = (key, versions)
+    except IOError, e:
+        log("failed to read %s : %s" % (status_file, e), log_level="WARNING")
+        return None
+    log("%d installed packages found" % len(versions), log_level="DEBUG")
+    return dict(versions)
+
+
 def get_remote_version_for(buildhost, package, domain, stack=None):
     """
     Retrieve remote version from the build server.
     Latest by default or from specific product stack.
     """
     stack = stack if stack else "latest"
-    url = "http://%s/domains/%s/stacks/%s/packages/%s/version" % \
-                                        (buildhost, domain, stack, package)
+    url = _version_url(buildhost, domain, stack, package)
     log("getting version from: %s" % url, log_level="DEBUG")
-    version = _read_from_url(url)
+    if lookup_cache is not None:
+        version = lookup_cache.read(url, immutable=stack != "latest")
+    else:
+        version = _read_from_url(url)
     log("version of %s for stack %s is %s" % (package, stack, version))
     return version
 
 
+def get_remote_packages_for(buildhost, packages, domain, stack=None):
+    """
+    Retrieve version and file name of all the packages in one request to
+    the build server, as {package: {"version": ..., "file": ...}}.
+    Returns None if the build server does not support it.
+    Only the packages missing from the lookup cache are requested.
+    """
+    stack = stack if stack else "latest"
+    url = "http://%s/domains/%s/stacks/%s/packages" % (buildhost, domain, stack)
+    immutable = stack != "latest"
+    remote_packages = {}
+    if lookup_cache is not None:
+        for package in packages:
+            version = lookup_cache.get(_version_url(buildhost, domain, stack,
+                                                    package))
+            file_name = version and lookup_cache.get(
+                                    _file_url(buildhost, package, version))
+            if file_name:
+                remote_packages[package] = {"version": version,
+                                            "file": file_name}
+                sha256 = lookup_cache.get(_checksum_url(buildhost, file_name))
+                if sha256:
+                    remote_packages[package]["sha256"] = sha256
+        packages = [package for package in packages
+                    if package not in remote_packages]
+        if not packages:
+            log("%d packages resolved from the lookup cache" % len(
+                                                            remote_packages))
+            return remote_packages
+
+    log("getting versions of %d packages from: %s" % (len(packages), url),
+        log_level="DEBUG")
+    try:
+        data = _post_to_url(url, {"packages": packages})
+    except urllib2.HTTPError, e:
+        if e.code not in (404, 405, 501):
+            raise
+        log("batch resolution not supported by %s (%s), falling back "
+            "to per package requests" % (buildhost, e.code), log_level="WARNING")
+        return None
+    resolved = json.loads(data)
+    if lookup_cache is not None:
+        for package, remote_package in resolved.items():
+            lookup_cache.put(_version_url(buildhost, domain, stack, package),
+                             remote_package["version"], immutable=immutable)
+            lookup_cache.put(_file_url(buildhost, package,
+                                       remote_package["version"]),
+                             remote_package["file"], immutable=True)
+            if remote_package.get("sha256"):
+                lookup_cache.put(_checksum_url(buildhost,
+                                               remote_package["file"]),
+                                 remote_package["sha256"], immutable=True)
+    remote_packages.update(resolved)
+    log("%d packages resolved for stack %s" % (len(remote_packages), stack))
+    return remote_packages
+
+
 def get_updated_package_name(buildhost, package, future_version):
-    url = "http://%s/packages/%s/version/%s/file" % \
-                                        (buildhost, package, future_version)
+    url = _file_url(buildhost, package, future_version)
     log("getting file name from: %s" % url, log_level="DEBUG")
-    filename = _read_from_url(url)
+    if lookup_cache is not None:
+        filename = lookup_cache.read(url, immutable=True)
+    else:
+        filename = _read_from_url(url)
     log("filename for %s in version %s is: %s" % \
                                         (package, future_version, filename))
     return filename
 
 
-def download_package(buildhost, file_name):
+def resolve_package(buildhost, package, installed_version, domain,
+                    stack=None, force_install=False):
+    """
+    Retrieve version and file name of the package to install, as
+    {"version": ..., "file": ...}, or None if the installed version is
+    already the one of the stack. A package the stack lists with an empty
+    version is no longer in it, and has neither version nor file. A stack
+    or package unknown to the build server aborts the update.
+    """
+    future_version = get_remote_version_for(buildhost,
+                                            package,
+                                            domain,
+                                            stack=stack)
+    if not force_install and installed_version == future_version:
+        return None
+    if not future_version:
+        if not installed_version:
+            return None
+        log("%s is no longer in stack %s" % (package, stack))
+        return {"version": "", "file": None}
+    return {"version": future_version,
+            "file": get_updated_package_name(buildhost,
+                                             package,
+                                             future_version)}
+
+
+def get_package_checksum(buildhost, file_name):
+    """
+    Retrieve the sha256 checksum of a package from the build server, or
+    None if it does not publish it.
+    """
+    url = _checksum_url(buildhost, file_name)
+    log("getting checksum from: %s" % url, log_level="DEBUG")
+    try:
+        if lookup_cache is not None:
+            return lookup_cache.read(url, immutable=True).split()[0]
+        return _read_from_url(url).split()[0]
+    except (urllib2.HTTPError, IndexError):
+        return None
+
+
+def get_package_size(buildhost, file_name):
+    """
+    Retrieve the size of a package on the build server, without
+    downloading it.
+    """
+    url = "http://%s/debs/%s" % (buildhost, file_name)
+    log("getting size from: %s" % url, log_level="DEBUG")
+    response = http_pool.open("HEAD", url)
+    response.read()
+    return int(response.getheader("content-length", 0))
+
+
+def download_package(buildhost, file_name, sha256=None, base=None):
+    """
+    Download the package from the first peer having it, or from the build
+    server. The checksum published by the build server is requested unless
+    given, and verified whatever the source. Peers are only used when the
+    checksum of the package is known.
+    With base, a previous package file, only the delta between both is
+    downloaded if the build server has it, see `download_delta`.
+    """
     url = "http://%s/debs/%s" % (buildhost, file_name)
     final_file_name = os.path.join(base_folder, file_name)
-    log("saving %s into %s" % (url, final_file_name), log_level="DEBUG")
-    output = _retrieve_from_url(url, final_file_name)
-    log("saved %s kb in %s" % (output, file_name))
+    if (package_cache is not None and
+            package_cache.get(file_name, final_file_name, sha256=sha256)):
+        log("reused %s from the cache" % file_name)
+        return 0
+
+    sha256 = sha256 or get_package_checksum(buildhost, file_name)
+    if base and sha256:
+        output = download_delta(buildhost, file_name, base, sha256)
+        if output is not None:
+            if package_cache is not None:
+                package_cache.put(final_file_name, file_name)
+            return output
+
+    urls = [url]
+    if package_peers and sha256:
+        peers = random.sample(package_peers, len(package_peers))
+        urls = ["http://%s/debs/%s" % (peer, file_name)
+                                                for peer in peers] + urls
+
+    for url in urls:
+        log("saving %s into %s" % (url, final_file_name), log_level="DEBUG")
+        started = time.time()
+        try:
+            output = _retrieve_from_url(url, final_file_name, sha256)
+        except (urllib2.URLError, httplib.HTTPException, socket.error,
+                ChecksumError), e:
+            if url == urls[-1]:
+                raise
+            log("failed to download %s : %s" % (url, e), log_level="WARNING")
+            continue
+        break
+    elapsed = time.time() - started
+    log("saved %s bytes in %s in %.2fs (%s)" % (output, file_name, elapsed,
+                                                _format_rate(output, elapsed)))
+    if package_cache is not None:
+        package_cache.put(final_file_name, file_name)
     return output
 
 
+def get_delta_bases(local_versions):
+    """
+    Return the retained package file of the installed version of each
+    package, by package, to download the new versions as deltas. A package
+    installed since in another version than the retained one has no base.
+    """
+    if not delta_base_folder or local_versions is None:
+        return {}
+    retained = _read_json(os.path.join(delta_base_folder, "index.json"), {})
+    bases = {}
+    for package, entry in retained.items():
+        path = os.path.join(delta_base_folder, entry["file"])
+        if (entry["version"] == local_versions.get(package) and
+                os.path.isfile(path)):
+            bases[package] = path
+    return bases
+
+
+def download_delta(buildhost, file_name, base, sha256):
+    """
+    Rebuild the package from base, a previous package file, and the delta
+    served by the build server under /deltas/<base file name>/<file name>.
+    Return the size of the delta, or None when the build server has no
+    delta or the rebuilt package does not match sha256, to fall back to a
+    full download.
+
+    A delta is a sequence of instructions, either "C" followed by an
+    offset and a length, as big-endian 64 and 32 bits unsigned integers,
+    to copy this range of base, or "D" followed by a length as a 32 bits
+    unsigned integer then as many bytes of data to insert.
+    """
+    url = "http://%s/deltas/%s/%s" % (buildhost, os.path.basename(base),
+                                      file_name)
+    final_file_name = os.path.join(base_folder, file_name)
+    partial_file_name = final_file_name + ".delta"
+    log("rebuilding %s from %s and %s" % (final_file_name, base, url),
+        log_level="DEBUG")
+    started = time.time()
+    try:
+        response = http_pool.open("GET", url)
+    except urllib2.HTTPError, e:
+        log("no delta for %s from %s (%s)" % (file_name,
+            os.path.basename(base), e.code), log_level="DEBUG")
+        return None
+    except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+        log("failed to download %s : %s" % (url, e), log_level="WARNING")
+        return None
+
+    checksum = hashlib.sha256()
+    try:
+        with open(base, "rb") as base_file, \
+             open(partial_file_name, "wb") as output:
+            size = _apply_delta(response, base_file, output, checksum)
+    except (ValueError, IOError, struct.error,
+            httplib.HTTPException, socket.error), e:
+        log("failed to rebuild %s from %s : %s" % (file_name, url, e),
+            log_level="WARNING")
+        http_pool.close()
+        _remove(partial_file_name)
+        return None
+    if checksum.hexdigest() != sha256:
+        log("checksum of %s rebuilt from %s does not match %s" % (
+            file_name, url, sha256), log_level="WARNING")
+        _remove(partial_file_name)
+        return None
+    os.rename(partial_file_name, final_file_name)
+    elapsed = time.time() - started
+    log("rebuilt %s from a delta of %s bytes in %.2fs (%s)" % (
+                        file_name, size, elapsed, _format_rate(size, elapsed)))
+    return size
+
+
+def _apply_delta(delta, base_file, output, checksum):
+    """
+    Write into output the file described by the instructions of delta
+    against base_file, and return the size of delta.
+    """
+    size = 0
+    while True:
+        operation = delta.read(1)
+        if not operation:
+            return size
+        if operation == "C":
+            offset, length = struct.unpack(">QI", _read_exactly(delta, 12))
+            size += 13
+            base_file.seek(offset)
+            while length:
+                data = base_file.read(min(length, BUFFER_SIZE))
+                if not data:
+                    raise ValueError("copy beyond the end of the base")
+                output.write(data)
+                checksum.update(data)
+                length -= len(data)
+        elif operation == "D":
+            length, = struct.unpack(">I", _read_exactly(delta, 4))
+            size += 5 + length
+            while length:
+                data = _read_exactly(delta, min(length, BUFFER_SIZE))
+                output.write(data)
+                checksum.update(data)
+                length -= len(data)
+        else:
+            raise ValueError("unknown delta instruction %r" % operation)
+
+
+def _read_exactly(stream, length):
+    data = stream.read(length)
+    if len(data) != length:
+        raise ValueError("truncated delta")
+    return data
+
+
+def _remove(file_name):
+    try:
+        os.unlink(file_name)
+    except OSError:
+        pass
+
+
+class PackageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serve the downloaded packages of a folder to the peers, under /debs/.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, folder):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PackageRequestHandler)
+        self.folder = folder
+
+
+class PackageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        file_name = os.path.basename(self.path)
+        path = os.path.join(self.server.folder, file_name)
+        if (not self.path.startswith("/debs/") or
+                not file_name.endswith(".deb") or not os.path.isfile(path)):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        first, last = 0, size - 1
+        if self.headers.getheader("Range"):
+            byte_range = _parse_range(self.headers.getheader("Range"), size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            first, last = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                                                        first, last, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(last - first + 1))
+        self.end_headers()
+        with open(path, "rb") as package:
+            package.seek(first)
+            _copy_exactly(package, self.wfile, last - first + 1)
+
+    def log_message(self, format, *args):
+        log("%s - %s" % (self.client_address[0], format % args),
+            log_level="DEBUG")
+
+
+def _parse_range(header, size):
+    """
+    Return the first and last offsets of the single byte range of a Range
+    header, as (first, last), or None if it cannot be satisfied.
+    """
+    unit, _, byte_range = header.partition("=")
+    if unit.strip() != "bytes" or "," in byte_range:
+        return None
+    first, _, last = byte_range.strip().partition("-")
+    try:
+        if not first:
+            # the last bytes of the file
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first, last = int(first), int(last) if last else size - 1
+    except ValueError:
+        return None
+    if first < 0 or first >= size or last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+def _copy_exactly(source, destination, size):
+    while size > 0:
+        data = source.read(min(BUFFER_SIZE, size))
+        if not data:
+            break
+        destination.write(data)
+        size -= len(data)
+
+
+def serve_packages(port, folder, duration=None, bind="0.0.0.0"):
+    """
+    Serve the packages of the folder to the peers, for duration seconds or
+    until interrupted. The packages are served to whoever can reach the
+    bind address, without authentication.
+    """
+    server = PackageServer((bind, port), folder)
+    log("serving packages of %s on %s:%s" % (folder, bind, port))
+    if duration:
+        timer = threading.Timer(duration, server.shutdown)
+        timer.daemon = True
+        timer.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# the files written by the agent, which runs as root, are the ones it was
+# started with and cannot be requested
+AGENT_FIXED_OPTIONS = (("--timings", "timings"),
+                       ("--lookup-cache", "lookup_cache_file"),
+                       ("--cache-dir", "cache_dir"),
+                       ("--retain-dir", "retain_dir"))
+
+
+def parse_agent_arguments(arguments):
+    """
+    Parse the command line of an update request to the agent, which only
+    runs updates, raising ValueError if invalid.
+    """
+    parser = build_parser()
+    try:
+        args = parser.parse_args(arguments)
+    except SystemExit:
+        raise ValueError("invalid arguments: %s" % " ".join(arguments))
+    if args.manifests is None or args.buildhost is None:
+        raise ValueError("too few arguments")
+    args.manifests.close()
+    if (args.test or args.detach or args.job_id or args.status or args.stop or
+            args.serve is not None or args.agent is not None or
+            args.write_plan or args.progress or args.send_web_callback):
+        raise ValueError("the agent only runs updates")
+    for option, dest in AGENT_FIXED_OPTIONS:
+        value = getattr(args, dest)
+        if value is not None and value != parser.get_default(dest):
+            raise ValueError("the agent does not accept %s" % option)
+    return args
+
+
+def apply_agent_options(arguments, options):
+    """
+    Set the files of the keyword arguments of main to the ones the agent
+    was started with, unless the request turned off the lookup cache or
+    the retained packages.
+    """
+    parser = build_parser()
+    for _, dest in AGENT_FIXED_OPTIONS:
+        if arguments[dest] is not None or parser.get_default(dest) is None:
+            arguments[dest] = options.get(dest)
+    return arguments
+
+
+class AgentServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Long running agent applying the update requests of the controller, so
+    that the interpreter, the parsed dpkg status and the lookup and package
+    caches stay warm from one deployment to the next.
+
+    POST /update with {"arguments": [command line arguments]} runs main like
+    the command line would, one update at a time, and answers with its
+    "status", "output" and "duration". GET /status describes the agent.
+    The requests must carry "Authorization: Bearer <token>", and cannot
+    name the files the agent writes: the updates use the ones of options,
+    by destination of AGENT_FIXED_OPTIONS, given to the agent. The token
+    travels in clear over HTTP: whoever holds it can install the packages
+    of any buildhost as root, so the agent only belongs on a trusted network.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, token, options=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, AgentRequestHandler)
+        self.token = token
+        self.options = options or {}
+        self.started = time.time()
+        self.updates = 0
+        self.update_lock = threading.Lock()
+
+
+class AgentRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path != "/status":
+            self._reply(404, {"error": "not found"})
+            return
+        self._reply(200, {"version": __version__,
+                          "pid": os.getpid(),
+                          "started": self.server.started,
+                          "updates": self.server.updates,
+                          "busy": self.server.update_lock.locked()})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader("Content-Length",
+                                                          0)))
+        if not self._authorized():
+            return
+        if self.path != "/update":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            args = parse_agent_arguments(json.loads(body)["arguments"])
+        except (ValueError, KeyError, TypeError, IOError), e:
+            self._reply(400, {"error": str(e)})
+            return
+        if not self.server.update_lock.acquire(False):
+            self._reply(409, {"error": "an update is already running"})
+            return
+        started = time.time()
+        try:
+            output = main(**apply_agent_options(main_arguments(args),
+                                                self.server.options))
+        except Exception, e:
+            log("update failed: %s" % e, log_level="ERROR")
+            self._reply(500, {"status": "failed", "error": str(e),
+                              "duration": time.time() - started})
+            return
+        finally:
+            if progress_reporter is not None:
+                progress_reporter.close()
+            self.server.updates += 1
+            self.server.update_lock.release()
+        self._reply(200, {"status": "succeeded", "output": output,
+                          "duration": time.time() - started})
+
+    def _authorized(self):
+        if hmac.compare_digest(
+                self.headers.getheader("Authorization", ""),
+                "Bearer %s" % self.server.token):
+            return True
+        self._reply(401, {"error": "unauthorized"})
+        return False
+
+    def _reply(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log("%s - %s" % (self.client_address[0], format % args),
+            log_level="DEBUG")
+
+
+def serve_agent(port, token, bind="0.0.0.0", options=None):
+    """
+    Run the agent on the port until interrupted, its updates using the
+    files of options, see `AgentServer`.
+    """
+    options = options or {}
+    timings = options.get("timings")
+    if timings and timings != "-" and os.path.dirname(timings) and \
+            not os.path.isdir(os.path.dirname(timings)):
+        os.makedirs(os.path.dirname(timings))
+    server = AgentServer((bind, port), token, options=options)
+    log("agent listening on %s:%s" % (bind, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class PackageCache(object):
+    """
+    Persistent cache of the downloaded packages, keyed by file name and
+    checksum. The least recently used packages are evicted once the cache
+    holds more than max_bytes or max_entries. The index is locked while it
+    is written, and merged with the packages cached meanwhile by the other
+    processes sharing the folder.
+    """
+    index_name = "index.json"
+    lock_name = "index.lock"
+
+    def __init__(self, folder, max_bytes=2 * 1024 ** 3, max_entries=500):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._discarded = set()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with self._index_lock():
+            self.entries = self._load()
+
+    def get(self, file_name, destination, sha256=None):
+        """
+        Copy the cached package into destination, if present and intact.
+        A known checksum of the package must match the cached one.
+        """
+        with self._lock:
+            entry = self.entries.get(file_name)
+            if entry is None:
+                return False
+            path = os.path.join(self.folder, file_name)
+            if sha256 and sha256 != entry["sha256"]:
+                log("cached %s does not match checksum %s" % (file_name,
+                    sha256), log_level="WARNING")
+                self._discard(file_name)
+                return False
+            try:
+                intact = _file_checksum(path) == entry["sha256"]
+            except IOError:
+                intact = False
+            if not intact:
+                log("cached %s is corrupted" % file_name, log_level="WARNING")
+                self._discard(file_name)
+                return False
+            _link_or_copy(path, destination)
+            entry["used"] = time.time()
+            self._save()
+            return True
+
+    def put(self, path, file_name):
+        """
+        Add the package at path to the cache, evicting older ones if needed.
+        """
+        cached_path = os.path.join(self.folder, file_name)
+        temporary_path = "%s.%s-%s.tmp" % (cached_path, os.getpid(),
+                                           threading.current_thread().ident)
+        _link_or_copy(path, temporary_path)
+        entry = {"sha256": _file_checksum(temporary_path),
+                 "size": os.path.getsize(temporary_path)}
+        with self._lock:
+            os.rename(temporary_path, cached_path)
+            entry["used"] = time.time()
+            self.entries[file_name] = entry
+            self._discarded.discard(file_name)
+            self._save(evict=True)
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.entries.values())
+        by_age = sorted(self.entries, key=lambda name: self.entries[name]["used"])
+        for file_name in by_age:
+            if total <= self.max_bytes and len(self.entries) <= self.max_entries:
+                break
+            total -= self.entries[file_name]["size"]
+            log("evicting %s from the cache" % file_name, log_level="DEBUG")
+            self._discard(file_name)
+
+    def _discard(self, file_name):
+        del self.entries[file_name]
+        self._discarded.add(file_name)
+        try:
+            os.unlink(os.path.join(self.folder, file_name))
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def _index_lock(self):
+        with open(os.path.join(self.folder, self.lock_name), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.folder, self.index_name)) as index:
+                return json.load(index)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, evict=False):
+        with self._index_lock():
+            for file_name, entry in self._load().items():
+                if (file_name not in self.entries and
+                        file_name not in self._discarded):
+                    self.entries[file_name] = entry
+            if evict:
+                self._evict()
+            index_file_name = os.path.join(self.folder, self.index_name)
+            with open(index_file_name + ".tmp", "w") as index:
+                json.dump(self.entries, index)
+            os.rename(index_file_name + ".tmp", index_file_name)
+            self._discarded.clear()
+
+
+class LookupCache(object):
+    """
+    Persistent cache of the answers of the build server, keyed by URL.
+    The answers which cannot change, for a pinned stack or about a package
+    file, never expire. The others, for the latest stack, are revalidated
+    with their ETag once older than ttl seconds. A 404 is remembered for ttl
+    seconds as well, since the build server may publish the answer later.
+    """
+    def __init__(self, file_name, ttl=60):
+        self.file_name = file_name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            with open(file_name) as lookups:
+                self.entries = json.load(lookups)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def get(self, url):
+        """
+        Return the cached answer for url, or None if missing or expired.
+        """
+        with self._lock:
+            entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if not entry["immutable"] and time.time() - entry["stored"] >= self.ttl:
+            return None
+        return entry["value"]
+
+    def put(self, url, value, immutable=False, etag=None):
+        with self._lock:
+            self.entries[url] = {"value": value,
+                                 "immutable": immutable,
+                                 "etag": etag,
+                                 "stored": time.time()}
+
+    def read(self, url, immutable=False):
+        """
+        Return the answer for url from the cache, or from the build server,
+        sending the ETag of the expired answer if any.
+        """
+        value = self.get(url)
+        if value is not None:
+            log("reused %s from the lookup cache" % url, log_level="DEBUG")
+            return value
+        with self._lock:
+            entry = self.entries.get(url) or {}
+        if entry.get("missing") and time.time() - entry["stored"] < self.ttl:
+            raise urllib2.HTTPError(url, 404, "Not Found", None, None)
+        try:
+            value, etag = _read_from_url_if_modified(url, entry.get("etag"))
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                with self._lock:
+                    self.entries[url] = {"value": None,
+                                         "missing": True,
+                                         "immutable": False,
+                                         "stored": time.time()}
+            raise
+        if value is None:
+            log("%s not modified" % url, log_level="DEBUG")
+            value = entry["value"]
+        self.put(url, value, immutable=immutable, etag=etag)
+        return value
+
+    def save(self):
+        folder = os.path.dirname(self.file_name)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with self._lock:
+            with open(self.file_name + ".tmp", "w") as lookups:
+                json.dump(self.entries, lookups)
+        os.rename(self.file_name + ".tmp", self.file_name)
+
+
+class Downloader(object):
+    """
+    Download packages from the build server in background threads as soon
+    as they are added, with at most `jobs` concurrent transfers.
+    """
+    def __init__(self, buildhost, jobs=2):
+        self.buildhost = buildhost
+        self.jobs = max(jobs, 1)
+        self.transfers = {}
+        self.errors = []
+        self.started = None
+        self._added = set()
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def add(self, file_name, sha256=None, base=None):
+        with self._lock:
+            if file_name in self._added:
+                return
+            self._added.add(file_name)
+            if self.started is None:
+                self.started = time.time()
+            if len(self._workers) < self.jobs:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        self._queue.put((file_name, sha256, base))
+
+    def join(self, cancel=False):
+        """
+        Wait for the transfers to complete, or only for the running ones if
+        cancelled, and return {file_name: (bytes, seconds)}. The first
+        error of a transfer is re-raised.
+        """
+        if cancel:
+            self.errors.append(None)
+        with self._lock:
+            workers = list(self._workers)
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
+
+        if not cancel and self.errors:
+            raise self.errors[0][0], self.errors[0][1], self.errors[0][2]
+        if self.transfers:
+            log("downloaded %d files, %d bytes in %.2fs" % (
+                len(self.transfers),
+                sum(size for size, _ in self.transfers.values()),
+                time.time() - self.started))
+        return self.transfers
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self.errors:
+                # give up the remaining transfers after a failure
+                continue
+            file_name, sha256, base = item
+            try:
+                with timed("download", package=file_name) as event:
+                    event["bytes"] = download_package(self.buildhost,
+                                                      file_name,
+                                                      sha256=sha256,
+                                                      base=base)
+            except Exception:
+                self.errors.append(sys.exc_info())
+                continue
+            self.transfers[file_name] = (event["bytes"], event["duration"])
+
+
 def remove_packages(packages):
-    command = "dpkg -r %s" % " ".join(sorted(packages.keys()))
+    command = "dpkg -r %s" % " ".join(sorted(packages))
     log("removing packages: %s" % command, log_level="DEBUG")
-    return _shell_run(command)
+    with timed("remove", packages=len(packages)) as event:
+        event["exit_code"] = _shell_run(command)
+    return event["exit_code"]
 
 
 def install_packages(packages):
     command = "dpkg --force-overwrite -i %s" % " ".join([os.path.join(base_folder, pkg) \
                                        for pkg in sorted(packages.values())])
     log("installing packages: %s" % command, log_level="DEBUG")
-    return _shell_run(command)
+    with timed("install", packages=len(packages)) as event:
+        event["exit_code"] = _shell_run(command)
+    return event["exit_code"]
 
 
 # Helpers (to be patched)
 
+def _parse_dpkg_status(lines):
+    """
+    Index the stanzas of a dpkg status database by package name. Packages
+    removed or with only their configuration files left are ignored.
+    """
+    versions = {}
+    fields = {}
+    for line in itertools.chain(lines, [""]):
+        line = line.rstrip("\n")
+        if not line.strip():
+            status = fields.get("Status", "").split()
+            if ("Package" in fields and status and
+                    status[-1] not in ("not-installed", "config-files")):
+                versions.setdefault(fields["Package"], fields.get("Version", ""))
+            fields = {}
+        elif not line[0].isspace() and ":" in line:
+            key, value = line.split(":", 1)
+            fields[key] = value.strip()
+    return versions
+
+
+def _version_url(buildhost, domain, stack, package):
+    return "http://%s/domains/%s/stacks/%s/packages/%s/version" % (
+                                            buildhost, domain, stack, package)
+
+
+def _file_url(buildhost, package, version):
+    return "http://%s/packages/%s/version/%s/file" % (buildhost, package,
+                                                      version)
+
+
+def _checksum_url(buildhost, file_name):
+    return "http://%s/debs/%s.sha256" % (buildhost, file_name)
+
+
+def _staged_file_name(domain, stack):
+    return os.path.join(base_folder, "mise-a-feu-%s-%s.staged" % (
+                                        domain, stack if stack else "latest"))
+
+
+def _job_file_name(job_id, extension):
+    return os.path.join(base_folder, "mise-a-feu-job-%s.%s" % (job_id,
+                                                               extension))
+
+
+def _job_pid(job_id, status):
+    """
+    Process of a job: recorded by the job itself, or by the detaching
+    process when the job did not record it.
+    """
+    if "pid" in status:
+        return status["pid"]
+    try:
+        with open(_job_file_name(job_id, "pid")) as pid_file:
+            return int(pid_file.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _file_checksum(file_name):
+    checksum = hashlib.sha256()
+    with open(file_name, "rb") as data:
+        for block in iter(lambda: data.read(BUFFER_SIZE), ""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def _read_json(file_name, default=None):
+    try:
+        with open(file_name) as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError):
+        return default
+
+
+def _write_json(file_name, data):
+    with open(file_name + ".tmp", "w") as json_file:
+        json.dump(data, json_file)
+    os.rename(file_name + ".tmp", file_name)
+
+
+def _link_or_copy(source, destination):
+    """
+    Hard link source to destination, or copy it across file systems.
+    """
+    try:
+        os.unlink(destination)
+    except OSError:
+        pass
+    try:
+        os.link(source, destination)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source, destination)
+
+
+def _map_in_threads(function, items, jobs):
+    """
+    Apply function on each item with up to `jobs` worker threads and return
+    the results in the same order. The first error of a worker is re-raised.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def _worker():
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    workers = [threading.Thread(target=_worker)
+                                    for _ in range(min(jobs, len(items)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class ChecksumError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Keep one persistent HTTP/1.1 connection per host and per thread, so the
+    successive requests to the buildhost reuse the same TCP connection.
+    Connecting gives up after timeout seconds, and waiting for data after
+    read_timeout seconds, the same as timeout by default.
+    Redirections of GET and HEAD requests are followed, and the requests to
+    hosts behind a proxy of the environment go through urllib2, like
+    before the pool.
+    """
+    idempotent_methods = ("GET", "HEAD")
+    redirect_codes = (301, 302, 303, 307, 308)
+    max_redirects = 5
+
+    def __init__(self, timeout=None, read_timeout=None):
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        self._local = threading.local()
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Return the body of the response, or raise urllib2.HTTPError like
+        urllib2.urlopen would.
+        """
+        return self.open(method, url, body, headers).read()
+
+    def open(self, method, url, body=None, headers=None):
+        """
+        Return the response, which must be read completely before the next
+        request of the thread. A GET or HEAD request failing on a connection
+        closed by the server in the meantime is retried once on a new
+        connection.
+        """
+        for _ in range(self.max_redirects + 1):
+            response = self._open(method, url, body, headers)
+            location = response.getheader("location")
+            if (response.status not in self.redirect_codes or not location or
+                    method not in self.idempotent_methods):
+                break
+            response.read()
+            url = urlparse.urljoin(url, location)
+        if response.status >= 300 and response.status != 304:
+            response.read()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        return response
+
+    def _open(self, method, url, body=None, headers=None):
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if _proxied(scheme, netloc):
+            return _open_with_urllib2(method, url, body, headers,
+                                      self.read_timeout or self.timeout)
+        path = (path or "/") + ("?" + query if query else "")
+        retries = 2 if method in self.idempotent_methods else 1
+        for attempt in range(1, retries + 1):
+            connection = self._get_connection(scheme, netloc)
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    if self.read_timeout is not None:
+                        connection.sock.settimeout(self.read_timeout)
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self._drop_connection(netloc)
+                if attempt == retries:
+                    raise
+                continue
+            return response
+
+    def close(self):
+        """
+        Close the connections opened by the current thread.
+        """
+        for netloc in list(self._local.__dict__.get("connections", {})):
+            self._drop_connection(netloc)
+
+    def _get_connection(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault("connections", {})
+        if netloc not in connections:
+            factory = httplib.HTTPSConnection if scheme == "https" \
+                                              else httplib.HTTPConnection
+            connections[netloc] = factory(netloc, timeout=self.timeout)
+        return connections[netloc]
+
+    def _drop_connection(self, netloc):
+        connection = self._local.__dict__.get("connections", {}).pop(netloc,
+                                                                     None)
+        if connection is not None:
+            connection.close()
+
+
+class _ProxiedResponse(object):
+    """
+    Response of urllib2 with the attributes of an httplib response used by
+    the callers of `ConnectionPool.open`.
+    """
+    length = None
+
+    def __init__(self, response):
+        self._response = response
+        self.status = response.code
+        self.reason = getattr(response, "msg", "")
+        self.msg = response.info()
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def read(self, amt=None):
+        return self._response.read() if amt is None \
+                                     else self._response.read(amt)
+
+
+def _proxied(scheme, netloc):
+    host = netloc.split("@")[-1].split(":")[0]
+    return scheme in urllib.getproxies() and not urllib.proxy_bypass(host)
+
+
+def _open_with_urllib2(method, url, body=None, headers=None, timeout=None):
+    request = urllib2.Request(url, body, headers or {})
+    request.get_method = lambda: method
+    try:
+        if timeout is None:
+            return _ProxiedResponse(urllib2.urlopen(request))
+        return _ProxiedResponse(urllib2.urlopen(request, timeout=timeout))
+    except urllib2.HTTPError, e:
+        if e.code != 304:
+            raise
+        return _ProxiedResponse(e)
+
+
+http_pool = ConnectionPool()
+
+
 def _read_from_url(url):
-    f = urllib2.urlopen(url)
-    return f.read().replace("\n", "")
+    return http_pool.request("GET", url).replace("\n", "")
+
+
+def _read_from_url_if_modified(url, etag=None):
+    """
+    Return the body of url and its ETag, or None as body if the resource
+    still matches etag.
+    """
+    response = http_pool.open("GET", url,
+                              headers={"If-None-Match": etag} if etag else None)
+    body = response.read()
+    if response.status == 304:
+        return None, etag
+    return body.replace("\n", ""), response.getheader("etag")
+
+
+def _post_to_url(url, payload):
+    return http_pool.request("POST", url, json.dumps(payload),
+                             {"content-type": "application/json"})
 
 
 def _shell_run(command):
     return subprocess.call(command, shell=True)
 
 
-def _retrieve_from_url(url, filename):
-    return urllib.urlretrieve(url, filename)
+def _retrieve_from_url(url, filename, sha256=None):
+    """
+    Download url into filename and return the number of bytes transferred.
+    The data goes first into a ".part" file, whose download is resumed with
+    an HTTP Range request if it is left over from a previous attempt.
+    The data is hashed as it arrives, in blocks of BUFFER_SIZE, and the file
+    is only renamed once complete and matching sha256, or the SHA-256 of
+    the Digest header of the response. Otherwise ChecksumError is raised.
+    """
+    partial_file_name = filename + ".part"
+    offset = 0
+    headers = {}
+    if os.path.exists(partial_file_name):
+        offset = os.path.getsize(partial_file_name)
+        headers["Range"] = "bytes=%d-" % offset
+        log("resuming %s from byte %d" % (url, offset), log_level="DEBUG")
+
+    try:
+        response = http_pool.open("GET", url, headers=headers)
+    except urllib2.HTTPError, e:
+        if not offset or e.code != 416:
+            raise
+        # the partial file is already complete
+        response = None
+
+    if response is not None and response.status != 206:
+        offset = 0
+    checksum = hashlib.sha256()
+    if offset:
+        with open(partial_file_name, "rb") as partial:
+            for block in iter(lambda: partial.read(BUFFER_SIZE), ""):
+                checksum.update(block)
+    size = 0
+    if response is not None:
+        with open(partial_file_name, "ab" if offset else "wb") as output:
+            while True:
+                data = response.read(BUFFER_SIZE)
+                if not data:
+                    break
+                checksum.update(data)
+                output.write(data)
+                size += len(data)
+        if response.length:
+            # connection closed before the end, keep the partial file to resume
+            raise httplib.IncompleteRead("", response.length)
+        sha256 = sha256 or _digest_header(response)
+    if sha256 and checksum.hexdigest() != sha256:
+        os.unlink(partial_file_name)
+        raise ChecksumError("checksum of %s does not match %s" % (url, sha256))
+    os.rename(partial_file_name, filename)
+    return size
+
+
+def _digest_header(response):
+    """
+    Return the hexadecimal SHA-256 of the Digest header of the response
+    (RFC 3230), if any.
+    """
+    for digest in (response.getheader("digest") or "").split(","):
+        algorithm, _, value = digest.strip().partition("=")
+        if algorithm.lower() == "sha-256" and value:
+            try:
+                return base64.b64decode(value).encode("hex")
+            except TypeError:
+                return None
+    return None
+
+
+def _format_rate(size, elapsed):
+    return "%.2f MB/s" % (size / max(elapsed, 0.001) / 1024 ** 2)
 
 
-def _do_web_callback(web_callback_url, packages):
+def _do_web_callback(web_callback_url, packages, timeout=10, retries=0,
+                     backoff=1):
     """
     Make a POST HTTP request to callback url once the stack update is complete.
     Body of the request should be json data:
     {"packages" : [name+]}
+    Failed requests are retried after backoff seconds, then twice as long
+    each time, unless the callback answered a client error.
     """
     payload = {"packages" : packages}
     req = urllib2.Request(web_callback_url,
                           json.dumps(payload),
                           {"content-type": "application/json"})
 
-    try:
-        f = urllib2.urlopen(req)
-        return f.code == 200
-    except urllib2.URLError, e:
-        log("failed to open web callback %s : %s" % (web_callback_url, e),
-            log_level="ERROR")
-        return False
-
-
-if __name__ == '__main__':
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            f = urllib2.urlopen(req, timeout=timeout)
+            return f.code == 200
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            log("failed to open web callback %s : %s" % (web_callback_url, e),
+                log_level="ERROR")
+            if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                return False
+    return False
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Upgrade packages of the stack according to version.', prog="mise-a-feu (client)")
     parser.add_argument('--version', action='version', version='%(prog)s '+get_version())
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--verbose', action='store_true')
     parser.add_argument('--force', action='store_true')
     parser.add_argument('--web-callback', action='store', dest='webcallback')
-    parser.add_argument('manifests', type=file)
-    parser.add_argument('buildhost', help="buildserver domain name to retrieve the data remotely")
+    parser.add_argument('--send-web-callback', action='store',
+                        dest='send_web_callback', help=argparse.SUPPRESS)
+    parser.add_argument('--batch', action='store_true',
+                        help="resolve all the packages in one request to the buildhost")
+    parser.add_argument('--download-jobs', action='store', type=int, default=2,
+                        help="number of concurrent downloads (2 by default)")
+    phase = parser.add_mutually_exclusive_group()
+    phase.add_argument('--prefetch', action='store_true',
+                       help="only download and stage the packages to install")
+    phase.add_argument('--staged', action='store_true',
+                       help="install the packages staged by --prefetch, offline")
+    phase.add_argument('--rollback', action='store_true',
+                       help="reinstall the packages replaced by the last "
+                            "update, offline")
+    parser.add_argument('--strategy', action='store', default='remove-install',
+                        choices=['remove-install', 'upgrade'],
+                        help="remove the packages before installing them "
+                             "(remove-install, by default) or install them "
+                             "over the old ones (upgrade)")
+    parser.add_argument('--cache-dir', action='store', dest='cache_dir',
+                        help="keep the downloaded packages in this folder")
+    parser.add_argument('--cache-max-bytes', action='store', type=int,
+                        default=2 * 1024 ** 3,
+                        help="size of the package cache (2GB by default)")
+    parser.add_argument('--cache-max-entries', action='store', type=int,
+                        default=500,
+                        help="number of packages in the cache (500 by default)")
+    parser.add_argument('--jobs', action='store', type=int, default=4,
+                        help="number of packages resolved concurrently (4 by default)")
+    parser.add_argument('--detach', action='store_true',
+                        help="run in the background and print the job id")
+    parser.add_argument('--job-id', action='store', dest='job_id',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--status', action='store', metavar='JOB_ID',
+                        help="print the status of a detached job as json")
+    parser.add_argument('--stop', action='store', metavar='JOB_ID',
+                        help="terminate a detached job")
+    parser.add_argument('--peers', action='store', type=lambda peers: peers.split(','),
+                        help="comma separated host:port of peers serving the packages")
+    parser.add_argument('--serve', action='store', type=int, metavar='PORT',
+                        help="serve the downloaded packages to the peers on this port")
+    parser.add_argument('--serve-for', action='store', type=int, metavar='SECONDS',
+                        dest='serve_for', help="stop serving after this time")
+    parser.add_argument('--serve-bind', action='store', dest='serve_bind',
+                        metavar='ADDRESS', default='0.0.0.0',
+                        help="address to serve the packages on, without "
+                             "authentication (%(default)s by default)")
+    parser.add_argument('--plan', action='store', dest='plan_file',
+                        help="install the versions of this plan, without resolving them")
+    parser.add_argument('--plan-only', action='store_true', dest='plan_only',
+                        help="only print the changes to make as json")
+    parser.add_argument('--timings', action='store', metavar='FILE',
+                        help="append the duration of each phase as json lines "
+                             "to this file, or to the standard output with -")
+    parser.add_argument('--lookup-cache', action='store',
+                        dest='lookup_cache_file', metavar='FILE',
+                        default="/var/cache/mise-a-feu/lookups.json",
+                        help="keep the answers of the build server in this "
+                             "file (%(default)s by default)")
+    parser.add_argument('--no-lookup-cache', action='store_const',
+                        dest='lookup_cache_file', const=None,
+                        help="always ask the build server")
+    parser.add_argument('--lookup-ttl', action='store', type=int, default=60,
+                        help="seconds before revalidating the versions of "
+                             "the latest stack (60 by default)")
+    parser.add_argument('--connect-timeout', action='store', type=float,
+                        default=10,
+                        help="seconds to connect to the build server or to "
+                             "a peer (10 by default)")
+    parser.add_argument('--read-timeout', action='store', type=float,
+                        default=60,
+                        help="seconds without data from the build server or "
+                             "a peer before giving up (60 by default)")
+    parser.add_argument('--progress', action='store_true',
+                        help="stream progress events on the standard output")
+    parser.add_argument('--progress-url', action='store', dest='progress_url',
+                        help="post the progress events to this url instead")
+    parser.add_argument('--retain-dir', action='store', dest='retain_dir',
+                        default="/var/cache/mise-a-feu/retained",
+                        help="keep the installed packages and the ones they "
+                             "replaced in this folder (%(default)s by default)")
+    parser.add_argument('--no-retain', action='store_const',
+                        dest='retain_dir', const=None,
+                        help="do not keep the packages for a rollback")
+    parser.add_argument('--deltas', action='store_true',
+                        help="download the delta of the packages with the "
+                             "retained ones, when the build server has it")
+    parser.add_argument('--agent', action='store', type=int, metavar='PORT',
+                        help="run as an agent applying the update requests "
+                             "received on this port, with its own --timings, "
+                             "--lookup-cache, --cache-dir and --retain-dir")
+    parser.add_argument('--agent-bind', action='store', dest='agent_bind',
+                        default="0.0.0.0", metavar='ADDRESS',
+                        help="address the agent listens on (%(default)s by "
+                             "default)")
+    parser.add_argument('--agent-token-file', action='store',
+                        dest='agent_token_file', metavar='FILE',
+                        help="only accept the requests carrying the token "
+                             "of this file, required with --agent")
+    parser.add_argument('--write-plan', action='store', dest='write_plan',
+                        metavar='PLAN_FILE',
+                        help="only resolve the packages of the manifest into a plan")
+    parser.add_argument('manifests', nargs="?", type=file)
+    parser.add_argument('buildhost', nargs="?", help="buildserver domain name to retrieve the data remotely")
     parser.add_argument('domain', nargs="?", default="default", help='Domain ("default" by default)')
     parser.add_argument('stack', nargs="?", default="latest", help='Stack version (latest version by default)')
-    args = parser.parse_args()
+    return parser
+
+
+def main_arguments(args):
+    """
+    Keyword arguments of main for the parsed command line.
+    """
+    return dict(manifest_file=args.manifests.name,
+                buildhost=args.buildhost,
+                verbose=args.verbose,
+                force_install=args.force,
+                domain=args.domain,
+                stack=args.stack,
+                webcallback=args.webcallback,
+                jobs=args.jobs,
+                batch=args.batch,
+                download_jobs=args.download_jobs,
+                cache_dir=args.cache_dir,
+                cache_max_bytes=args.cache_max_bytes,
+                cache_max_entries=args.cache_max_entries,
+                prefetch=args.prefetch,
+                staged=args.staged,
+                strategy=args.strategy,
+                peers=args.peers,
+                plan_file=args.plan_file,
+                plan_only=args.plan_only,
+                timings=args.timings,
+                lookup_cache_file=args.lookup_cache_file,
+                lookup_ttl=args.lookup_ttl,
+                progress=args.progress,
+                progress_url=args.progress_url,
+                retain_dir=args.retain_dir,
+                rollback=args.rollback,
+                deltas=args.deltas,
+                connect_timeout=args.connect_timeout,
+                read_timeout=args.read_timeout)
+
 
-    if not args.test:
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    if (not args.status and not args.stop and args.serve is None and
+            args.agent is None and not args.send_web_callback and
+            (args.manifests is None or args.buildhost is None)):
+        parser.error("too few arguments")
+
+    if args.send_web_callback:
+        # started by send_web_callback
+        os.setsid()
+        callback = json.loads(args.send_web_callback)
+        timing_file = callback["timings"]
+        with timed("web_callback") as event:
+            event["succeeded"] = _do_web_callback(callback["url"],
+                                                  callback["packages"],
+                                                  timeout=callback["timeout"],
+                                                  retries=callback["retries"],
+                                                  backoff=callback["backoff"])
+
+    elif args.status:
+        print json.dumps(get_job_status(args.status))
+
+    elif args.stop:
+        print json.dumps(stop_job(args.stop))
+
+    elif args.detach:
+        print start_job([arg for arg in sys.argv[1:] if arg != '--detach'])
+
+    elif args.agent is not None:
+        is_verbose = args.verbose
+        if not args.agent_token_file:
+            parser.error("--agent-token-file is required with --agent")
+        with open(args.agent_token_file) as token_file:
+            token = token_file.read().strip()
+        if not token:
+            parser.error("%s is empty" % args.agent_token_file)
+        serve_agent(args.agent, token, bind=args.agent_bind,
+                    options=dict((dest, getattr(args, dest))
+                                 for _, dest in AGENT_FIXED_OPTIONS))
+
+    elif args.serve is not None:
+        is_verbose = args.verbose
+        serve_packages(args.serve, args.cache_dir or base_folder,
+                       duration=args.serve_for, bind=args.serve_bind)
+
+    elif args.write_plan:
+        is_verbose = args.verbose
+        args.manifests.close()
+        write_plan(args.write_plan,
+                   args.buildhost,
+                   get_installed_packages(args.manifests.name),
+                   args.domain,
+                   stack=args.stack,
+                   jobs=args.jobs,
+                   batch=args.batch)
+
+    elif not args.test:
         # run main action
         args.manifests.close()
-        main(manifest_file=args.manifests.name,
-             buildhost=args.buildhost,
-             verbose=args.verbose,
-             force_install=args.force,
-             domain=args.domain,
-             stack=args.stack,
-             webcallback=args.webcallback)
+        run = main if not args.job_id else \
+                        lambda **kwargs: run_job(args.job_id, **kwargs)
+        try:
+            output = run(**main_arguments(args))
+        finally:
+            if progress_reporter is not None:
+                progress_reporter.close()
+        if args.plan_only:
+            print json.dumps(output)
 
     else:
         # helper functions for tests
@@ -237,7 +2311,8 @@ if __name__ == '__main__':
 
         # run tests for downloader
 
-        with patch('__main__._retrieve_from_url', get_lookup_function({"http://buildhost/debs/test-package-1.0.0-amd64.deb": {"/tmp/test-package-1.0.0-amd64.deb": 10}})):
+        with nested(patch('__main__._read_from_url', get_lookup_function({"http://buildhost/debs/test-package-1.0.0-amd64.deb.sha256": "0123  test-package-1.0.0-amd64.deb"})),
+                    patch('__main__._retrieve_from_url', get_lookup_function({"http://buildhost/debs/test-package-1.0.0-amd64.deb": {"/tmp/test-package-1.0.0-amd64.deb": 10}}))):
             output = download_package("buildhost", "test-package-1.0.0-amd64.deb")
         assert output>0, "can not download file"
 
@@ -304,7 +2379,7 @@ if __name__ == '__main__':
         with  tempfile.NamedTemporaryFile() as fd:          
             output = _retrieve_from_url("http://127.0.0.1:8000/", fd.name)
             assert output>0, "downloader failed to retrieve url %s" % output
-            output = fd.read()
+            output = open(fd.name).read()
             assert output=="hello world\n", "downloader failed to download file %s" % output
 
         # test file reader
@@ -320,8 +2395,8 @@ if __name__ == '__main__':
         with nested(
                 patch('__main__.get_installed_packages', 
                         get_lookup_function({'toto.manifest': ['pkg1', 'pkg2']})),
-                patch('__main__.get_local_version_for', 
-                        get_lookup_function({'pkg1': "0.0.9", 'pkg2': "0.0.8"})),
+                patch('__main__.get_local_versions', 
+                        lambda: {'pkg1': "0.0.9", 'pkg2': "0.0.8"}),
                 patch('__main__._shell_run', 
                         get_lookup_function({'dpkg -r pkg1 pkg2': 0,
                                         'dpkg --force-overwrite -i /tmp/pkg1-1.0.0-amd64.deb /tmp/pkg2-2.0.0-amd64.deb': 0,})),
@@ -329,7 +2404,9 @@ if __name__ == '__main__':
                         get_lookup_function({'http://buildhost/domains/default/stacks/latest/packages/pkg1/version': "1.0.0",
                                         'http://buildhost/domains/default/stacks/latest/packages/pkg2/version': "2.0.0",
                                         "http://buildhost/packages/pkg1/version/1.0.0/file": "pkg1-1.0.0-amd64.deb",
-                                        "http://buildhost/packages/pkg2/version/2.0.0/file": "pkg2-2.0.0-amd64.deb",})),
+                                        "http://buildhost/debs/pkg1-1.0.0-amd64.deb.sha256": "0123  pkg1-1.0.0-amd64.deb",
+                                        "http://buildhost/packages/pkg2/version/2.0.0/file": "pkg2-2.0.0-amd64.deb",
+                                        "http://buildhost/debs/pkg2-2.0.0-amd64.deb.sha256": "0123  pkg2-2.0.0-amd64.deb",})),
                 patch('__main__._retrieve_from_url', 
                         get_lookup_function({"http://buildhost/debs/pkg1-1.0.0-amd64.deb": {"/tmp/pkg1-1.0.0-amd64.deb": 10},
                                             "http://buildhost/debs/pkg2-2.0.0-amd64.deb": {"/tmp/pkg2-2.0.0-amd64.deb": 10}})),
@@ -340,15 +2417,16 @@ if __name__ == '__main__':
         with nested(
                 patch('__main__.get_installed_packages', 
                         get_lookup_function({'toto.manifest': ['pkg1', 'pkg2']})),
-                patch('__main__.get_local_version_for', 
-                        get_lookup_function({'pkg1': "1.0.0", 'pkg2': "0.0.8"})),
+                patch('__main__.get_local_versions', 
+                        lambda: {'pkg1': "1.0.0", 'pkg2': "0.0.8"}),
                 patch('__main__._shell_run', 
                         get_lookup_function({'dpkg -r pkg2': 0,
                                         'dpkg --force-overwrite -i /tmp/pkg2-2.0.0-amd64.deb': 0,})),
                 patch('__main__._read_from_url', 
                         get_lookup_function({'http://buildhost/domains/default/stacks/latest/packages/pkg1/version': "1.0.0",
                                         'http://buildhost/domains/default/stacks/latest/packages/pkg2/version': "2.0.0",
-                                        "http://buildhost/packages/pkg2/version/2.0.0/file": "pkg2-2.0.0-amd64.deb",})),
+                                        "http://buildhost/packages/pkg2/version/2.0.0/file": "pkg2-2.0.0-amd64.deb",
+                                        "http://buildhost/debs/pkg2-2.0.0-amd64.deb.sha256": "0123  pkg2-2.0.0-amd64.deb",})),
                 patch('__main__._retrieve_from_url', 
                         get_lookup_function({"http://buildhost/debs/pkg2-2.0.0-amd64.deb": {"/tmp/pkg2-2.0.0-amd64.deb": 10}})),
             ):
@@ -358,8 +2436,8 @@ if __name__ == '__main__':
         with nested(
                 patch('__main__.get_installed_packages', 
                         get_lookup_function({'toto.manifest': ['pkg1', 'pkg2']})),
-                patch('__main__.get_local_version_for', 
-                        get_lookup_function({'pkg1': "1.0.0", 'pkg2': "2.0.0"})),
+                patch('__main__.get_local_versions', 
+                        lambda: {'pkg1': "1.0.0", 'pkg2': "2.0.0"}),
                 patch('__main__._read_from_url', 
                         get_lookup_function({'http://buildhost/domains/default/stacks/latest/packages/pkg1/version': "1.0.0",
                                         'http://buildhost/domains/default/stacks/latest/packages/pkg2/version': "2.0.0",})),
@@ -370,6 +2448,7 @@ if __name__ == '__main__':
         with nested(
                 patch('__main__.get_installed_packages', 
                         get_lookup_function({'toto.manifest': ['pkg1', 'pkg2']})),
+                patch('__main__.get_local_versions', lambda: None),
                 patch('__main__.get_local_version_for', 
                         get_lookup_function({'pkg1': "1.0.0", 'pkg2': "2.0.0"})),
                 patch('__main__._shell_run', 
@@ -379,7 +2458,9 @@ if __name__ == '__main__':
                         get_lookup_function({'http://buildhost/domains/default/stacks/latest/packages/pkg1/version': "1.0.0",
                                         'http://buildhost/domains/default/stacks/latest/packages/pkg2/version': "2.0.0",
                                         "http://buildhost/packages/pkg1/version/1.0.0/file": "pkg1-1.0.0-amd64.deb",
-                                        "http://buildhost/packages/pkg2/version/2.0.0/file": "pkg2-2.0.0-amd64.deb",})),
+                                        "http://buildhost/debs/pkg1-1.0.0-amd64.deb.sha256": "0123  pkg1-1.0.0-amd64.deb",
+                                        "http://buildhost/packages/pkg2/version/2.0.0/file": "pkg2-2.0.0-amd64.deb",
+                                        "http://buildhost/debs/pkg2-2.0.0-amd64.deb.sha256": "0123  pkg2-2.0.0-amd64.deb",})),
                 patch('__main__._retrieve_from_url', 
                         get_lookup_function({"http://buildhost/debs/pkg1-1.0.0-amd64.deb": {"/tmp/pkg1-1.0.0-amd64.deb": 10},
                                             "http://buildhost/debs/pkg2-2.0.0-amd64.deb": {"/tmp/pkg2-2.0.0-amd64.deb": 10}})),
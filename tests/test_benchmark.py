@@ -0,0 +1,20 @@
+import unittest
+
+from benchmarks.bench_update_stack import run_scenario
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_scenario(self):
+        result = run_scenario(10, 0.5, deb_size=100)
+        self.assertEqual(5, result["updated"])
+        self.assertEqual(0, result["outdated"])
+        # 10 versions, 5 file names, 5 checksums and 5 packages
+        self.assertEqual(25, result["requests"])
+        self.assertTrue(result["bytes"] > 5 * 100)
+
+    def test_batch_scenario(self):
+        result = run_scenario(10, 1, deb_size=100, batch=True)
+        self.assertEqual(10, result["updated"])
+        self.assertEqual(0, result["outdated"])
+        self.assertEqual(11, result["requests"])
@@ -0,0 +1,65 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from mise_a_feu.lib.delivery import Notifier, run_with_timeout
+
+
+class RunWithTimeoutTestCase(unittest.TestCase):
+
+    def test_exit_code(self):
+        self.assertEqual(0, run_with_timeout("true", timeout=5))
+        self.assertEqual(3, run_with_timeout("exit 3", timeout=5))
+
+    def test_timeout(self):
+        started = time.time()
+        self.assertEqual(None, run_with_timeout("sleep 10", timeout=0.2))
+        self.assertTrue(time.time() - started < 5)
+
+
+class NotifierTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.output = os.path.join(self.folder, "output")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_background_delivery(self):
+        notifier = Notifier(timeout=5, workers=1)
+        started = time.time()
+        notifier.notify("sleep 0.5; echo '%%(message)s' >> %s" % self.output,
+                        "deploying")
+        self.assertTrue(time.time() - started < 0.5)
+        self.assertEqual({"sent": 1, "failed": 0, "retried": 0,
+                          "coalesced": 0}, notifier.close())
+        self.assertEqual("deploying\n", open(self.output).read())
+
+    def test_retries(self):
+        notifier = Notifier(timeout=5, retries=2, backoff=0)
+        notifier.notify("echo x >> %s; exit 1 # %%(message)s" % self.output,
+                        "deploying")
+        self.assertEqual({"sent": 0, "failed": 1, "retried": 2,
+                          "coalesced": 0}, notifier.close())
+        self.assertEqual("x\nx\nx\n", open(self.output).read())
+
+    def test_coalesce(self):
+        notifier = Notifier(timeout=5, workers=1)
+        notifier.notify("sleep 0.5 # %(message)s", "busy")
+        time.sleep(0.1)
+        command = "echo '%%(message)s' >> %s" % self.output
+        notifier.notify(command, "started")
+        notifier.notify(command, "done")
+        self.assertEqual({"sent": 2, "failed": 0, "retried": 0,
+                          "coalesced": 1}, notifier.close())
+        self.assertEqual("started | done\n", open(self.output).read())
+
+    def test_close_timeout(self):
+        notifier = Notifier(timeout=5)
+        notifier.notify("sleep 2 # %(message)s", "slow")
+        started = time.time()
+        self.assertEqual(0, notifier.close(timeout=0.2)["sent"])
+        self.assertTrue(time.time() - started < 1)
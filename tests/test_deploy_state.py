@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+from fabric.exceptions import CommandTimeout
+
+from mise_a_feu.lib.deploy_state import DeployState, converge
+from mise_a_feu.lib.rollout import WaveScheduler
+
+HOSTS = ["host1", "host2", "host3"]
+
+
+class Output(str):
+    failed = False
+    return_code = 0
+
+
+class FailedOutput(Output):
+    failed = True
+    return_code = 1
+
+
+class DeployStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "state", "main-1.2.3.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_save_and_load(self):
+        state = DeployState(self.path, "main", "1.2.3", HOSTS)
+        state.record("host1", "succeeded")
+        state.record("host2", "failed", "exit code 1")
+        state.save()
+
+        loaded = DeployState.load(self.path)
+        self.assertEqual(("main", "1.2.3"), (loaded.domain, loaded.stack))
+        self.assertEqual(["host2", "host3"], loaded.pending_hosts())
+        self.assertEqual("exit code 1", loaded.hosts["host2"]["reason"])
+        self.assertEqual({"status": "failed", "error": "exit code 1"},
+                         loaded.results()["host2"])
+        self.assertEqual(1, loaded.hosts["host2"]["attempts"])
+        self.assertEqual("host2: failed after 1 attempts (exit code 1)",
+                         loaded.summary().splitlines()[1])
+
+        loaded.remove()
+        self.assertEqual(None, DeployState.load(self.path))
+
+    def test_converge(self):
+        state = DeployState(self.path, "main", "1.2.3", HOSTS)
+        attempts = []
+
+        def _deploy(hosts):
+            attempts.append(hosts)
+            results = {"host1": Output(""),
+                       "host2": FailedOutput(""),
+                       "host3": CommandTimeout(timeout=60)}
+            if len(attempts) > 1:
+                results["host3"] = Output("")
+            return dict((host, results[host]) for host in hosts)
+
+        with patch("time.sleep") as sleep:
+            results = converge(_deploy, state, retries=2, backoff=10)
+        self.assertEqual([HOSTS, ["host2", "host3"], ["host2"]], attempts)
+        self.assertEqual([((10,), {}), ((20,), {})], sleep.call_args_list)
+        self.assertEqual(["host2"], state.pending_hosts())
+        self.assertEqual(("failed", 3), (state.hosts["host2"]["outcome"],
+                                         state.hosts["host2"]["attempts"]))
+        self.assertEqual(("succeeded", 2), (state.hosts["host3"]["outcome"],
+                                            state.hosts["host3"]["attempts"]))
+        self.assertTrue(results["host2"].failed)
+        self.assertEqual(["host2"], DeployState.load(self.path).pending_hosts())
+
+    def test_resume(self):
+        state = DeployState(self.path, "main", "1.2.3", HOSTS)
+        state.record("host1", "succeeded")
+        state.record("host2", "timeout", "job 12-34 still running")
+        state.save()
+
+        deployed = []
+        converge(lambda hosts: deployed.extend(hosts) or {"host2": Output("")},
+                 DeployState.load(self.path))
+        self.assertEqual(["host2", "host3"], deployed)
+        state = DeployState.load(self.path)
+        self.assertEqual(["host3"], state.pending_hosts())
+        self.assertEqual("not deployed", state.hosts["host3"]["reason"])
+        self.assertEqual(2, state.hosts["host2"]["attempts"])
+
+    def test_stopped_rollout(self):
+        state = DeployState(self.path, "main", "1.2.3", HOSTS)
+        deployed = []
+
+        def _deploy_wave(hosts):
+            deployed.append(hosts)
+            return dict((host, FailedOutput("") if host == "host2"
+                         else Output("")) for host in hosts)
+
+        scheduler = WaveScheduler(HOSTS, wave_size=2, max_failure_ratio=0.1)
+        with patch("time.sleep"), self.assertRaises(SystemExit):
+            converge(lambda hosts: scheduler.run(_deploy_wave), state,
+                     retries=2)
+        self.assertEqual([["host1", "host2"]], deployed)
+        state = DeployState.load(self.path)
+        self.assertEqual(["succeeded", "failed", "pending"],
+                         [state.hosts[host]["outcome"] for host in HOSTS])
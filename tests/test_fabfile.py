@@ -0,0 +1,185 @@
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from fabric.api import settings, abort, env, execute, hide
+
+# stack_updater must first be imported with its sudo mocked
+from test_stack_updater import sudo_mock
+from mise_a_feu import fabfile
+from mise_a_feu.lib.utils import host_outcome
+
+HOSTS = ["h0", "h1", "h2", "h3"]
+
+
+def fake_execute(calls, failures=None):
+    """
+    Stand-in for execute, recording the calls of each task and answering
+    as if every host succeeded, but the ones given the result of a failure.
+    """
+    failures = failures or {}
+
+    def _execute(task, *args, **kwargs):
+        calls.append((task, kwargs))
+        hosts = kwargs.get("hosts", [])
+        if task is fabfile.deploy_host:
+            results = dict((host, "job-%s" % host if kwargs.get("detach")
+                                  else "done") for host in hosts)
+            results.update((host, result) for host, result
+                           in failures.items() if host in hosts)
+            return results
+        if task is fabfile.collect_timings:
+            return dict((host, []) for host in hosts)
+        if task is fabfile.poll_host:
+            return dict((host, {"job": args[0][host], "status": "succeeded"})
+                        for host in hosts)
+        return dict((host, "done") for host in hosts)
+    return _execute
+
+
+class DeployHostTestCase(unittest.TestCase):
+
+    def test_aborting_host(self):
+        def run_updater(domain, stack_version, buildhost, **kwargs):
+            if env.host_string == "h1":
+                abort("Unknown phase: other")
+            return "done"
+
+        with settings(hide("everything"), buildhost="buildhost",
+                      warn_only=True), \
+             patch.object(fabfile, "run_updater", run_updater):
+            results = execute(fabfile.deploy_host, "default", "1.2.3",
+                              hosts=["h0", "h1"])
+        self.assertEqual(("succeeded", None), host_outcome(results["h0"]))
+        self.assertEqual(("failed", "Unknown phase: other"),
+                         host_outcome(results["h1"]))
+
+
+class DeployHostsTestCase(unittest.TestCase):
+
+    def deploy(self, **kwargs):
+        calls = []
+        with settings(rollout={"wave_size": 2}, poll_interval=0), \
+             patch.object(fabfile, "execute", fake_execute(calls)):
+            results = fabfile.deploy_hosts("default", "1.2.3", hosts=HOSTS,
+                                           **kwargs)
+        return results, [(kwargs["hosts"], kwargs) for task, kwargs in calls
+                         if task is fabfile.deploy_host]
+
+    def test_detached_waves(self):
+        results, deployed = self.deploy(detach=True)
+        self.assertEqual([["h0", "h1"], ["h2", "h3"]],
+                         [hosts for hosts, kwargs in deployed])
+        self.assertTrue(all(kwargs["detach"] for hosts, kwargs in deployed))
+        self.assertEqual(["succeeded"] * 4,
+                         [results[host]["status"] for host in HOSTS])
+
+    def test_prefetch_waves(self):
+        results, deployed = self.deploy(phase="prefetch")
+        self.assertEqual([["h0", "h1"], ["h2", "h3"]],
+                         [hosts for hosts, kwargs in deployed])
+        self.assertEqual(["prefetch", "prefetch"],
+                         [kwargs["phase"] for hosts, kwargs in deployed])
+
+
+class PostDeployTestCase(unittest.TestCase):
+
+    def test_stage_commands_of_the_host(self):
+        stage = [({"command": "a"}, ["h0", "h1"]),
+                 ({"command": "b"}, ["h1"])]
+        with patch.object(fabfile, "run_post_deploy_command") as run_command:
+            for host, commands in (("h0", ["a"]), ("h1", ["a", "b"])):
+                run_command.reset_mock()
+                with settings(host_string=host):
+                    fabfile.run_post_deploy_stage(stage)
+                self.assertEqual(commands,
+                                 [args[0]["command"] for args, _
+                                  in run_command.call_args_list])
+
+    def test_one_execution_by_stage(self):
+        calls = []
+        commands = [{"command": "a", "concurrency": 2},
+                    {"command": "b", "after": []},
+                    {"command": "c", "run_once_on": "h3"}]
+        with settings(post_deployment=commands, hosts=HOSTS), \
+             patch.object(fabfile, "execute", fake_execute(calls)):
+            fabfile.post_deploy()
+        self.assertEqual([HOSTS, ["h3"]],
+                         [kwargs["hosts"] for task, kwargs in calls])
+
+
+class DeployTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.settings = dict(hosts=HOSTS,
+                             pidfile=os.path.join(self.folder, "pid"),
+                             state_file=os.path.join(self.folder,
+                                                     "state.json"),
+                             notifications={"start": [], "end": []},
+                             buildhost="buildhost")
+
+    def tearDown(self):
+        # deploy runs once by process otherwise
+        fabfile.deploy.wrapped.__dict__.pop("return_value", None)
+        shutil.rmtree(self.folder)
+
+    def deploy(self, failures=None, **settings_):
+        calls = []
+        with settings(**dict(self.settings, **settings_)), \
+             patch.object(fabfile, "execute",
+                          fake_execute(calls, failures)), \
+             patch.object(fabfile, "Notifier") as notifier, \
+             patch.object(fabfile, "record_deployment") as record, \
+             patch.object(fabfile, "log_deployment"):
+            notifier.return_value.close.return_value = dict.fromkeys(
+                        ("sent", "failed", "retried", "coalesced"), 0)
+            try:
+                fabfile.deploy("default", "1.2.3")
+            finally:
+                self.closed = notifier.return_value.close.called
+                self.results = record.call_args[0][3] \
+                                            if record.called else None
+        return calls
+
+    def test_deploy(self):
+        self.deploy()
+        self.assertTrue(self.closed)
+        self.assertEqual(["succeeded"] * 4,
+                         [self.results[host]["status"] for host in HOSTS])
+        self.assertFalse(os.path.exists(self.settings["pidfile"]))
+
+    def test_failed_deploy(self):
+        with self.assertRaises(SystemExit):
+            self.deploy(failures={"h1": Exception("boom")})
+        self.assertTrue(self.closed)
+        self.assertEqual({"status": "failed", "error": "boom"},
+                         self.results["h1"])
+        self.assertFalse(os.path.exists(self.settings["pidfile"]))
+
+    def test_stopped_rollout(self):
+        with self.assertRaises(SystemExit):
+            self.deploy(failures={"h1": Exception("boom")},
+                        rollout={"wave_size": 2, "max_failure_ratio": 0.1},
+                        retry={"retries": 2, "backoff": 0})
+        self.assertEqual(["succeeded", "failed", "pending", "pending"],
+                         [self.results[host]["status"] for host in HOSTS])
+        self.assertEqual(["h1", "h2", "h3"],
+                         fabfile.DeployState.load(
+                             self.settings["state_file"]).pending_hosts())
+
+    def test_stopped_prefetch(self):
+        with self.assertRaises(SystemExit):
+            self.deploy(failures={"h1": Exception("boom")}, prefetch=True,
+                        rollout={"wave_size": 2, "max_failure_ratio": 0.1})
+        # the packages of h0 were only staged
+        self.assertEqual(["pending", "failed", "pending", "pending"],
+                         [self.results[host]["status"] for host in HOSTS])
+
+    def test_failed_plan(self):
+        with patch.object(fabfile, "resolve_plan",
+                          side_effect=IOError("no manifest")), \
+             self.assertRaises(IOError):
+            self.deploy(plan=True)
+        self.assertFalse(os.path.exists(self.settings["pidfile"]))
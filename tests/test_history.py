@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mise_a_feu.lib.history import DeploymentHistory, host_records
+
+
+def host(outcome="succeeded", duration=10.0, packages=None):
+    return {"outcome": outcome, "duration": duration,
+            "phases": {"fetch": duration / 2},
+            "packages": packages or {}}
+
+
+class HostRecordsTestCase(unittest.TestCase):
+
+    def test_host_records(self):
+        events = {"host1": [{"phase": "resolved", "package": "pkg1",
+                             "installed": "1.0", "version": "1.1"},
+                            {"phase": "lookup", "start": 100, "end": 101,
+                             "duration": 1},
+                            {"phase": "lookup", "start": 101, "end": 103,
+                             "duration": 2},
+                            {"phase": "install", "start": 103, "end": 110,
+                             "duration": 7}]}
+        records = host_records({"host1": ("succeeded", None),
+                                "host2": ("failed", "timeout")}, events)
+        self.assertEqual({"outcome": "succeeded", "error": None,
+                          "duration": 10, "phases": {"lookup": 3,
+                                                     "install": 7},
+                          "packages": {"pkg1": ("1.0", "1.1")}},
+                         records["host1"])
+        self.assertEqual({"outcome": "failed", "error": "timeout",
+                          "duration": None, "phases": {}, "packages": {}},
+                         records["host2"])
+
+
+class DeploymentHistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.history = DeploymentHistory(os.path.join(self.folder, "history",
+                                                      "history.db"))
+        self.history.record("prod", "1.0", 1000, 1100, "succeeded",
+                            {"host1": host(duration=50,
+                                           packages={"pkg1": ("", "1.0"),
+                                                     "pkg2": ("", "1.0")}),
+                             "host2": host(duration=20,
+                                           packages={"pkg1": ("", "1.0")})})
+        self.history.record("prod", "1.1", 2000, 2100, "succeeded",
+                            {"host1": host(duration=10,
+                                           packages={"pkg1": ("1.0", "1.1")}),
+                             "host2": host(duration=30,
+                                           packages={"pkg1": ("1.0", "1.1")})})
+        self.history.record("prod", "1.2", 3000, 3100, "failed",
+                            {"host1": host("failed", duration=5,
+                                           packages={"pkg1": ("1.1", "1.2")}),
+                             "host2": host(duration=40,
+                                           packages={"pkg2": ("", "1.2")})})
+        self.history.record("staging", "2.0", 2500, 2600, "succeeded",
+                            {"host3": host(duration=100)})
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.folder)
+
+    def test_deployed_at(self):
+        self.assertEqual(None, self.history.deployed_at("prod", 999))
+        self.assertEqual("1.0", self.history.deployed_at("prod", 1500)["stack"])
+        self.assertEqual("1.1", self.history.deployed_at("prod", 2000)["stack"])
+        self.assertEqual("1.1", self.history.deployed_at("prod", 5000)["stack"])
+
+    def test_versions_at(self):
+        self.assertEqual({"host1": {"pkg1": "1.0", "pkg2": "1.0"},
+                          "host2": {"pkg1": "1.0"}},
+                         self.history.versions_at("prod", 1500))
+        # the failed update of host1 did not change its versions
+        self.assertEqual({"host1": {"pkg1": "1.1", "pkg2": "1.0"},
+                          "host2": {"pkg1": "1.1", "pkg2": "1.2"}},
+                         self.history.versions_at("prod", 5000))
+        self.assertEqual({"host2": {"pkg1": "1.1", "pkg2": "1.2"}},
+                         self.history.versions_at("prod", 5000, "host2"))
+
+    def test_slowest_hosts(self):
+        self.assertEqual([("host2", 30.0, 40.0, 3), ("host1", 65 / 3.0, 50.0, 3)],
+                         self.history.slowest_hosts("prod"))
+        self.assertEqual([("host2", 35.0, 40.0, 2)],
+                         self.history.slowest_hosts("prod", last=2, limit=1))
@@ -0,0 +1,69 @@
+import unittest
+
+from mise_a_feu.lib.post_deploy import schedule_post_deployment, \
+                                       stage_hosts, stage_pool_size
+
+HOSTS = ["host1", "host2", "host3"]
+
+
+def commands_of(stages):
+    return [[command["command"] for command, _ in stage] for stage in stages]
+
+
+class SchedulePostDeploymentTestCase(unittest.TestCase):
+
+    def test_sequential_by_default(self):
+        stages = schedule_post_deployment([{"command": "a"},
+                                           {"command": "b"},
+                                           {"command": "c"}], HOSTS)
+        self.assertEqual([["a"], ["b"], ["c"]], commands_of(stages))
+        self.assertEqual(HOSTS, stages[0][0][1])
+
+    def test_run_once(self):
+        stages = schedule_post_deployment([{"command": "a",
+                                            "run_once_on": "host2"},
+                                           {"command": "b",
+                                            "run_once_on": "unknown"}],
+                                          HOSTS)
+        self.assertEqual([[({"command": "a", "run_once_on": "host2"},
+                            ["host2"])], []], stages)
+
+    def test_dependencies(self):
+        stages = schedule_post_deployment([{"command": "migrate",
+                                            "run_once_on": "host1"},
+                                           {"command": "restart web",
+                                            "name": "web",
+                                            "after": "migrate"},
+                                           {"command": "restart worker",
+                                            "after": "migrate"},
+                                           {"command": "clear cache",
+                                            "after": []},
+                                           {"command": "warm up",
+                                            "after": ["web",
+                                                      "restart worker"]}],
+                                          HOSTS)
+        self.assertEqual([["migrate", "clear cache"],
+                          ["restart web", "restart worker"],
+                          ["warm up"]], commands_of(stages))
+
+    def test_circular_dependencies(self):
+        with self.assertRaises(SystemExit):
+            schedule_post_deployment([{"command": "a", "after": "b"},
+                                      {"command": "b", "after": "a"}], HOSTS)
+        with self.assertRaises(SystemExit):
+            schedule_post_deployment([{"command": "a", "after": "z"}], HOSTS)
+
+
+class StageTestCase(unittest.TestCase):
+
+    def test_stage_hosts(self):
+        self.assertEqual(["host2", "host1", "host3"],
+                         stage_hosts([({"command": "a"}, ["host2"]),
+                                      ({"command": "b"}, HOSTS)]))
+
+    def test_stage_pool_size(self):
+        self.assertEqual(None, stage_pool_size([({"command": "a"}, HOSTS)]))
+        self.assertEqual(2, stage_pool_size([
+                                ({"command": "a", "concurrency": 5}, HOSTS),
+                                ({"command": "b", "concurrency": 2}, HOSTS),
+                                ({"command": "c"}, HOSTS)]))
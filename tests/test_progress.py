@@ -0,0 +1,50 @@
+import unittest
+from StringIO import StringIO
+
+from mise_a_feu.lib.progress import ProgressStream, FleetProgress
+
+
+class ProgressStreamTestCase(unittest.TestCase):
+
+    def test_write(self):
+        batches = []
+        output = StringIO()
+        stream = ProgressStream(batches.append, output)
+        stream.write("[host1] out: INFO - reading\n[host1] out: MISE-A-")
+        stream.write('FEU-PROGRESS [{"phase": "lookup", "state": "start"}, ')
+        stream.write('{"phase": "lookup", "state": "end"}]\n[host1] out: ')
+        stream.write("MISE-A-FEU-PROGRESS not json\n")
+        self.assertEqual([[{"phase": "lookup", "state": "start"},
+                           {"phase": "lookup", "state": "end"}]], batches)
+        self.assertEqual("[host1] out: INFO - reading\n"
+                         "[host1] out: MISE-A-FEU-PROGRESS not json\n",
+                         output.getvalue())
+
+
+class FleetProgressTestCase(unittest.TestCase):
+
+    def test_summary(self):
+        fleet = FleetProgress(hosts=["host1", "host2", "host3"],
+                              stuck_after=60)
+        fleet.update("host1", [{"phase": "resolved"},
+                               {"phase": "download", "state": "start"},
+                               {"phase": "download", "state": "end",
+                                "bytes": 100}], now=1000)
+        fleet.update("host2", [{"phase": "install", "state": "end"},
+                               {"phase": "done"}], now=1000)
+        fleet.update("host3", [], now=900)
+        self.assertEqual("downloading", fleet.hosts["host1"]["state"])
+        self.assertEqual(["host3"], fleet.stuck_hosts(now=1010))
+        self.assertEqual("3 hosts: 1 done, 1 downloading, 1 starting, "
+                         "100 bytes downloaded; stuck: host3",
+                         fleet.summary(now=1010))
+
+    def test_callbacks(self):
+        output = StringIO()
+        fleet = FleetProgress(interval=0.05, output=output)
+        fleet.start()
+        fleet.callback_for("host1")([{"phase": "lookup", "state": "end"}])
+        fleet.callback_for("host2")([{"phase": "done"}])
+        fleet.stop()
+        self.assertEqual("resolving", fleet.hosts["host1"]["state"])
+        self.assertEqual("done", fleet.hosts["host2"]["state"])
@@ -0,0 +1,103 @@
+import unittest
+from mock import Mock
+
+from mise_a_feu.lib.rollout import split_waves, has_failed, WaveScheduler
+
+
+class FakeResult(str):
+    failed = False
+
+
+def deploy_with(updaters):
+    """
+    Build a wave deployment running the mocked updater of each host.
+    """
+    waves = []
+
+    def _deploy_wave(hosts):
+        waves.append(hosts)
+        return dict((host, updaters[host].run()) for host in hosts)
+    return _deploy_wave, waves
+
+
+def mock_updater(failed=False, error=None):
+    """
+    Stand-in for a StackUpdater whose run() succeeds, fails or raises.
+    """
+    updater = Mock(spec=["run", "start", "poll", "wait"])
+    if error:
+        updater.run.return_value = error
+    else:
+        updater.run.return_value = FakeResult("")
+        updater.run.return_value.failed = failed
+    return updater
+
+
+class SplitWavesTestCase(unittest.TestCase):
+
+    def test_single_wave(self):
+        self.assertEqual([["h1", "h2", "h3"]], split_waves(["h1", "h2", "h3"]))
+
+    def test_wave_size(self):
+        self.assertEqual([["h1", "h2"], ["h3"]],
+                         split_waves(["h1", "h2", "h3"], 2))
+
+    def test_wave_percentage(self):
+        hosts = ["h%s" % index for index in range(10)]
+        self.assertEqual([3, 3, 3, 1],
+                         [len(wave) for wave in split_waves(hosts, "25%")])
+        self.assertEqual([1] * 10,
+                         [len(wave) for wave in split_waves(hosts, "1%")])
+
+
+class WaveSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.hosts = ["h%s" % index for index in range(6)]
+        self.updaters = dict((host, mock_updater()) for host in self.hosts)
+
+    def test_has_failed(self):
+        self.assertFalse(has_failed(mock_updater().run()))
+        self.assertTrue(has_failed(mock_updater(failed=True).run()))
+        self.assertTrue(has_failed(mock_updater(error=SystemExit(1)).run()))
+        self.assertFalse(has_failed({"status": "succeeded", "output": {}}))
+        self.assertTrue(has_failed({"status": "failed", "error": "boom"}))
+        self.assertTrue(has_failed({"job": "1-1", "status": "running"}))
+
+    def test_all_waves(self):
+        deploy_wave, waves = deploy_with(self.updaters)
+        scheduler = WaveScheduler(self.hosts, wave_size=2, max_concurrency=2)
+        results = scheduler.run(deploy_wave)
+        self.assertEqual(self.hosts, sorted(results))
+        self.assertEqual([["h0", "h1"], ["h2", "h3"], ["h4", "h5"]], waves)
+        for updater in self.updaters.values():
+            updater.run.assert_called_once_with()
+
+    def test_stop_on_failures(self):
+        self.updaters["h2"] = mock_updater(failed=True)
+        deploy_wave, waves = deploy_with(self.updaters)
+        scheduler = WaveScheduler(self.hosts, wave_size="50%",
+                                  max_failure_ratio=0.2)
+        with self.assertRaises(SystemExit):
+            scheduler.run(deploy_wave)
+        self.assertEqual(1, len(waves))
+        self.assertFalse(self.updaters["h3"].run.called)
+
+    def test_tolerated_failures(self):
+        self.updaters["h2"] = mock_updater(error=Exception("boom"))
+        deploy_wave, waves = deploy_with(self.updaters)
+        scheduler = WaveScheduler(self.hosts, wave_size="50%",
+                                  max_failure_ratio=0.5)
+        results = scheduler.run(deploy_wave)
+        self.assertEqual(2, len(waves))
+        self.assertTrue(has_failed(results["h2"]))
+
+    def test_closed_gate(self):
+        deploy_wave, waves = deploy_with(self.updaters)
+        gate = Mock(return_value=False)
+        scheduler = WaveScheduler.from_config(self.hosts, {"wave_size": 3},
+                                              gate=gate)
+        with self.assertRaises(SystemExit):
+            scheduler.run(deploy_wave)
+        self.assertEqual(1, len(waves))
+        gate.assert_called_once_with()
@@ -1,11 +1,28 @@
+import hashlib
+import tempfile
 import unittest
 from mock import patch
+from fabric.api import settings
 
 with patch('fabric.api.sudo') as sudo_mock:
     from mise_a_feu.lib.stack_updater import StackUpdater
 
-def run_single_assert_command(updater, command):
-    updater.run()
+from mise_a_feu.lib.rollout import has_failed
+from test_update_stack import LocalAgent, StubBuildhost
+
+
+class FakeOutput(str):
+    """
+    Output of a command ran with fabric.
+    """
+    def __new__(cls, output, failed=False):
+        output = str.__new__(cls, output)
+        output.failed = failed
+        return output
+
+
+def run_single_assert_command(updater, command, method="run"):
+    getattr(updater, method)()
     sudo_mock.assert_called_with(command)
     sudo_mock.reset_mock()
 
@@ -55,3 +72,301 @@ class StackUpdaterTestCase(unittest.TestCase):
                                                verbose=True),
             "/root/tools/update_stack.py --verbose --web-callback http://host.foo/bar /etc/manifests.cfg buildhost-64 default 1.2.3")
 
+
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               jobs=8),
+            "/root/tools/update_stack.py --jobs 8 /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               batch=True),
+            "/root/tools/update_stack.py --batch /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               jobs=8, download_jobs=3),
+            "/root/tools/update_stack.py --jobs 8 --download-jobs 3 /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               cache_dir="/var/cache/debs",
+                                               cache_max_bytes=1024),
+            "/root/tools/update_stack.py --cache-dir /var/cache/debs --cache-max-bytes 1024 /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               cache_max_entries=100),
+            "/root/tools/update_stack.py --cache-max-entries 100 /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               strategy="upgrade"),
+            "/root/tools/update_stack.py --strategy upgrade /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+    def test_phases(self):
+        updater = StackUpdater("default", "1.2.3", "buildhost-64",
+                               "/etc/manifests.cfg", verbose=True)
+        run_single_assert_command(updater,
+            "/root/tools/update_stack.py --prefetch --verbose /etc/manifests.cfg buildhost-64 default 1.2.3",
+            method="prefetch")
+        run_single_assert_command(updater,
+            "/root/tools/update_stack.py --staged --verbose /etc/manifests.cfg buildhost-64 default 1.2.3",
+            method="install_staged")
+
+    def test_detached_job(self):
+        updater = StackUpdater("default", "1.2.3", "buildhost-64",
+                               "/etc/manifests.cfg")
+        sudo_mock.return_value = "1-1\n"
+        self.assertEqual("1-1", updater.start())
+        sudo_mock.assert_called_with("/root/tools/update_stack.py --detach /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+        sudo_mock.return_value = '{"job": "1-1", "status": "succeeded"}'
+        self.assertEqual("succeeded", updater.wait(interval=0)["status"])
+        sudo_mock.assert_called_with("/root/tools/update_stack.py --status 1-1")
+        sudo_mock.reset_mock()
+
+    def test_wait_timeout(self):
+        updater = StackUpdater("default", "1.2.3", "buildhost-64",
+                               "/etc/manifests.cfg")
+        sudo_mock.return_value = '{"job": "1-1", "status": "running"}'
+        self.assertEqual("running",
+                         updater.wait("1-1", interval=0, timeout=0)["status"])
+        sudo_mock.reset_mock()
+
+    def test_peers(self):
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               peers=["host1:8765",
+                                                      "host2:8765"]),
+            "/root/tools/update_stack.py --peers host1:8765,host2:8765 /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+        updater = StackUpdater("default", "1.2.3", "buildhost-64",
+                               "/etc/manifests.cfg", cache_dir="/var/cache/debs")
+        sudo_mock.return_value = "2-2\n"
+        self.assertEqual("2-2", updater.serve(8765, duration=600))
+        sudo_mock.assert_called_with("/root/tools/update_stack.py --detach --serve 8765 --serve-for 600 --cache-dir /var/cache/debs")
+        updater.serve(8765, bind="10.0.0.1")
+        sudo_mock.assert_called_with("/root/tools/update_stack.py --detach --serve 8765 --serve-bind 10.0.0.1 --cache-dir /var/cache/debs")
+        sudo_mock.return_value = '{"job": "2-2", "status": "stopped"}'
+        self.assertEqual("stopped", updater.stop("2-2")["status"])
+        sudo_mock.assert_called_with("/root/tools/update_stack.py --stop 2-2")
+        sudo_mock.reset_mock()
+
+    def test_rollback(self):
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               retain_dir="/srv/retained"),
+            "/root/tools/update_stack.py --rollback --retain-dir /srv/retained /etc/manifests.cfg buildhost-64 default 1.2.3",
+            method="rollback")
+
+    def test_deltas(self):
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               deltas=True),
+            "/root/tools/update_stack.py --deltas /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+    def test_timeouts(self):
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               connect_timeout=5,
+                                               read_timeout=30),
+            "/root/tools/update_stack.py --connect-timeout 5 --read-timeout 30 /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+    def test_dry_run(self):
+        updater = StackUpdater("default", "1.2.3", "buildhost-64",
+                               "/etc/manifests.cfg")
+        sudo_mock.return_value = '{"changes": [], "download_bytes": 0}'
+        self.assertEqual({"changes": [], "download_bytes": 0},
+                         updater.dry_run())
+        sudo_mock.assert_called_with("/root/tools/update_stack.py --plan-only /etc/manifests.cfg buildhost-64 default 1.2.3")
+        sudo_mock.reset_mock()
+
+    def test_lookup_cache(self):
+        run_single_assert_command(StackUpdater("default",
+                                               "1.2.3",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               lookup_cache=False),
+            "/root/tools/update_stack.py --no-lookup-cache /etc/manifests.cfg buildhost-64 default 1.2.3")
+        run_single_assert_command(StackUpdater("default",
+                                               "latest",
+                                               "buildhost-64",
+                                               "/etc/manifests.cfg",
+                                               lookup_ttl=300),
+            "/root/tools/update_stack.py --lookup-ttl 300 /etc/manifests.cfg buildhost-64 default latest")
+
+    def test_progress(self):
+        updater = StackUpdater("default", "1.2.3", "buildhost-64",
+                               "/etc/manifests.cfg")
+        batches = []
+        updater.run(progress=batches.append)
+        args, kwargs = sudo_mock.call_args
+        self.assertEqual(("/root/tools/update_stack.py --progress /etc/manifests.cfg buildhost-64 default 1.2.3",), args)
+        kwargs["stdout"].write('MISE-A-FEU-PROGRESS [{"phase": "done"}]\n')
+        self.assertEqual([[{"phase": "done"}]], batches)
+        sudo_mock.reset_mock()
+
+    def test_timings(self):
+        updater = StackUpdater("default", "1.2.3", "buildhost-64",
+                               "/etc/manifests.cfg",
+                               timings="/tmp/timings.jsonl")
+        run_single_assert_command(updater,
+            "/root/tools/update_stack.py --timings /tmp/timings.jsonl /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+        sudo_mock.return_value = FakeOutput(
+            '{"phase": "install", "duration": 1.5}\n'
+            '{"phase": "remove", "duration": 0.5}\n')
+        self.assertEqual([{"phase": "install", "duration": 1.5},
+                          {"phase": "remove", "duration": 0.5}],
+                         updater.collect_timings())
+        sudo_mock.assert_called_with("cat /tmp/timings.jsonl && rm -f /tmp/timings.jsonl")
+        sudo_mock.return_value = FakeOutput("", failed=True)
+        self.assertEqual([], updater.collect_timings())
+        sudo_mock.reset_mock()
+
+    def test_upload(self):
+        script = tempfile.NamedTemporaryFile()
+        script.write("print 'update'\n")
+        script.flush()
+        checksum = hashlib.sha256("print 'update'\n").hexdigest()
+        updater = StackUpdater(None, None, None)
+        with patch('mise_a_feu.lib.stack_updater.put') as put_mock:
+            sudo_mock.return_value = FakeOutput(
+                "%s  /root/tools/update_stack.py" % checksum)
+            self.assertFalse(updater.upload(script.name))
+            sudo_mock.assert_called_once_with("sha256sum /root/tools/update_stack.py")
+            self.assertFalse(put_mock.called)
+            sudo_mock.reset_mock()
+
+            sudo_mock.return_value = FakeOutput("no such file", failed=True)
+            self.assertTrue(updater.upload(script.name))
+            put_mock.assert_called_once_with(script.name,
+                                             "/root/tools/update_stack.py",
+                                             mirror_local_mode=False,
+                                             use_sudo=True)
+            sudo_mock.assert_called_with("chown root:root /root/tools/update_stack.py && chmod 770 /root/tools/update_stack.py")
+            self.assertEqual(2, sudo_mock.call_count)
+        sudo_mock.reset_mock()
+
+    def test_plan(self):
+        updater = StackUpdater("default", "1.2.3", "buildhost-64",
+                               "/etc/manifests.cfg")
+        with patch('mise_a_feu.lib.stack_updater.put') as put_mock:
+            self.assertEqual("/tmp/plan-default-1.2.3.json",
+                             updater.push_plan("plans/plan-default-1.2.3.json"))
+            put_mock.assert_called_with("plans/plan-default-1.2.3.json",
+                                        "/tmp/plan-default-1.2.3.json",
+                                        use_sudo=True)
+        run_single_assert_command(updater,
+            "/root/tools/update_stack.py --plan /tmp/plan-default-1.2.3.json /etc/manifests.cfg buildhost-64 default 1.2.3")
+
+    def test_agent(self):
+        updater = StackUpdater(None, None, None, cache_dir="/var/cache/debs")
+        sudo_mock.return_value = "3-3\n"
+        self.assertEqual("3-3", updater.start_agent(8766, "/root/tools/agent.token"))
+        self.assertEqual([(("/root/tools/update_stack.py --detach --agent 8766 --agent-token-file /root/tools/agent.token --timings /var/cache/mise-a-feu/agent-timings.jsonl --cache-dir /var/cache/debs",),),
+                          (("echo 3-3 > /root/tools/agent.job",),)],
+                         sudo_mock.call_args_list)
+        sudo_mock.reset_mock()
+        sudo_mock.side_effect = [FakeOutput("3-3\n"),
+                                 '{"job": "3-3", "status": "stopped"}', ""]
+        self.assertEqual("stopped", updater.stop_agent()["status"])
+        self.assertEqual([(("cat /root/tools/agent.job",),),
+                          (("/root/tools/update_stack.py --stop 3-3",),),
+                          (("rm -f /root/tools/agent.job",),)],
+                         sudo_mock.call_args_list)
+        sudo_mock.reset_mock()
+        sudo_mock.side_effect = [FakeOutput("", failed=True)]
+        self.assertEqual("unknown", updater.stop_agent()["status"])
+        sudo_mock.side_effect = None
+        sudo_mock.reset_mock()
+
+
+class AgentTransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.buildhost = StubBuildhost({
+            "/domains/default/stacks/1.2.3/packages/mise-a-feu-test/version":
+                "1.0.0",
+            "/packages/mise-a-feu-test/version/1.0.0/file":
+                "mise-a-feu-test-1.0.0-amd64.deb",
+            "/debs/mise-a-feu-test-1.0.0-amd64.deb": "package"})
+        self.manifest = tempfile.NamedTemporaryFile()
+        self.manifest.write("mise-a-feu-test\n")
+        self.manifest.flush()
+        self.agent = LocalAgent(token="secret")
+
+    def tearDown(self):
+        self.agent.stop()
+        self.manifest.close()
+        self.buildhost.stop()
+
+    def test_dry_run(self):
+        updater = StackUpdater("default", "1.2.3", self.buildhost.address,
+                               self.manifest.name,
+                               lookup_cache=False,
+                               timings="/tmp/timings.jsonl",
+                               retain_dir="/srv/retained",
+                               agent=self.agent.port,
+                               agent_token="secret")
+        with settings(host_string="root@127.0.0.1:22"):
+            self.assertEqual(0, updater.agent_status()["updates"])
+            plan = updater.dry_run()
+        self.assertEqual(["mise-a-feu-test"],
+                         [change["package"] for change in plan["changes"]])
+        self.assertEqual(7, plan["download_bytes"])
+        self.assertFalse(sudo_mock.called)
+
+    def test_token_required(self):
+        updater = StackUpdater("default", "1.2.3", self.buildhost.address,
+                               self.manifest.name,
+                               agent=self.agent.address)
+        with self.assertRaises(SystemExit):
+            updater.run()
+        self.assertEqual([], self.buildhost.requests)
+
+    def test_failed_update(self):
+        self.buildhost.routes[
+            "/domains/default/stacks/1.2.3/packages/mise-a-feu-test/version"
+        ] = 500
+        updater = StackUpdater("default", "1.2.3", self.buildhost.address,
+                               self.manifest.name,
+                               lookup_cache=False,
+                               agent=self.agent.address,
+                               agent_token="secret")
+        with settings(command_timeout=30):
+            result = updater.run()
+        self.assertEqual("failed", result["status"])
+        self.assertTrue("500" in result["error"])
+        self.assertTrue(has_failed(result))
+
+    def test_unauthorized(self):
+        updater = StackUpdater("default", "1.2.3", self.buildhost.address,
+                               self.manifest.name,
+                               agent=self.agent.address,
+                               agent_token="other")
+        result = updater.run()
+        self.assertEqual("failed", result["status"])
+        self.assertTrue("401" in result["error"])
+        self.assertEqual([], self.buildhost.requests)
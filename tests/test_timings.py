@@ -0,0 +1,38 @@
+import unittest
+
+from mise_a_feu.lib.timings import percentile, summarize_timings, \
+                                   format_timings
+
+
+class PercentileTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, percentile(values, 0.5))
+        self.assertEqual(95, percentile(values, 0.95))
+        self.assertEqual(100, percentile(values, 1))
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual(7, percentile([7], 0.95))
+        self.assertEqual(None, percentile([], 0.5))
+
+
+class SummarizeTimingsTestCase(unittest.TestCase):
+
+    def test_summarize(self):
+        events = [{"phase": "download", "duration": float(index),
+                   "bytes": 10, "package": "pkg%s.deb" % index}
+                  for index in range(1, 21)]
+        events += [{"phase": "install", "duration": 3.0, "exit_code": 0},
+                   {"phase": "install", "duration": 5.0, "exit_code": 1}]
+        summary = summarize_timings(events)
+        self.assertEqual({"count": 20, "p50": 10.0, "p95": 19.0,
+                          "max": 20.0, "bytes": 200},
+                         summary["download"])
+        self.assertEqual({"count": 2, "p50": 3.0, "p95": 5.0,
+                          "max": 5.0, "bytes": 0},
+                         summary["install"])
+
+        lines = format_timings(summary).splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual(["download", "20", "10.00s", "19.00s", "20.00s",
+                          "200"], lines[1].split())
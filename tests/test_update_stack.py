@@ -0,0 +1,1274 @@
+import os
+import json
+import base64
+import sys
+import socket
+import struct
+import hashlib
+import shutil
+import tempfile
+import subprocess
+import threading
+import time
+import unittest
+import urllib2
+import httplib
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+from mock import patch
+
+from mise_a_feu.scripts import update_stack
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+class StubBuildhostHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self._dispatch(None)
+
+    def do_HEAD(self):
+        self._dispatch(None)
+
+    def do_POST(self):
+        length = int(self.headers.getheader("Content-Length", 0))
+        self._dispatch(self.rfile.read(length))
+
+    def _dispatch(self, body):
+        self.server.requests.append(self.path)
+        route = self.server.routes.get(self.path)
+        if route is None:
+            self._reply(404, "not found")
+        elif callable(route):
+            self._reply(200, route(body))
+        elif isinstance(route, int):
+            self._reply(route, "")
+        elif self.headers.getheader("If-None-Match") == '"%s"' % hash(route):
+            self._reply(304, "")
+        elif self.headers.getheader("Range"):
+            offset = int(self.headers.getheader("Range")[6:-1])
+            self.server.ranges.append(offset)
+            if offset >= len(route):
+                self._reply(416, "")
+            else:
+                self._reply(206, route[offset:])
+        else:
+            self._reply(200, route, etag='"%s"' % hash(route))
+
+    def _reply(self, code, body, etag=None):
+        self.send_response(code)
+        if etag:
+            self.send_header("ETag", etag)
+        for header, value in self.server.headers.get(self.path, {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_delta(base, target, block_size=1024):
+    """
+    Delta of target against base in the format of update_stack, reusing
+    the blocks of base found anywhere in target.
+    """
+    blocks = {}
+    for offset in range(0, len(base) - block_size + 1, block_size):
+        blocks.setdefault(base[offset:offset + block_size], offset)
+    delta = []
+    data = []
+    position = 0
+    while position < len(target):
+        offset = blocks.get(target[position:position + block_size])
+        if offset is None:
+            data.append(target[position])
+            position += 1
+            continue
+        if data:
+            delta.append("D" + struct.pack(">I", len(data)) + "".join(data))
+            data = []
+        delta.append("C" + struct.pack(">QI", offset, block_size))
+        position += block_size
+    if data:
+        delta.append("D" + struct.pack(">I", len(data)) + "".join(data))
+    return "".join(delta)
+
+
+class StubBuildhost(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local buildhost answering the registered paths (a string, or a function
+    of the request body) with their extra headers, counting the requests and
+    TCP connections.
+    """
+    def __init__(self, routes=None, handler=StubBuildhostHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        self.routes = routes or {}
+        self.headers = {}
+        self.requests = []
+        self.ranges = []
+        self.connections = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def address(self):
+        return "127.0.0.1:%s" % self.server_address[1]
+
+
+class LocalAgent(object):
+    """
+    update_stack --agent running in a separate process on a free port.
+    """
+    def __init__(self, token, *options):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        self.port = listener.getsockname()[1]
+        listener.close()
+        self.token = token
+        self.token_file = tempfile.NamedTemporaryFile()
+        self.token_file.write(token + "\n")
+        self.token_file.flush()
+        command = [sys.executable,
+                   os.path.splitext(update_stack.__file__)[0] + ".py",
+                   "--agent", str(self.port), "--agent-bind", "127.0.0.1",
+                   "--agent-token-file", self.token_file.name] + \
+                  list(options)
+        with open(os.devnull, "w") as devnull:
+            self.process = subprocess.Popen(command, stdout=devnull,
+                                            stderr=devnull)
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", self.port)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+
+    @property
+    def address(self):
+        return "127.0.0.1:%s" % self.port
+
+    def request(self, path, data=None, token=None):
+        headers = {"Authorization": "Bearer %s" % (token or self.token)}
+        request = urllib2.Request("http://%s%s" % (self.address, path),
+                                  json.dumps(data) if data else None, headers)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            return e.code, json.loads(e.read())
+        return response.code, json.loads(response.read())
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.token_file.close()
+
+
+class GetLocalVersionsTestCase(unittest.TestCase):
+
+    def test_read_status_file(self):
+        versions = update_stack.get_local_versions(
+                                os.path.join(DATA_DIR, "dpkg_status"))
+        self.assertEqual({"pkg1": "1.0.0", "pkg2": "2.0.0-1"}, versions)
+
+    def test_missing_status_file(self):
+        versions = update_stack.get_local_versions(
+                                os.path.join(DATA_DIR, "does_not_exist"))
+        self.assertEqual(None, versions)
+
+    def test_status_file_parsed_once(self):
+        status_file = tempfile.NamedTemporaryFile()
+        with open(os.path.join(DATA_DIR, "dpkg_status")) as status:
+            status_file.write(status.read())
+        status_file.flush()
+        with patch.object(update_stack, "_parse_dpkg_status",
+                          wraps=update_stack._parse_dpkg_status) as parse:
+            for _ in range(3):
+                versions = update_stack.get_local_versions(status_file.name)
+            versions["pkg3"] = "3.0.0"
+            self.assertEqual({"pkg1": "1.0.0", "pkg2": "2.0.0-1"},
+                             update_stack.get_local_versions(status_file.name))
+            self.assertEqual(1, parse.call_count)
+
+            status_file.write("\nPackage: pkg3\nStatus: install ok installed"
+                              "\nVersion: 3.0.0\n")
+            status_file.flush()
+            self.assertEqual(versions,
+                             update_stack.get_local_versions(status_file.name))
+            self.assertEqual(2, parse.call_count)
+        status_file.close()
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.buildhost = StubBuildhost({"/foo": "bar\n"})
+
+    def tearDown(self):
+        self.buildhost.stop()
+
+    def test_connection_reused(self):
+        pool = update_stack.ConnectionPool()
+        url = "http://%s/foo" % self.buildhost.address
+        for _ in range(3):
+            self.assertEqual("bar\n", pool.request("GET", url))
+        self.assertEqual(1, self.buildhost.connections)
+
+    def test_http_error(self):
+        pool = update_stack.ConnectionPool()
+        with self.assertRaises(urllib2.HTTPError):
+            pool.request("GET", "http://%s/missing" % self.buildhost.address)
+
+    def test_read_timeout(self):
+        self.buildhost.routes["/slow"] = lambda body: time.sleep(1) or ""
+        pool = update_stack.ConnectionPool(timeout=5, read_timeout=0.1)
+        started = time.time()
+        with self.assertRaises(socket.timeout):
+            pool.request("GET", "http://%s/slow" % self.buildhost.address)
+        self.assertTrue(time.time() - started < 1)
+        pool.close()
+
+    def test_redirect_followed(self):
+        self.buildhost.routes["/moved"] = 302
+        self.buildhost.headers["/moved"] = {"Location": "/foo"}
+        pool = update_stack.ConnectionPool()
+        self.assertEqual("bar\n", pool.request(
+            "GET", "http://%s/moved" % self.buildhost.address))
+        self.assertEqual(["/moved", "/foo"], self.buildhost.requests)
+        pool.close()
+
+    def test_post_not_retried(self):
+        pool = update_stack.ConnectionPool()
+        url = "http://%s/foo" % self.buildhost.address
+        with patch.object(httplib.HTTPConnection, "getresponse",
+                          side_effect=httplib.BadStatusLine("")) as response:
+            with self.assertRaises(httplib.BadStatusLine):
+                pool.request("POST", url, "{}")
+            self.assertEqual(1, response.call_count)
+            with self.assertRaises(httplib.BadStatusLine):
+                pool.request("GET", url)
+            self.assertEqual(3, response.call_count)
+
+    def test_proxy(self):
+        self.buildhost.routes["http://buildhost/foo"] = "proxied\n"
+        pool = update_stack.ConnectionPool()
+        with patch.dict(os.environ, {"http_proxy": "http://%s" %
+                                                   self.buildhost.address,
+                                     "no_proxy": ""}), \
+             patch.object(urllib2, "_opener", None):
+            self.assertEqual("proxied\n", pool.request("GET",
+                                                        "http://buildhost/foo"))
+        self.assertEqual(["http://buildhost/foo"], self.buildhost.requests)
+        self.assertEqual(0, len(pool._local.__dict__.get("connections", {})))
+
+
+class ResolutionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.buildhost = StubBuildhost()
+        self.local_versions = {}
+        self.remote_packages = {}
+        for index in range(20):
+            package = "pkg%s" % index
+            version = "1.0.%s" % index
+            self.buildhost.routes.update({
+                "/domains/default/stacks/latest/packages/%s/version" % package:
+                    version,
+                "/packages/%s/version/%s/file" % (package, version):
+                    "%s-%s-amd64.deb" % (package, version)})
+            self.local_versions[package] = version if index % 2 else "0.0.1"
+            self.buildhost.routes["/debs/%s-%s-amd64.deb" % (package,
+                                                             version)] = package
+            self.remote_packages[package] = {
+                "version": version,
+                "file": "%s-%s-amd64.deb" % (package, version)}
+        self.manifest = tempfile.NamedTemporaryFile()
+        self.manifest.write("\n".join(sorted(self.local_versions)))
+        self.manifest.flush()
+
+    def tearDown(self):
+        update_stack.http_pool.close()
+        update_stack.lookup_cache = None
+        self.manifest.close()
+        self.buildhost.stop()
+
+    def run_main(self, **kwargs):
+        with patch.object(update_stack, "get_local_versions",
+                          lambda: self.local_versions), \
+             patch.object(update_stack, "download_package") as download, \
+             patch.object(update_stack, "_shell_run",
+                          return_value=0) as shell_run:
+            output = update_stack.main(self.manifest.name,
+                                       self.buildhost.address,
+                                       "default",
+                                       **kwargs)
+
+        self.assertEqual(dict(("pkg%s" % index,
+                               "pkg%s-1.0.%s-amd64.deb" % (index, index))
+                              for index in range(0, 20, 2)),
+                         output)
+        self.assertEqual(10, download.call_count)
+        return shell_run
+
+    def test_concurrent_resolution(self):
+        shell_run = self.run_main(jobs=4)
+        self.assertEqual(2, shell_run.call_count)
+        self.assertEqual(30, len(self.buildhost.requests))
+        self.assertTrue(self.buildhost.connections <= 4)
+
+    def test_batch_resolution(self):
+        def _resolve_stack(body):
+            return json.dumps(dict((package, self.remote_packages[package])
+                              for package in json.loads(body)["packages"]))
+        self.buildhost.routes["/domains/default/stacks/latest/packages"] = \
+                                                            _resolve_stack
+        self.run_main(batch=True)
+        self.assertEqual(["/domains/default/stacks/latest/packages"],
+                         self.buildhost.requests)
+
+    def test_batch_resolution_not_supported(self):
+        self.run_main(batch=True)
+        self.assertEqual("/domains/default/stacks/latest/packages",
+                         self.buildhost.requests[0])
+        self.assertEqual(31, len(self.buildhost.requests))
+
+    def test_plan(self):
+        self.buildhost.routes[
+                    "/domains/default/stacks/latest/packages/gone/version"] = ""
+        plan_file = tempfile.NamedTemporaryFile()
+        plan = update_stack.write_plan(plan_file.name,
+                                       self.buildhost.address,
+                                       sorted(self.local_versions) + ["gone"],
+                                       "default")
+        self.assertEqual(41, len(self.buildhost.requests))
+        self.assertEqual({"version": "", "file": None},
+                         plan["packages"]["gone"])
+        self.assertEqual(self.remote_packages["pkg3"],
+                         plan["packages"]["pkg3"])
+
+        self.run_main(plan_file=plan_file.name)
+        self.assertEqual(41, len(self.buildhost.requests))
+
+        with self.assertRaises(Exception):
+            self.run_main(plan_file=plan_file.name, stack="1.2.3")
+        self.assertEqual(41, len(self.buildhost.requests))
+
+    def test_package_missing_from_plan(self):
+        plan_file = tempfile.NamedTemporaryFile()
+        update_stack.write_plan(plan_file.name, self.buildhost.address,
+                                ["pkg%s" % index for index in range(10)],
+                                "default")
+        self.assertEqual(20, len(self.buildhost.requests))
+        self.run_main(plan_file=plan_file.name)
+        self.assertEqual(35, len(self.buildhost.requests))
+
+    def test_timings(self):
+        timings = tempfile.NamedTemporaryFile()
+        with patch.object(update_stack, "get_local_versions",
+                          lambda: self.local_versions), \
+             patch.object(update_stack, "download_package",
+                          return_value=4), \
+             patch.object(update_stack, "_shell_run", return_value=0):
+            update_stack.main(self.manifest.name,
+                              self.buildhost.address,
+                              "default",
+                              timings=timings.name)
+        update_stack.timing_file = None
+
+        events = [json.loads(line) for line in open(timings.name)]
+        phases = [event["phase"] for event in events]
+        self.assertEqual(20, phases.count("lookup"))
+        self.assertEqual(10, phases.count("download"))
+        self.assertEqual(10, phases.count("resolved"))
+        self.assertEqual(["local_versions", "fetch", "remove", "install",
+                          "downtime"],
+                         [phase for phase in phases
+                          if phase not in ("lookup", "download", "resolved")])
+        self.assertEqual({"phase": "resolved", "package": "pkg4",
+                          "installed": "0.0.1", "version": "1.0.4"},
+                         dict((key, value) for event in events
+                              if event.get("package") == "pkg4" and
+                                 event["phase"] == "resolved"
+                              for key, value in event.items()
+                              if key != "time"))
+        events = [event for event in events if event["phase"] != "resolved"]
+        for event in events:
+            self.assertTrue(event["end"] >= event["start"])
+            self.assertAlmostEqual(event["end"] - event["start"],
+                                   event["duration"])
+        self.assertEqual(40, sum(event.get("bytes", 0) for event in events))
+        self.assertEqual(0, events[-2]["exit_code"])
+        self.assertEqual(10, events[-1]["packages"])
+
+    def test_lookup_cache_pinned_stack(self):
+        for path, answer in self.buildhost.routes.items():
+            if "/stacks/latest/" in path:
+                self.buildhost.routes[path.replace("/latest/", "/1.2.3/")] = \
+                                                                        answer
+        # pkg19 is no longer in the stack
+        self.buildhost.routes[
+                "/domains/default/stacks/1.2.3/packages/pkg19/version"] = ""
+        lookups = tempfile.NamedTemporaryFile()
+        self.run_main(stack="1.2.3", lookup_cache_file=lookups.name)
+        self.assertEqual(30, len(self.buildhost.requests))
+        version = self.buildhost.routes.pop(
+                "/domains/default/stacks/1.2.3/packages/pkg1/version")
+        self.run_main(stack="1.2.3", lookup_cache_file=lookups.name)
+        self.assertEqual(30, len(self.buildhost.requests))
+
+        self.buildhost.routes[
+                "/domains/default/stacks/1.2.3/packages/pkg1/version"] = version
+        update_stack.lookup_cache = None
+        self.run_main(stack="1.2.3")
+        self.assertEqual(60, len(self.buildhost.requests))
+
+    def test_lookup_cache_latest_stack(self):
+        lookups = tempfile.NamedTemporaryFile()
+        self.run_main(lookup_cache_file=lookups.name)
+        self.assertEqual(30, len(self.buildhost.requests))
+        self.run_main(lookup_cache_file=lookups.name)
+        self.assertEqual(30, len(self.buildhost.requests))
+
+        # expired, the versions are revalidated but the file names are not
+        self.run_main(lookup_cache_file=lookups.name, lookup_ttl=0)
+        self.assertEqual(50, len(self.buildhost.requests))
+
+    def test_lookup_cache_missing(self):
+        lookups = update_stack.LookupCache(os.devnull)
+        url = "http://%s/debs/pkg0.deb.sha256" % self.buildhost.address
+        for _ in range(2):
+            with self.assertRaises(urllib2.HTTPError):
+                lookups.read(url, immutable=True)
+        self.assertEqual(1, len(self.buildhost.requests))
+
+        # published since, and the 404 expired
+        self.buildhost.routes["/debs/pkg0.deb.sha256"] = "0123"
+        lookups.ttl = 0
+        self.assertEqual("0123", lookups.read(url, immutable=True))
+
+    def test_lookup_cache_batch(self):
+        def _resolve_stack(body):
+            return json.dumps(dict((package, self.remote_packages[package])
+                              for package in json.loads(body)["packages"]))
+        self.buildhost.routes["/domains/default/stacks/1.2.3/packages"] = \
+                                                            _resolve_stack
+        lookups = tempfile.NamedTemporaryFile()
+        self.run_main(stack="1.2.3", batch=True,
+                      lookup_cache_file=lookups.name)
+        self.run_main(stack="1.2.3", batch=True,
+                      lookup_cache_file=lookups.name)
+        self.assertEqual(["/domains/default/stacks/1.2.3/packages"],
+                         self.buildhost.requests)
+
+    def test_progress(self):
+        output = StringIO()
+        with patch.object(update_stack, "get_local_versions",
+                          lambda: self.local_versions), \
+             patch.object(update_stack, "download_package",
+                          return_value=4), \
+             patch.object(update_stack, "_shell_run", return_value=0), \
+             patch("sys.stdout", output):
+            update_stack.main(self.manifest.name,
+                              self.buildhost.address,
+                              "default",
+                              progress=True)
+            update_stack.progress_reporter.close()
+        update_stack.progress_reporter = None
+
+        batches = [json.loads(line[len(update_stack.PROGRESS_MARKER):])
+                   for line in output.getvalue().splitlines()
+                   if line.startswith(update_stack.PROGRESS_MARKER)]
+        events = sum(batches, [])
+        self.assertEqual(10, len([event for event in events
+                                  if event["phase"] == "resolved"]))
+        self.assertEqual({"phase": "install", "state": "start",
+                          "packages": 10},
+                         dict((key, value) for key, value
+                              in events[-4].items() if key != "time"))
+        self.assertEqual("done", events[-1]["phase"])
+
+    def test_plan_only(self):
+        self.buildhost.routes[
+                    "/domains/default/stacks/latest/packages/pkg19/version"] = ""
+        with patch.object(update_stack, "get_local_versions",
+                          lambda: self.local_versions), \
+             patch.object(update_stack, "download_package") as download, \
+             patch.object(update_stack, "_shell_run",
+                          return_value=0) as shell_run:
+            report = update_stack.main(self.manifest.name,
+                                       self.buildhost.address,
+                                       "default",
+                                       plan_only=True)
+        self.assertFalse(download.called)
+        self.assertFalse(shell_run.called)
+        changes = dict((change["package"], change)
+                       for change in report["changes"])
+        self.assertEqual(11, len(changes))
+        self.assertEqual({"package": "pkg2",
+                          "action": "install",
+                          "installed": "0.0.1",
+                          "version": "1.0.2",
+                          "file": "pkg2-1.0.2-amd64.deb",
+                          "size": len("pkg2"),
+                          "cached": False},
+                         changes["pkg2"])
+        self.assertEqual("remove", changes["pkg19"]["action"])
+        self.assertEqual(sum(len("pkg%s" % index)
+                             for index in range(0, 20, 2)),
+                         report["download_bytes"])
+
+    def run_strategy(self, strategy):
+        self.buildhost.routes[
+                    "/domains/default/stacks/latest/packages/pkg19/version"] = ""
+        with patch.object(update_stack, "get_local_versions",
+                          lambda: self.local_versions), \
+             patch.object(update_stack, "download_package"), \
+             patch.object(update_stack, "_shell_run",
+                          return_value=0) as shell_run:
+            output = update_stack.main(self.manifest.name,
+                                       self.buildhost.address,
+                                       "default",
+                                       strategy=strategy)
+        self.assertEqual(10, len(output))
+        self.assertFalse("pkg19" in output)
+        return [args[0] for args, _ in shell_run.call_args_list]
+
+    def test_remove_install_strategy(self):
+        commands = self.run_strategy("remove-install")
+        self.assertEqual(2, len(commands))
+        self.assertEqual(12, len(commands[0].split()))
+        self.assertTrue(commands[0].startswith("dpkg -r pkg0 "))
+        self.assertFalse("pkg19" in commands[0])
+
+    def test_upgrade_strategy(self):
+        commands = self.run_strategy("upgrade")
+        self.assertEqual(2, len(commands))
+        self.assertEqual("dpkg -r pkg19", commands[0])
+        self.assertTrue(commands[1].startswith("dpkg --force-overwrite -i "))
+
+    def test_unknown_stack(self):
+        with patch.object(update_stack, "get_local_versions",
+                          lambda: self.local_versions), \
+             patch.object(update_stack, "download_package"), \
+             patch.object(update_stack, "_shell_run",
+                          return_value=0) as shell_run:
+            with self.assertRaises(urllib2.HTTPError):
+                update_stack.main(self.manifest.name, self.buildhost.address,
+                                  "default", stack="1.2.4")
+        self.assertFalse(shell_run.called)
+
+    def test_prefetch_then_install_staged(self):
+        folder = tempfile.mkdtemp()
+        try:
+            with patch.object(update_stack, "base_folder", folder), \
+                 patch.object(update_stack, "get_local_versions",
+                              lambda: self.local_versions), \
+                 patch.object(update_stack, "_shell_run",
+                              return_value=0) as shell_run:
+                prefetched = update_stack.main(self.manifest.name,
+                                               self.buildhost.address,
+                                               "default",
+                                               prefetch=True)
+                self.assertEqual(0, shell_run.call_count)
+                self.assertEqual(50, len(self.buildhost.requests))
+
+                self.local_versions["pkg0"] = "1.0.0"
+                installed = update_stack.main(self.manifest.name,
+                                              self.buildhost.address,
+                                              "default",
+                                              staged=True)
+                self.assertEqual(50, len(self.buildhost.requests))
+                self.assertEqual(2, shell_run.call_count)
+        finally:
+            shutil.rmtree(folder)
+        del prefetched["pkg0"]
+        self.assertEqual(prefetched, installed)
+        self.assertEqual(9, len(installed))
+
+    def test_rollback(self):
+        folder = tempfile.mkdtemp()
+        retain_dir = os.path.join(folder, "retained")
+        try:
+            with patch.object(update_stack, "base_folder", folder), \
+                 patch.object(update_stack, "get_local_versions",
+                              lambda: self.local_versions), \
+                 patch.object(update_stack, "_shell_run",
+                             return_value=0) as shell_run:
+                installed = update_stack.main(self.manifest.name,
+                                              self.buildhost.address,
+                                              "default",
+                                              retain_dir=retain_dir)
+                self.assertEqual(10, len(installed))
+                for package, remote_package in self.remote_packages.items():
+                    self.local_versions[package] = remote_package["version"]
+
+                # the previous versions were not installed by mise-a-feu
+                with self.assertRaises(Exception):
+                    update_stack.main(self.manifest.name,
+                                      self.buildhost.address,
+                                      "default",
+                                      retain_dir=retain_dir,
+                                      rollback=True)
+
+                self.buildhost.routes.update({
+                    "/domains/default/stacks/latest/packages/pkg0/version":
+                        "1.1.0",
+                    "/packages/pkg0/version/1.1.0/file": "pkg0-1.1.0-amd64.deb",
+                    "/debs/pkg0-1.1.0-amd64.deb": "pkg0"})
+                update_stack.main(self.manifest.name,
+                                  self.buildhost.address,
+                                  "default",
+                                  retain_dir=retain_dir)
+                self.local_versions["pkg0"] = "1.1.0"
+                self.assertEqual(["pkg0-1.0.0-amd64.deb",
+                                  "pkg0-1.1.0-amd64.deb"],
+                                 sorted(name for name in os.listdir(retain_dir)
+                                        if name.startswith("pkg0")))
+
+                requests = len(self.buildhost.requests)
+                shell_run.reset_mock()
+                os.unlink(os.path.join(folder, "pkg0-1.0.0-amd64.deb"))
+                rolled_back = update_stack.main(self.manifest.name,
+                                                self.buildhost.address,
+                                                "default",
+                                                retain_dir=retain_dir,
+                                                rollback=True)
+                self.assertEqual(requests, len(self.buildhost.requests))
+                self.assertEqual({"pkg0": "pkg0-1.0.0-amd64.deb"}, rolled_back)
+                shell_run.assert_called_with(
+                    "dpkg --force-overwrite -i %s" %
+                    os.path.join(folder, "pkg0-1.0.0-amd64.deb"))
+                self.local_versions["pkg0"] = "1.0.0"
+
+                # the rollback can itself be rolled back, without callback
+                with patch.object(update_stack,
+                                  "send_web_callback") as callback:
+                    self.assertEqual({"pkg0": "pkg0-1.1.0-amd64.deb"},
+                                     update_stack.main(self.manifest.name,
+                                                       self.buildhost.address,
+                                                       "default",
+                                                       retain_dir=retain_dir,
+                                                       rollback=True,
+                                                       webcallback="http://x"))
+                self.assertFalse(callback.called)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_failed_install_not_retained(self):
+        folder = tempfile.mkdtemp()
+        retain_dir = os.path.join(folder, "retained")
+        try:
+            with patch.object(update_stack, "base_folder", folder), \
+                 patch.object(update_stack, "get_local_versions",
+                              lambda: self.local_versions), \
+                 patch.object(update_stack, "_shell_run", return_value=1), \
+                 patch.object(update_stack, "send_web_callback") as callback:
+                with self.assertRaises(Exception) as error:
+                    update_stack.main(self.manifest.name,
+                                      self.buildhost.address, "default",
+                                      retain_dir=retain_dir,
+                                      webcallback="http://x")
+            self.assertTrue("exit code 1" in str(error.exception))
+            self.assertFalse(callback.called)
+            self.assertTrue(os.path.exists(os.path.join(retain_dir,
+                                                        "rollback.json")))
+            self.assertFalse(os.path.exists(os.path.join(retain_dir,
+                                                         "index.json")))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_install_without_staged_packages(self):
+        folder = tempfile.mkdtemp()
+        try:
+            with patch.object(update_stack, "base_folder", folder):
+                with self.assertRaises(Exception):
+                    update_stack.main(self.manifest.name,
+                                      self.buildhost.address,
+                                      "default",
+                                      staged=True)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_concurrent_update(self):
+        folder = tempfile.mkdtemp()
+        try:
+            with patch.object(update_stack, "base_folder", folder), \
+                 patch.object(update_stack, "get_local_versions",
+                              lambda: self.local_versions), \
+                 patch.object(update_stack, "_shell_run",
+                              return_value=0) as shell_run:
+                with update_stack.update_lock():
+                    with self.assertRaises(Exception):
+                        update_stack.main(self.manifest.name,
+                                          self.buildhost.address, "default")
+                    self.assertEqual([], self.buildhost.requests)
+                self.assertEqual(10, len(update_stack.main(
+                                                self.manifest.name,
+                                                self.buildhost.address,
+                                                "default")))
+                self.assertEqual(2, shell_run.call_count)
+        finally:
+            shutil.rmtree(folder)
+
+
+class DownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.content = "".join(chr(index % 256) for index in range(200000))
+        self.buildhost = StubBuildhost(dict(
+            ("/debs/pkg%s-1.0.0-amd64.deb" % index, self.content)
+            for index in range(5)))
+        self.folder = tempfile.mkdtemp()
+        self.base_folder = patch.object(update_stack, "base_folder",
+                                        self.folder)
+        self.base_folder.start()
+
+    def tearDown(self):
+        self.base_folder.stop()
+        shutil.rmtree(self.folder)
+        update_stack.http_pool.close()
+        self.buildhost.stop()
+
+    def read(self, file_name):
+        with open(os.path.join(self.folder, file_name)) as deb:
+            return deb.read()
+
+    def test_download(self):
+        output = update_stack.download_package(self.buildhost.address,
+                                               "pkg0-1.0.0-amd64.deb")
+        self.assertEqual(len(self.content), output)
+        self.assertEqual(self.content, self.read("pkg0-1.0.0-amd64.deb"))
+        self.assertFalse(os.path.exists(
+                os.path.join(self.folder, "pkg0-1.0.0-amd64.deb.part")))
+
+    def test_resume_partial_download(self):
+        with open(os.path.join(self.folder,
+                               "pkg0-1.0.0-amd64.deb.part"), "w") as part:
+            part.write(self.content[:1000])
+        output = update_stack.download_package(self.buildhost.address,
+                                               "pkg0-1.0.0-amd64.deb")
+        self.assertEqual([1000], self.buildhost.ranges)
+        self.assertEqual(len(self.content) - 1000, output)
+        self.assertEqual(self.content, self.read("pkg0-1.0.0-amd64.deb"))
+
+    def test_resume_complete_download(self):
+        with open(os.path.join(self.folder,
+                               "pkg0-1.0.0-amd64.deb.part"), "w") as part:
+            part.write(self.content)
+        output = update_stack.download_package(self.buildhost.address,
+                                               "pkg0-1.0.0-amd64.deb")
+        self.assertEqual(0, output)
+        self.assertEqual(self.content, self.read("pkg0-1.0.0-amd64.deb"))
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(update_stack.ChecksumError):
+            update_stack.download_package(self.buildhost.address,
+                                          "pkg0-1.0.0-amd64.deb",
+                                          sha256="0" * 64)
+        self.assertEqual([], os.listdir(self.folder))
+
+        update_stack.download_package(
+                self.buildhost.address, "pkg0-1.0.0-amd64.deb",
+                sha256=hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(self.content, self.read("pkg0-1.0.0-amd64.deb"))
+
+    def test_digest_header(self):
+        self.buildhost.headers["/debs/pkg0-1.0.0-amd64.deb"] = {
+            "Digest": "SHA-256=%s" % base64.b64encode(
+                                            hashlib.sha256("other").digest())}
+        with self.assertRaises(update_stack.ChecksumError):
+            update_stack.download_package(self.buildhost.address,
+                                          "pkg0-1.0.0-amd64.deb")
+        self.assertEqual([], os.listdir(self.folder))
+
+        self.buildhost.headers["/debs/pkg0-1.0.0-amd64.deb"] = {
+            "Digest": "SHA-256=%s" % base64.b64encode(
+                                        hashlib.sha256(self.content).digest())}
+        update_stack.download_package(self.buildhost.address,
+                                      "pkg0-1.0.0-amd64.deb")
+        self.assertEqual(self.content, self.read("pkg0-1.0.0-amd64.deb"))
+
+    def test_resumed_download_checksum(self):
+        with open(os.path.join(self.folder,
+                               "pkg0-1.0.0-amd64.deb.part"), "w") as part:
+            part.write("corrupted" + self.content[9:1000])
+        with self.assertRaises(update_stack.ChecksumError):
+            update_stack.download_package(
+                self.buildhost.address, "pkg0-1.0.0-amd64.deb",
+                sha256=hashlib.sha256(self.content).hexdigest())
+        self.assertEqual([], os.listdir(self.folder))
+
+    def test_concurrent_downloads(self):
+        downloader = update_stack.Downloader(self.buildhost.address, jobs=2)
+        for index in range(5):
+            downloader.add("pkg%s-1.0.0-amd64.deb" % index)
+        downloader.add("pkg0-1.0.0-amd64.deb")
+        transfers = downloader.join()
+        self.assertEqual(5, len(transfers))
+        # the checksum and the package
+        self.assertEqual(10, len(self.buildhost.requests))
+        self.assertTrue(self.buildhost.connections <= 2)
+        for index in range(5):
+            self.assertEqual(self.content,
+                             self.read("pkg%s-1.0.0-amd64.deb" % index))
+
+    def test_cached_download(self):
+        cache = update_stack.PackageCache(os.path.join(self.folder, "cache"))
+        with patch.object(update_stack, "package_cache", cache):
+            for _ in range(2):
+                update_stack.download_package(self.buildhost.address,
+                                              "pkg0-1.0.0-amd64.deb")
+        self.assertEqual(["/debs/pkg0-1.0.0-amd64.deb.sha256",
+                          "/debs/pkg0-1.0.0-amd64.deb"],
+                         self.buildhost.requests)
+        self.assertEqual(self.content, self.read("pkg0-1.0.0-amd64.deb"))
+
+    def delta_routes(self, delta=None):
+        with open(os.path.join(self.folder, "pkg0-1.0.0-amd64.deb"),
+                  "w") as base:
+            base.write(self.content)
+        target = (self.content[:50000] + "new files" * 100 +
+                  self.content[50000:150000] + self.content[160000:])
+        self.buildhost.routes["/debs/pkg0-1.1.0-amd64.deb"] = target
+        self.buildhost.routes["/debs/pkg0-1.1.0-amd64.deb.sha256"] = \
+                                            hashlib.sha256(target).hexdigest()
+        self.buildhost.routes[
+            "/deltas/pkg0-1.0.0-amd64.deb/pkg0-1.1.0-amd64.deb"] = \
+                                delta or make_delta(self.content, target)
+        return target
+
+    def test_delta_download(self):
+        target = self.delta_routes()
+        output = update_stack.download_package(
+                            self.buildhost.address, "pkg0-1.1.0-amd64.deb",
+                            base=os.path.join(self.folder,
+                                              "pkg0-1.0.0-amd64.deb"))
+        self.assertTrue(output < len(target) / 10)
+        self.assertEqual(target, self.read("pkg0-1.1.0-amd64.deb"))
+        self.assertEqual(["/debs/pkg0-1.1.0-amd64.deb.sha256",
+                          "/deltas/pkg0-1.0.0-amd64.deb/pkg0-1.1.0-amd64.deb"],
+                         self.buildhost.requests)
+
+    def test_delta_download_fallback(self):
+        for delta in ("D\x00\x00\x00\x04data",
+                      "C\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00",
+                      "X"):
+            target = self.delta_routes(delta)
+            self.buildhost.requests = []
+            output = update_stack.download_package(
+                            self.buildhost.address, "pkg0-1.1.0-amd64.deb",
+                            sha256=hashlib.sha256(target).hexdigest(),
+                            base=os.path.join(self.folder,
+                                              "pkg0-1.0.0-amd64.deb"))
+            self.assertEqual(len(target), output)
+            self.assertEqual(target, self.read("pkg0-1.1.0-amd64.deb"))
+            self.assertEqual("/debs/pkg0-1.1.0-amd64.deb",
+                             self.buildhost.requests[-1])
+            self.assertFalse(os.path.exists(os.path.join(
+                            self.folder, "pkg0-1.1.0-amd64.deb.delta")))
+
+        del self.buildhost.routes[
+            "/deltas/pkg0-1.0.0-amd64.deb/pkg0-1.1.0-amd64.deb"]
+        self.assertEqual(len(target), update_stack.download_package(
+                            self.buildhost.address, "pkg0-1.1.0-amd64.deb",
+                            base=os.path.join(self.folder,
+                                              "pkg0-1.0.0-amd64.deb")))
+
+    def test_delta_bases(self):
+        retain_dir = os.path.join(self.folder, "retained")
+        os.makedirs(retain_dir)
+        with open(os.path.join(retain_dir, "pkg0-1.0.0-amd64.deb"), "w"):
+            pass
+        with open(os.path.join(retain_dir, "index.json"), "w") as index:
+            json.dump({"pkg0": {"version": "1.0.0",
+                                "file": "pkg0-1.0.0-amd64.deb"},
+                       "pkg1": {"version": "1.0.0",
+                                "file": "pkg1-1.0.0-amd64.deb"}}, index)
+        local_versions = {"pkg0": "1.0.0", "pkg1": "1.0.0"}
+        self.assertEqual({}, update_stack.get_delta_bases(local_versions))
+        with patch.object(update_stack, "delta_base_folder", retain_dir):
+            self.assertEqual({"pkg0": os.path.join(retain_dir,
+                                                   "pkg0-1.0.0-amd64.deb")},
+                             update_stack.get_delta_bases(local_versions))
+            # installed since in another version
+            local_versions["pkg0"] = "1.0.1"
+            self.assertEqual({}, update_stack.get_delta_bases(local_versions))
+
+    def test_failed_download(self):
+        downloader = update_stack.Downloader(self.buildhost.address)
+        downloader.add("missing-1.0.0-amd64.deb")
+        with self.assertRaises(urllib2.HTTPError):
+            downloader.join()
+
+
+class PackageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_folder = os.path.join(self.folder, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, file_name, content):
+        path = os.path.join(self.folder, file_name)
+        with open(path, "w") as deb:
+            deb.write(content)
+        return path
+
+    def test_get_cached_package(self):
+        cache = update_stack.PackageCache(self.cache_folder)
+        cache.put(self.write("pkg1.deb", "foo"), "pkg1.deb")
+        destination = os.path.join(self.folder, "copy.deb")
+        cache = update_stack.PackageCache(self.cache_folder)
+        self.assertTrue(cache.get("pkg1.deb", destination))
+        self.assertEqual("foo", open(destination).read())
+        self.assertFalse(cache.get("pkg2.deb", destination))
+
+    def test_checksum_mismatch(self):
+        cache = update_stack.PackageCache(self.cache_folder)
+        cache.put(self.write("pkg1.deb", "foo"), "pkg1.deb")
+        destination = os.path.join(self.folder, "copy.deb")
+        self.assertFalse(cache.get("pkg1.deb", destination, sha256="0" * 64))
+        self.assertEqual({}, cache.entries)
+
+    def test_corrupted_package(self):
+        cache = update_stack.PackageCache(self.cache_folder)
+        cache.put(self.write("pkg1.deb", "foo"), "pkg1.deb")
+        os.unlink(os.path.join(self.cache_folder, "pkg1.deb"))
+        with open(os.path.join(self.cache_folder, "pkg1.deb"), "w") as deb:
+            deb.write("bar")
+        self.assertFalse(cache.get("pkg1.deb",
+                                   os.path.join(self.folder, "copy.deb")))
+
+    def test_least_recently_used_eviction(self):
+        cache = update_stack.PackageCache(self.cache_folder,
+                                          max_bytes=10, max_entries=2)
+        cache.put(self.write("pkg1.deb", "1111"), "pkg1.deb")
+        cache.put(self.write("pkg2.deb", "2222"), "pkg2.deb")
+        cache.entries["pkg2.deb"]["used"] -= 10
+        cache.put(self.write("pkg3.deb", "3333"), "pkg3.deb")
+        self.assertEqual(["pkg1.deb", "pkg3.deb"], sorted(cache.entries))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_folder,
+                                                     "pkg2.deb")))
+        cache.put(self.write("pkg4.deb", "44444444"), "pkg4.deb")
+        self.assertEqual(["pkg4.deb"], sorted(cache.entries))
+
+    def test_shared_index(self):
+        first = update_stack.PackageCache(self.cache_folder)
+        second = update_stack.PackageCache(self.cache_folder)
+        first.put(self.write("pkg1.deb", "foo"), "pkg1.deb")
+        second.put(self.write("pkg2.deb", "bar"), "pkg2.deb")
+        cache = update_stack.PackageCache(self.cache_folder)
+        self.assertEqual(["pkg1.deb", "pkg2.deb"], sorted(cache.entries))
+
+    def test_checksum_outside_lock(self):
+        cache = update_stack.PackageCache(self.cache_folder)
+
+        def checksum(path):
+            self.assertFalse(cache._lock.locked())
+            return "0" * 64
+        with patch.object(update_stack, "_file_checksum", checksum):
+            cache.put(self.write("pkg1.deb", "foo"), "pkg1.deb")
+        self.assertEqual("0" * 64, cache.entries["pkg1.deb"]["sha256"])
+
+
+class JobTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.base_folder = patch.object(update_stack, "base_folder",
+                                        self.folder)
+        self.base_folder.start()
+
+    def tearDown(self):
+        self.base_folder.stop()
+        shutil.rmtree(self.folder)
+
+    def test_succeeded_job(self):
+        with patch.object(update_stack, "main",
+                          lambda **kwargs: {"pkg1": "pkg1-1.0.0-amd64.deb"}):
+            update_stack.run_job("1-1", manifest_file="foo")
+        status = update_stack.get_job_status("1-1")
+        self.assertEqual("succeeded", status["status"])
+        self.assertEqual(["pkg1"], status["packages"])
+
+    def test_failed_job(self):
+        def _main(**kwargs):
+            raise Exception("boom")
+        with patch.object(update_stack, "main", _main):
+            with self.assertRaises(Exception):
+                update_stack.run_job("1-1", manifest_file="foo")
+        status = update_stack.get_job_status("1-1")
+        self.assertEqual("failed", status["status"])
+        self.assertEqual("boom", status["error"])
+
+    def test_dead_job(self):
+        update_stack.write_job_status("1-1", status="running", pid=2 ** 22 + 1)
+        self.assertEqual("failed", update_stack.get_job_status("1-1")["status"])
+
+    def test_unknown_job(self):
+        self.assertEqual("unknown",
+                         update_stack.get_job_status("1-1")["status"])
+
+
+class PeerDownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.content = "package content" * 1000
+        self.file_name = "pkg1-1.0.0-amd64.deb"
+        self.buildhost = StubBuildhost({
+            "/debs/%s" % self.file_name: self.content,
+            "/debs/%s.sha256" % self.file_name: "%s  %s\n" % (
+                hashlib.sha256(self.content).hexdigest(), self.file_name)})
+        self.folder = tempfile.mkdtemp()
+        self.base_folder = patch.object(update_stack, "base_folder",
+                                        os.path.join(self.folder, "tmp"))
+        self.base_folder.start()
+        os.mkdir(update_stack.base_folder)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.base_folder.stop()
+        shutil.rmtree(self.folder)
+        update_stack.http_pool.close()
+        self.buildhost.stop()
+
+    def start_peer(self, content):
+        folder = tempfile.mkdtemp(dir=self.folder)
+        with open(os.path.join(folder, self.file_name), "w") as deb:
+            deb.write(content)
+        server = update_stack.PackageServer(("127.0.0.1", 0), folder)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return "127.0.0.1:%s" % server.server_address[1]
+
+    def dead_peer(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        address = "127.0.0.1:%s" % sock.getsockname()[1]
+        sock.close()
+        return address
+
+    def download(self, peers):
+        with patch.object(update_stack, "package_peers", peers):
+            update_stack.download_package(self.buildhost.address,
+                                          self.file_name)
+        with open(os.path.join(update_stack.base_folder,
+                               self.file_name)) as deb:
+            self.assertEqual(self.content, deb.read())
+
+    def test_download_from_peer(self):
+        self.download([self.start_peer(self.content)])
+        self.assertEqual(["/debs/%s.sha256" % self.file_name],
+                         self.buildhost.requests)
+
+    def test_skip_unavailable_and_corrupted_peers(self):
+        self.download([self.dead_peer(), self.start_peer("corrupted")])
+        self.assertEqual(["/debs/%s.sha256" % self.file_name,
+                          "/debs/%s" % self.file_name],
+                         self.buildhost.requests)
+
+    def test_no_peer_without_checksum(self):
+        del self.buildhost.routes["/debs/%s.sha256" % self.file_name]
+        self.download([self.start_peer("corrupted")])
+        self.assertEqual("/debs/%s" % self.file_name,
+                         self.buildhost.requests[-1])
+
+    def test_resume_from_peer(self):
+        with open(os.path.join(update_stack.base_folder,
+                               self.file_name + ".part"), "w") as part:
+            part.write(self.content[:100])
+        self.download([self.start_peer(self.content)])
+
+    def test_ranges(self):
+        url = "http://%s/debs/%s" % (self.start_peer(self.content),
+                                     self.file_name)
+        size = len(self.content)
+
+        def get(byte_range):
+            response = update_stack.http_pool.open("GET", url,
+                                                   headers={"Range": byte_range})
+            return response.getheader("content-range"), response.read()
+        self.assertEqual(("bytes 10-19/%d" % size, self.content[10:20]),
+                         get("bytes=10-19"))
+        self.assertEqual(("bytes %d-%d/%d" % (size - 5, size - 1, size),
+                          self.content[-5:]),
+                         get("bytes=-5"))
+        self.assertEqual(("bytes 100-%d/%d" % (size - 1, size),
+                          self.content[100:]),
+                         get("bytes=100-"))
+        for byte_range in ("bytes=%d-" % size, "bytes=0-1,5-6", "bytes=a-"):
+            with self.assertRaises(urllib2.HTTPError) as error:
+                get(byte_range)
+            self.assertEqual(416, error.exception.code)
+
+
+class WebCallbackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.callbacks = []
+        self.buildhost = StubBuildhost({"/callback": lambda body:
+                                            self.callbacks.append(body) or "",
+                                        "/broken": 503,
+                                        "/missing": 404})
+
+    def tearDown(self):
+        self.buildhost.stop()
+
+    def test_background_delivery(self):
+        timings = tempfile.NamedTemporaryFile()
+        with patch.object(update_stack, "timing_file", timings.name):
+            update_stack.send_web_callback(
+                    "http://%s/callback" % self.buildhost.address, ["pkg1"])
+        events = []
+        for _ in range(50):
+            events = [json.loads(line) for line in open(timings.name)]
+            if events:
+                break
+            time.sleep(0.1)
+        self.assertEqual([{"packages": ["pkg1"]}],
+                         [json.loads(body) for body in self.callbacks])
+        self.assertEqual([("web_callback", True)],
+                         [(event["phase"], event["succeeded"])
+                          for event in events])
+
+    def test_retries(self):
+        self.assertFalse(update_stack._do_web_callback(
+                    "http://%s/broken" % self.buildhost.address, ["pkg1"],
+                    retries=2, backoff=0))
+        self.assertEqual(["/broken"] * 3, self.buildhost.requests)
+
+    def test_no_retry_on_client_error(self):
+        self.assertFalse(update_stack._do_web_callback(
+                    "http://%s/missing" % self.buildhost.address, ["pkg1"],
+                    retries=2, backoff=0))
+        self.assertEqual(["/missing"], self.buildhost.requests)
+
+
+class AgentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.buildhost = StubBuildhost({
+            "/domains/default/stacks/latest/packages/mise-a-feu-test/version":
+                "1.0.0",
+            "/packages/mise-a-feu-test/version/1.0.0/file":
+                "mise-a-feu-test-1.0.0-amd64.deb",
+            "/debs/mise-a-feu-test-1.0.0-amd64.deb": "package"})
+        self.manifest = tempfile.NamedTemporaryFile()
+        self.manifest.write("mise-a-feu-test\n")
+        self.manifest.flush()
+        self.agent = LocalAgent(token="secret")
+
+    def tearDown(self):
+        self.agent.stop()
+        self.manifest.close()
+        self.buildhost.stop()
+
+    def arguments(self, *options):
+        return {"arguments": ["--no-lookup-cache", "--no-retain"] +
+                             list(options) + [self.manifest.name,
+                                              self.buildhost.address,
+                                              "default", "latest"]}
+
+    def test_status(self):
+        code, status = self.agent.request("/status")
+        self.assertEqual(200, code)
+        self.assertEqual(update_stack.__version__, status["version"])
+        self.assertEqual(0, status["updates"])
+        self.assertFalse(status["busy"])
+
+    def test_unauthorized(self):
+        self.assertEqual(401, self.agent.request("/status", token="other")[0])
+        self.assertEqual(401, self.agent.request(
+                            "/update", self.arguments("--plan-only"),
+                            token="other")[0])
+        self.assertEqual([], self.buildhost.requests)
+
+    def test_update(self):
+        for _ in range(2):
+            code, answer = self.agent.request("/update",
+                                              self.arguments("--plan-only"))
+            self.assertEqual(200, code)
+            self.assertEqual("succeeded", answer["status"])
+            self.assertEqual([{"package": "mise-a-feu-test",
+                               "installed": "",
+                               "version": "1.0.0",
+                               "file": "mise-a-feu-test-1.0.0-amd64.deb",
+                               "size": 7,
+                               "cached": False,
+                               "action": "install"}],
+                             answer["output"]["changes"])
+        self.assertEqual(2, self.agent.request("/status")[1]["updates"])
+
+    def test_failed_update(self):
+        self.buildhost.routes[
+            "/domains/default/stacks/latest/packages/mise-a-feu-test/version"
+        ] = 500
+        code, answer = self.agent.request("/update",
+                                          self.arguments("--plan-only"))
+        self.assertEqual(500, code)
+        self.assertEqual("failed", answer["status"])
+        self.assertTrue("500" in answer["error"])
+
+    def test_invalid_update(self):
+        for arguments in (self.arguments("--detach"),
+                          self.arguments("--timings", "/etc/cron.d/x"),
+                          self.arguments("--lookup-cache", "/etc/passwd"),
+                          self.arguments("--cache-dir", "/etc"),
+                          self.arguments("--retain-dir", "/etc"),
+                          {"arguments": ["--plan-only"]},
+                          {"manifest": self.manifest.name}):
+            code, answer = self.agent.request("/update", arguments)
+            self.assertEqual(400, code)
+        self.assertEqual(0, self.agent.request("/status")[1]["updates"])
+
+    def test_agent_options(self):
+        self.agent.stop()
+        timings = tempfile.NamedTemporaryFile()
+        self.agent = LocalAgent("secret", "--timings", timings.name)
+        code, answer = self.agent.request("/update",
+                                          self.arguments("--plan-only"))
+        self.assertEqual(200, code)
+        self.assertTrue([json.loads(line) for line in open(timings.name)])
+        self.assertEqual({"timings": timings.name,
+                          "lookup_cache_file": None,
+                          "cache_dir": "/srv/cache",
+                          "retain_dir": "/srv/retained"},
+                         update_stack.apply_agent_options(
+                                    {"timings": None,
+                                     "lookup_cache_file": None,
+                                     "cache_dir": None,
+                                     "retain_dir": "/var/cache/mise-a-feu/"
+                                                   "retained"},
+                                    {"timings": timings.name,
+                                     "lookup_cache_file": "/srv/lookups.json",
+                                     "cache_dir": "/srv/cache",
+                                     "retain_dir": "/srv/retained"}))
+
+    def test_token_required(self):
+        with open(os.devnull, "w") as devnull:
+            code = subprocess.call([sys.executable,
+                                    os.path.splitext(update_stack.__file__)[0]
+                                    + ".py", "--agent", "0"],
+                                   stdout=devnull, stderr=devnull)
+        self.assertEqual(2, code)
@@ -1,7 +1,13 @@
 import os
+import tempfile
 import unittest
 
-from mise_a_feu.lib.utils import str2bool, get_config
+from fabric.api import settings
+from fabric.exceptions import CommandTimeout
+from mock import patch
+
+from mise_a_feu.lib.utils import str2bool, get_config, host_outcome, \
+                                 parse_time, record_deployment
 
 class Str2BoolTestCase(unittest.TestCase):
 
@@ -28,3 +34,42 @@ class GetConfigTestCase(unittest.TestCase):
         config = get_config(config_file)
         self.assertEqual(["localhost"], config["hosts"])
         self.assertEqual(2, len(config["post_deployment"]))
+
+class HostOutcomeTestCase(unittest.TestCase):
+
+    def test_host_outcome(self):
+        class Output(str):
+            failed = True
+            return_code = 2
+
+        self.assertEqual(("succeeded", None), host_outcome("output"))
+        self.assertEqual(("failed", "exit code 2"), host_outcome(Output("")))
+        self.assertEqual(("failed", "boom"), host_outcome(Exception("boom")))
+        self.assertEqual(("failed", "no result"), host_outcome(None))
+        self.assertEqual(("stopped", None), host_outcome({"status": "stopped"}))
+        self.assertEqual(("timeout", "job 12-34 still running"),
+                         host_outcome({"status": "running", "job": "12-34"}))
+        self.assertEqual("timeout",
+                         host_outcome(CommandTimeout(timeout=30))[0])
+
+class RecordDeploymentTestCase(unittest.TestCase):
+
+    def test_database_error(self):
+        history_db = tempfile.NamedTemporaryFile()
+        history_db.write("not a database" * 100)
+        history_db.flush()
+        with settings(rcfile="examples/example_config.yml",
+                      history_db=history_db.name), \
+             patch("mise_a_feu.lib.utils.warn") as warn:
+            self.assertEqual(None, record_deployment("1.2.3", 0, "failed",
+                                                     {}, {}))
+        self.assertTrue(warn.called)
+
+
+class ParseTimeTestCase(unittest.TestCase):
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time("2014-05-01") + 3723,
+                         parse_time("2014-05-01 01:02:03"))
+        with self.assertRaises(SystemExit):
+            parse_time("yesterday")